@@ -0,0 +1,77 @@
+"""Single-stream greedy tokens/s of a TextGenerationModel with and without a
+draft model, with the draft's acceptance rate.
+
+Random weights make every model disagree with every other, so the target is
+built with its last layers damped and a sharpened head: its first layers
+then decide most tokens, like a large model whose small sibling often
+predicts the same thing. The "aligned" draft is those first layers, the
+"unrelated" draft a separately initialized model sharing the tokenizer.
+
+Usage: python -m benchmarks.assisted_decoding [--size large] [--draft-layers 2]
+"""
+
+import argparse
+import os
+import time
+
+import torch
+from transformers import LlamaForCausalLM
+
+from src.domain.models.constants import MODELS_DIR
+from src.domain.models.text.text_generation import TextGenerationModel
+
+from .tiny_models import CORPUS, build_draft_model, tiny_models_dir
+
+
+def make_predictable(path, keep_layers, damping=0.05, sharpening=8.0):
+    model = LlamaForCausalLM.from_pretrained(path)
+    with torch.no_grad():
+        for layer in model.model.layers[keep_layers:]:
+            layer.self_attn.o_proj.weight.mul_(damping)
+            layer.mlp.down_proj.weight.mul_(damping)
+        model.lm_head.weight.mul_(sharpening)
+    model.save_pretrained(path)
+
+
+def run(model, max_new_tokens):
+    start = time.perf_counter()
+    tokens = 0
+    for prompt in CORPUS:
+        text = model.generate(prompt, max_new_tokens=max_new_tokens, do_sample=False)
+        tokens += len(model.tokenizer.encode(text)) - len(model.tokenizer.encode(prompt))
+    return time.perf_counter() - start, tokens
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--size", default="large")
+    parser.add_argument("--draft-layers", type=int, default=2)
+    parser.add_argument("--max-new-tokens", type=int, default=64)
+    args = parser.parse_args()
+
+    tag = "text-generation"
+    with tiny_models_dir({(tag, "target"): {"size": args.size}, (tag, "unrelated"): {"size": "tiny"}}):
+        target_path = os.path.join(MODELS_DIR, tag, "target")
+        make_predictable(target_path, args.draft_layers)
+        build_draft_model(target_path, os.path.join(MODELS_DIR, tag, "aligned"), args.draft_layers)
+
+        model = TextGenerationModel("target", batching=False)
+        model.load()
+        run(model, 8)  # warmup
+
+        print(f"{'draft':>10} {'seconds':>9} {'tokens/s':>9} {'accepted':>9} {'tok/pass':>9}")
+        elapsed, tokens = run(model, args.max_new_tokens)
+        print(f"{'none':>10} {elapsed:>9.2f} {tokens / elapsed:>9.1f} {'-':>9} {1.0:>9.2f}")
+        for draft_id in ("aligned", "unrelated"):
+            model.load_draft(draft_id)
+            elapsed, tokens = run(model, args.max_new_tokens)
+            stats = model.assisted_stats
+            print(
+                f"{draft_id:>10} {elapsed:>9.2f} {tokens / elapsed:>9.1f}"
+                f" {stats.acceptance_rate:>9.0%} {stats.tokens_per_pass:>9.2f}"
+            )
+        model.unload()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,95 @@
+"""Throughput of the batch inference CLI on prompts of mixed lengths: one
+prompt at a time, batches in input order and batches of length-sorted
+prompts, with the padding efficiency of each.
+
+Then a run is interrupted halfway and resumed, and every prompt must have
+exactly one output.
+
+Usage: python -m benchmarks.batch_inference [--prompts 128] [--batch-size 8]
+"""
+
+import argparse
+import json
+import os
+import random
+
+from src.cli.batch_inference import BatchRunner
+from src.domain.models.text.text_generation import TextGenerationModel
+
+from .generation import make_prompt
+from .tiny_models import tiny_models_dir
+
+
+class _Interrupt(Exception):
+    pass
+
+
+def write_prompts(path, tokenizer, prompts, max_length):
+    lengths = random.Random(0).choices(range(8, max_length), k=prompts)
+    with open(path, "w") as f:
+        for i, length in enumerate(lengths):
+            f.write(json.dumps({"id": f"p{i}", "prompt": make_prompt(tokenizer, length, i)}) + "\n")
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--prompts", type=int, default=128)
+    parser.add_argument("--batch-size", type=int, default=8)
+    parser.add_argument("--max-prompt-tokens", type=int, default=384)
+    parser.add_argument("--max-new-tokens", type=int, default=16)
+    parser.add_argument("--size", default="small")
+    args = parser.parse_args()
+
+    kwargs = dict(max_new_tokens=args.max_new_tokens, min_new_tokens=args.max_new_tokens, do_sample=False)
+    with tiny_models_dir({("text-generation", "bench"): {"size": args.size}}) as tmp:
+        model = TextGenerationModel("bench", batching=False)
+        model.load()
+        model.warmup()
+        prompts = os.path.join(tmp, "prompts.jsonl")
+        write_prompts(prompts, model.tokenizer, args.prompts, args.max_prompt_tokens)
+
+        print(f"{args.prompts} prompts of 8-{args.max_prompt_tokens} tokens, {args.max_new_tokens} new tokens each")
+        print(f"{'batches':>16} {'seconds':>8} {'prompts/s':>10} {'tokens/s':>9} {'padding eff.':>12}")
+        setups = [
+            ("one at a time", dict(batch_size=1)),
+            ("input order", dict(batch_size=args.batch_size, sort=False)),
+            ("length-sorted", dict(batch_size=args.batch_size)),
+        ]
+        for name, setup in setups:
+            output = os.path.join(tmp, f"{name}.jsonl")
+            report = BatchRunner(model, progress=None, **setup, **kwargs).run(prompts, output)
+            print(
+                f"{name:>16} {report.elapsed:>8.2f} {report.prompts_per_second:>10.2f}"
+                f" {report.tokens_per_second:>9.1f} {report.padding_efficiency:>12.0%}"
+            )
+
+        # interrupted after half of the batches, then resumed
+        output = os.path.join(tmp, "resumed.jsonl")
+        runner = BatchRunner(model, batch_size=args.batch_size, progress=None, **kwargs)
+        batches = args.prompts // args.batch_size // 2
+        write = runner._write
+
+        def interrupting_write(out, results):
+            if runner.report.batches > batches:
+                raise _Interrupt()
+            write(out, results)
+
+        runner._write = interrupting_write
+        try:
+            runner.run(prompts, output)
+        except _Interrupt:
+            pass
+        first = runner.report.generated
+        report = BatchRunner(model, batch_size=args.batch_size, progress=None, **kwargs).run(prompts, output)
+        with open(output) as f:
+            ids = [json.loads(line)["id"] for line in f]
+        complete = sorted(ids) == sorted(f"p{i}" for i in range(args.prompts))
+        print(
+            f"\ninterrupted after {first} prompts, resumed: {report.skipped} skipped,"
+            f" {report.generated} generated, each prompt once: {complete}"
+        )
+        model.unload()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,81 @@
+"""Tokens/s of live streaming chats on one ConversationalModel while as many
+other chats are abandoned after their first tokens, e.g. closed tabs.
+
+Abandoned chats either keep generating until `max_new_tokens` (the reader
+just stops reading) or are cancelled through their streamer.
+
+Usage: python -m benchmarks.cancellation [--chats 4] [--size small]
+"""
+
+import argparse
+import threading
+import time
+
+from src.domain.models.text.conversational import ConversationalModel
+
+from .tiny_models import CORPUS, tiny_models_dir
+
+
+def run(model, chats, cancel, max_new_tokens):
+    tokens = [0] * chats
+    saved = []
+
+    def chat(i, abandon):
+        messages = [{"role": "user", "content": CORPUS[i % len(CORPUS)]}]
+        streamer = model.generate(
+            messages,
+            stream=True,
+            max_new_tokens=max_new_tokens,
+            min_new_tokens=max_new_tokens,
+            do_sample=False,
+            on_metrics=lambda metrics: saved.append(metrics.saved_tokens),
+        )
+        if abandon:
+            next(iter(streamer))
+            if cancel:
+                streamer.cancel()
+            return
+        text = "".join(streamer)
+        tokens[i] = len(model.tokenizer.encode(text, add_special_tokens=False))
+
+    abandoned = [threading.Thread(target=chat, args=(i, True)) for i in range(chats)]
+    live = [threading.Thread(target=chat, args=(i, False)) for i in range(chats)]
+    start = time.perf_counter()
+    for thread in abandoned + live:
+        thread.start()
+    for thread in live:
+        thread.join()
+    elapsed = time.perf_counter() - start
+    # let the abandoned generations finish before the next run
+    while len(saved) < 2 * chats:
+        time.sleep(0.01)
+    return elapsed, sum(tokens), sum(saved)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--chats", type=int, default=4)
+    parser.add_argument("--max-new-tokens", type=int, default=128)
+    parser.add_argument("--size", default="small")
+    args = parser.parse_args()
+
+    with tiny_models_dir({("conversational", "bench"): {"size": args.size}}):
+        print(f"{args.chats} live and {args.chats} abandoned chats")
+        print(f"{'mode':>11} {'abandoned':>10} {'seconds':>9} {'live tokens/s':>14} {'saved tokens':>13}")
+        for continuous_batching in (False, True):
+            model = ConversationalModel("bench", continuous_batching=continuous_batching)
+            model.load()
+            run(model, 1, True, 8)  # warmup
+            mode = "continuous" if continuous_batching else "threads"
+            for cancel in (False, True):
+                elapsed, tokens, saved = run(model, args.chats, cancel, args.max_new_tokens)
+                abandoned = "cancelled" if cancel else "left"
+                print(
+                    f"{mode:>11} {abandoned:>10} {elapsed:>9.2f}"
+                    f" {tokens / elapsed:>14.1f} {saved:>13}"
+                )
+            model.unload()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,55 @@
+"""Time to first token per chat turn, with and without KV-cache reuse.
+
+Without reuse every turn prefills the whole conversation, so TTFT grows
+with the history; with reuse only the tokens appended since the previous
+turn are prefilled.
+
+Usage: python -m benchmarks.chat_kv_reuse [--turns 12] [--size medium]
+"""
+
+import argparse
+import time
+
+from src.use_cases.chat_service import ChatService
+
+from .tiny_models import CORPUS, tiny_models_dir
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--turns", type=int, default=12)
+    parser.add_argument("--size", default="medium")
+    args = parser.parse_args()
+
+    user_message = " ".join(CORPUS[1:3]) * 3
+    assistant_message = " ".join(CORPUS[2:4]) * 3
+
+    with tiny_models_dir({("conversational", "bench"): {"size": args.size}}):
+        service = ChatService()
+        service.set_assistant("bench")
+        service.append_message("system", "You are a helpful assistant.")
+        tokenizer = service.assistant.tokenizer
+
+        print(f"{'turn':>5} {'tokens':>7} {'no reuse ms':>12} {'reuse ms':>9} {'reused':>7}")
+        for turn in range(1, args.turns + 1):
+            start = time.perf_counter()
+            service.send(user_message, max_new_tokens=1, do_sample=False)
+            reuse = time.perf_counter() - start
+            reused = service._cache.reused_tokens
+
+            start = time.perf_counter()
+            service.assistant.generate(
+                service.get_messages(), max_new_tokens=1, do_sample=False
+            )
+            no_reuse = time.perf_counter() - start
+
+            tokens = len(tokenizer.apply_chat_template(service.get_messages()))
+            print(
+                f"{turn:>5} {tokens:>7} {no_reuse * 1000:>12.1f} "
+                f"{reuse * 1000:>9.1f} {reused:>7}"
+            )
+            service.append_message("assistant", assistant_message)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,70 @@
+"""Time-to-ready and peak RSS of loading a TextGenerationModel, per CPU
+load mode: converting on every load vs. converting once into a snapshot
+and mapping it on the next loads.
+
+Time-to-ready is the load plus the first generated token. Every load runs
+in a fresh process, the model files are in the OS page cache.
+
+Usage: python -m benchmarks.cold_start [--size large] [--modes fp32 bf16 int8]
+"""
+
+import argparse
+import multiprocessing
+import os
+import shutil
+import time
+
+import psutil
+
+from src.domain.models.constants import MODELS_DIR
+from src.domain.models.text.snapshots import SNAPSHOTS_DIR
+from src.domain.models.text.text_generation import TextGenerationModel
+
+from .memory import peak_rss, reset_peak_rss
+from .tiny_models import tiny_models_dir
+
+
+def measure(mode, use_snapshots):
+    model = TextGenerationModel("bench", batching=False, load_mode=mode)
+    model.use_snapshots = use_snapshots
+    baseline = psutil.Process().memory_info().rss
+    reset_peak_rss()
+    start = time.perf_counter()
+    model.load()
+    load_time = time.perf_counter() - start
+    model.generate("Hello", max_new_tokens=1, do_sample=False)
+    return {
+        "load_time": load_time,
+        "ready_time": time.perf_counter() - start,
+        "peak_rss": peak_rss() - baseline,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--size", default="large")
+    parser.add_argument("--modes", nargs="+", default=["fp32", "bf16", "int8"])
+    args = parser.parse_args()
+
+    context = multiprocessing.get_context("spawn")
+    with tiny_models_dir({("text-generation", "bench"): {"size": args.size}}):
+        snapshots = os.path.join(MODELS_DIR, "text-generation", "bench", SNAPSHOTS_DIR)
+        print(f"{'mode':>5} {'load':>16} {'load s':>7} {'ready s':>8} {'peak RSS MB':>12}")
+        for mode in args.modes:
+            shutil.rmtree(snapshots, ignore_errors=True)
+            runs = [
+                ("convert", False),
+                ("convert + store", True),
+                ("snapshot", True),
+            ]
+            for name, use_snapshots in runs:
+                with context.Pool(1) as pool:
+                    result = pool.apply(measure, (mode, use_snapshots))
+                print(
+                    f"{mode:>5} {name:>16} {result['load_time']:>7.2f}"
+                    f" {result['ready_time']:>8.2f} {result['peak_rss'] / 1024**2:>12.0f}"
+                )
+
+
+if __name__ == "__main__":
+    main()
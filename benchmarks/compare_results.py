@@ -0,0 +1,79 @@
+"""Compare two result files of `benchmarks.generation`, e.g. of the base and
+the head commit of a change, and flag the cases that got worse by more
+than the tolerance. Exits with status 1 if any did.
+
+Usage: python -m benchmarks.compare_results base.json head.json [--tolerance 0.1]
+"""
+
+import argparse
+import json
+import sys
+
+from .generation import KEY_FIELDS
+
+# metric, percentile (None for scalars), whether higher is better
+METRICS = [
+    ("ttft_ms", "p50", False),
+    ("itl_ms", "p50", False),
+    ("itl_ms", "p90", False),
+    ("latency_ms", "p50", False),
+    ("tokens_per_second", None, True),
+    ("peak_rss_mb", None, False),
+]
+
+
+def load(path):
+    with open(path) as f:
+        data = json.load(f)
+    return data["metadata"], {
+        tuple(result[field] for field in KEY_FIELDS): result for result in data["results"]
+    }
+
+
+def metric_value(result, metric, percentile):
+    value = result.get(metric)
+    if percentile is not None:
+        value = value.get(percentile) if value else None
+    return value
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("base")
+    parser.add_argument("head")
+    parser.add_argument("--tolerance", type=float, default=0.1)
+    args = parser.parse_args()
+
+    base_metadata, base = load(args.base)
+    head_metadata, head = load(args.head)
+    print(f"base: {base_metadata.get('commit')}  head: {head_metadata.get('commit')}")
+    for field in ("size", "torch", "transformers", "platform", "cpus"):
+        if base_metadata.get(field) != head_metadata.get(field):
+            print(f"warning: {field} differs: {base_metadata.get(field)} vs {head_metadata.get(field)}")
+
+    regressions = 0
+    for key in sorted(base.keys() & head.keys(), key=str):
+        for metric, percentile, higher_is_better in METRICS:
+            before = metric_value(base[key], metric, percentile)
+            after = metric_value(head[key], metric, percentile)
+            if not before or after is None:
+                continue
+            change = (after - before) / before
+            worse = -change if higher_is_better else change
+            if worse > args.tolerance:
+                regressions += 1
+                name = f"{metric}.{percentile}" if percentile else metric
+                print(
+                    f"REGRESSION {' '.join(map(str, key))}: {name}"
+                    f" {before:.2f} -> {after:.2f} ({change:+.0%})"
+                )
+
+    missing = base.keys() ^ head.keys()
+    if missing:
+        print(f"{len(missing)} cases are only in one of the files")
+    print(f"{len(base.keys() & head.keys())} cases compared, {regressions} regressions")
+    sys.exit(1 if regressions else 0)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,63 @@
+"""Per-token decode latency of a TextGenerationModel in eager mode and with
+the compiled static-cache generation mode, with the one-off compile time
+and whether both modes produce the same greedy output.
+
+Usage: python -m benchmarks.compiled_generation [--size small] [--max-new-tokens 64]
+"""
+
+import argparse
+import time
+
+from src.domain.models.text.text_generation import TextGenerationModel
+
+from .tiny_models import CORPUS, tiny_models_dir
+
+
+def run(model, max_new_tokens):
+    """Greedy outputs and the mean seconds per decoded token: the time after
+    the first new token (so without the prompt prefill) over the tokens each
+    generation actually produced after it."""
+    outputs = []
+    decode_time = 0.0
+    tokens = 0
+    for prompt in CORPUS:
+        kwargs = dict(max_new_tokens=max_new_tokens, min_new_tokens=max_new_tokens, do_sample=False)
+        metrics = []
+        for _ in model.generate(prompt, stream=True, on_metrics=metrics.append, **kwargs):
+            pass
+        if metrics[0].new_tokens > 1:
+            decode_time += metrics[0].duration - metrics[0].ttft
+            tokens += metrics[0].new_tokens - 1
+        outputs.append(model.generate(prompt, **kwargs))
+    return outputs, decode_time / max(tokens, 1)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--size", default="small")
+    parser.add_argument("--max-new-tokens", type=int, default=64)
+    args = parser.parse_args()
+
+    with tiny_models_dir({("text-generation", "bench"): {"size": args.size}}):
+        eager = TextGenerationModel("bench", batching=False, compile_generation=False)
+        eager.load()
+        run(eager, 4)  # warmup
+        eager_outputs, eager_latency = run(eager, args.max_new_tokens)
+        eager.unload()
+
+        compiled = TextGenerationModel("bench", batching=False, compile_generation=True)
+        compiled.load()
+        start = time.perf_counter()
+        compiled.warmup()
+        compile_time = time.perf_counter() - start
+        compiled_outputs, compiled_latency = run(compiled, args.max_new_tokens)
+
+        print(f"first compile:      {compile_time:.1f} s")
+        print(f"eager ms/token:     {eager_latency * 1000:.2f}")
+        print(f"compiled ms/token:  {compiled_latency * 1000:.2f}")
+        print(f"speedup:            {eager_latency / compiled_latency:.2f}x")
+        print(f"identical outputs:  {eager_outputs == compiled_outputs}")
+
+
+if __name__ == "__main__":
+    main()
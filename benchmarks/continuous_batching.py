@@ -0,0 +1,62 @@
+"""Aggregate tokens/s of concurrent streaming chats on one ConversationalModel:
+one `model.generate` thread per chat vs. the shared continuous-batching loop.
+
+Chats ask for different reply lengths, so static batches would make the
+short ones wait for the longest.
+
+Usage: python -m benchmarks.continuous_batching [--chats 8] [--size small]
+"""
+
+import argparse
+import threading
+import time
+
+from src.domain.models.text.conversational import ConversationalModel
+
+from .tiny_models import CORPUS, tiny_models_dir
+
+
+def run(model, chats):
+    tokens = [0] * chats
+
+    def chat(i):
+        messages = [
+            {"role": "system", "content": "You are a helpful assistant."},
+            {"role": "user", "content": CORPUS[i % len(CORPUS)]},
+        ]
+        streamer = model.generate(
+            messages, stream=True, max_new_tokens=16 + 16 * (i % 4), do_sample=False
+        )
+        text = "".join(streamer)
+        tokens[i] = len(model.tokenizer.encode(text, add_special_tokens=False))
+
+    threads = [threading.Thread(target=chat, args=(i,)) for i in range(chats)]
+    start = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return time.perf_counter() - start, sum(tokens)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--chats", type=int, nargs="+", default=[1, 4, 8])
+    parser.add_argument("--size", default="small")
+    args = parser.parse_args()
+
+    with tiny_models_dir({("conversational", "bench"): {"size": args.size}}):
+        print(f"{'chats':>6} {'mode':>11} {'seconds':>9} {'tokens/s':>9}")
+        for continuous_batching in (False, True):
+            model = ConversationalModel("bench", continuous_batching=continuous_batching)
+            model.load()
+            run(model, 1)  # warmup
+            for chats in args.chats:
+                elapsed, tokens = run(model, chats)
+                mode = "continuous" if continuous_batching else "threads"
+                print(f"{chats:>6} {mode:>11} {elapsed:>9.2f} {tokens / elapsed:>9.1f}")
+            model.unload()
+
+
+if __name__ == "__main__":
+    main()
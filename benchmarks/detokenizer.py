@@ -0,0 +1,71 @@
+"""Decoding cost per streamed token of `TextIteratorStreamer` and
+`IncrementalTextStreamer` as the output grows, on text without word or line
+boundaries (e.g. minified code, URLs, base64) and on ordinary prose.
+
+`TextIteratorStreamer` re-decodes everything since the last space or
+newline on every token, so its cost grows with the length of the current
+"word"; the incremental streamer's should stay flat.
+
+Usage: python -m benchmarks.detokenizer [--tokens 4096] [--window 512]
+"""
+
+import argparse
+import time
+
+import torch
+from transformers import TextIteratorStreamer
+
+from src.domain.models.text.streaming import IncrementalTextStreamer
+
+from .tiny_models import CORPUS, build_tokenizer
+
+TEXTS = {
+    "no spaces": "".join(text.replace(" ", "_").replace("\n", ";") for text in CORPUS),
+    "prose": " ".join(CORPUS),
+}
+
+
+def stream(streamer_class, tokenizer, ids, window):
+    """Microseconds per token of each `window` consecutive tokens, and the text."""
+    streamer = streamer_class(tokenizer, skip_prompt=True, skip_special_tokens=True)
+    streamer.put(torch.tensor([ids[:1]]))
+    costs = []
+    elapsed = 0.0
+    for i, token in enumerate(ids[1:], start=1):
+        start = time.perf_counter()
+        streamer.put(torch.tensor([token]))
+        elapsed += time.perf_counter() - start
+        if i % window == 0:
+            costs.append(elapsed / window * 1e6)
+            elapsed = 0.0
+    streamer.end()
+    return costs, "".join(streamer)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--tokens", type=int, default=4096)
+    parser.add_argument("--window", type=int, default=512)
+    args = parser.parse_args()
+
+    tokenizer = build_tokenizer()
+    for name, text in TEXTS.items():
+        ids = tokenizer.encode(text, add_special_tokens=False)
+        ids = (ids * (args.tokens // len(ids) + 1))[: args.tokens + 1]
+        expected = tokenizer.decode(ids[1:], skip_special_tokens=True)
+
+        baseline, baseline_text = stream(TextIteratorStreamer, tokenizer, ids, args.window)
+        incremental, incremental_text = stream(IncrementalTextStreamer, tokenizer, ids, args.window)
+
+        print(f"{name}: µs/token at output position")
+        print(f"{'tokens':>12} {'TextIterator':>13} {'Incremental':>12}")
+        for i, (a, b) in enumerate(zip(baseline, incremental)):
+            print(f"{f'{i * args.window}-{(i + 1) * args.window}':>12} {a:>13.1f} {b:>12.1f}")
+        print(
+            f"text matches a full decode: TextIterator {baseline_text == expected},"
+            f" Incremental {incremental_text == expected}\n"
+        )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,80 @@
+"""Single large file: one stream vs. parallel HTTP Range chunks.
+
+The stub throttles every connection, like a single TCP stream to the CDN
+would be, so chunked downloads should scale with `range_workers`.
+
+Usage: python -m benchmarks.download_ranged [--file-mb 64] [--range-mb 8] [--bandwidth-mb 16]
+"""
+
+import argparse
+import hashlib
+import os
+import tempfile
+import time
+
+from src.use_cases.repo_downloader import RepoDownloader
+
+from .stub_hub import StubHub
+
+
+def run(hub, repo_id, files, **kwargs):
+    downloader = RepoDownloader(hub.endpoint, max_workers=1, retries=2, **kwargs)
+    with tempfile.TemporaryDirectory() as tmp:
+        start = time.perf_counter()
+        (path,) = downloader.download(repo_id, files, tmp)
+        elapsed = time.perf_counter() - start
+        with open(path, "rb") as f:
+            digest = hashlib.sha256(f.read()).hexdigest()
+    return elapsed, digest
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--file-mb", type=float, default=64)
+    parser.add_argument("--range-mb", type=float, default=8)
+    parser.add_argument("--bandwidth-mb", type=float, default=16)
+    parser.add_argument("--workers", type=int, nargs="+", default=[2, 4, 8])
+    args = parser.parse_args()
+
+    content = os.urandom(int(args.file_mb * 1024**2))
+    expected = hashlib.sha256(content).hexdigest()
+    repo_id = "stub/large-model"
+    files = [{"rfilename": "model.safetensors", "size": len(content)}]
+    range_size = int(args.range_mb * 1024**2)
+
+    with StubHub(num_models=0, latency=0, bandwidth=args.bandwidth_mb * 1024**2) as hub:
+        hub.add_repo(repo_id, {"model.safetensors": content})
+        print(f"{args.file_mb} MB file, {args.bandwidth_mb} MB/s per connection")
+        print(f"{'mode':>14} {'seconds':>9} {'MB/s':>8}")
+
+        elapsed, digest = run(hub, repo_id, files, ranged_threshold=len(content) + 1)
+        assert digest == expected
+        print(f"{'single-stream':>14} {elapsed:>9.2f} {args.file_mb / elapsed:>8.1f}")
+
+        for workers in args.workers:
+            elapsed, digest = run(
+                hub,
+                repo_id,
+                files,
+                ranged_threshold=0,
+                range_size=range_size,
+                range_workers=workers,
+            )
+            assert digest == expected
+            print(f"{f'{workers} ranges':>14} {elapsed:>9.2f} {args.file_mb / elapsed:>8.1f}")
+
+        hub.drop_after = range_size // 2
+        elapsed, digest = run(
+            hub,
+            repo_id,
+            files,
+            ranged_threshold=0,
+            range_size=range_size,
+            range_workers=args.workers[-1],
+        )
+        assert digest == expected
+        print(f"interrupted chunk recovered, etag verified: {elapsed:.2f}s")
+
+
+if __name__ == "__main__":
+    main()
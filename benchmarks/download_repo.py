@@ -0,0 +1,66 @@
+"""Whole-repository download throughput against a local stub Hub.
+
+Each stub connection is throttled, so the aggregate rate should grow with
+the number of download workers. The last run cuts every file mid-transfer
+once and checks that the downloader resumes instead of starting over.
+
+Usage: python -m benchmarks.download_repo [--files 8] [--file-mb 4] [--bandwidth-mb 8]
+"""
+
+import argparse
+import os
+import tempfile
+import time
+
+from src.use_cases.repo_downloader import RepoDownloader
+
+from .stub_hub import StubHub
+
+
+def run(hub, repo_id, files, workers):
+    downloader = RepoDownloader(hub.endpoint, max_workers=workers, retries=2)
+    with tempfile.TemporaryDirectory() as tmp:
+        start = time.perf_counter()
+        paths = downloader.download(repo_id, files, tmp)
+        elapsed = time.perf_counter() - start
+        for path, file in zip(paths, files):
+            assert os.path.getsize(path) == file["size"]
+    return elapsed
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--files", type=int, default=8)
+    parser.add_argument("--file-mb", type=float, default=4)
+    parser.add_argument("--bandwidth-mb", type=float, default=8)
+    parser.add_argument("--workers", type=int, nargs="+", default=[1, 2, 4, 8])
+    args = parser.parse_args()
+
+    file_size = int(args.file_mb * 1024**2)
+    repo_id = "stub/sharded-model"
+    content = {
+        f"model-{i + 1:05d}-of-{args.files:05d}.safetensors": os.urandom(file_size)
+        for i in range(args.files)
+    }
+    files = [{"rfilename": name, "size": len(data)} for name, data in content.items()]
+    total_mb = file_size * args.files / 1024**2
+
+    with StubHub(num_models=0, latency=0, bandwidth=args.bandwidth_mb * 1024**2) as hub:
+        hub.add_repo(repo_id, content)
+        print(f"{args.files} files x {args.file_mb} MB, {args.bandwidth_mb} MB/s per connection")
+        print(f"{'workers':>8} {'seconds':>9} {'MB/s':>8}")
+        for workers in args.workers:
+            elapsed = run(hub, repo_id, files, workers)
+            print(f"{workers:>8} {elapsed:>9.2f} {total_mb / elapsed:>8.1f}")
+
+        hub.drop_after = file_size // 2
+        requests_before = hub.requests_count
+        elapsed = run(hub, repo_id, files, args.workers[-1])
+        print(
+            f"interrupted at 50%: {elapsed:.2f}s, "
+            f"{hub.requests_count - requests_before} requests for {args.files} files"
+        )
+
+
+if __name__ == "__main__":
+    main()
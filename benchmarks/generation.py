@@ -0,0 +1,234 @@
+"""Latency, throughput and memory of `TextGenerationModel.generate` and
+`ConversationalModel.generate` over a matrix of cases, written as JSON so
+that runs of two commits can be compared with `benchmarks.compare_results`.
+
+Every case runs `batch_size` concurrent requests of `prompt_tokens` prompt
+tokens and up to `max_new_tokens` new tokens (end of sequence is suppressed
+with `min_new_tokens`), `--repeats` times. Reported per case:
+
+- `ttft_ms`: time to the first new token (stream mode only).
+- `itl_ms`: inter-token latency, the gap between streamed chunks spread
+  over the tokens they carry (stream mode only).
+- `latency_ms`: time to the complete response.
+- `tokens_per_second`: new tokens of all requests over the wall time, as
+  counted by the generation metrics of each request.
+- `peak_rss_mb`: peak resident memory during the case, weights included.
+
+Each task and dtype runs in a fresh process with its default batching.
+
+Usage: python -m benchmarks.generation [--size small] [--output generation.json]
+       [--tasks text-generation conversational] [--modes stream non-stream]
+       [--prompt-tokens 32 256] [--max-new-tokens 32 128] [--batch-sizes 1 4]
+       [--dtypes fp32 bf16] [--repeats 3]
+"""
+
+import argparse
+import datetime
+import itertools
+import json
+import multiprocessing
+import os
+import platform
+import subprocess
+import threading
+import time
+
+import psutil
+import torch
+import transformers
+
+from src.domain.models.text.conversational import ConversationalModel
+from src.domain.models.text.text_generation import TextGenerationModel
+
+from .memory import peak_rss, reset_peak_rss
+from .tiny_models import CORPUS, tiny_models_dir
+
+TASKS = {
+    "text-generation": TextGenerationModel,
+    "conversational": ConversationalModel,
+}
+KEY_FIELDS = ("task", "mode", "dtype", "prompt_tokens", "max_new_tokens", "batch_size")
+
+
+def percentiles(values):
+    """p50/p90/p99 of `values` (seconds) in milliseconds."""
+    if not values:
+        return None
+    values = sorted(values)
+    return {
+        f"p{p}": round(values[min(len(values) - 1, len(values) * p // 100)] * 1000, 3)
+        for p in (50, 90, 99)
+    }
+
+
+def make_prompt(tokenizer, length, seed):
+    """Text of about `length` tokens, different for every `seed` so that no
+    request hits a cache filled by another."""
+    ids = tokenizer.encode(" ".join(CORPUS), add_special_tokens=False)
+    offset = seed * 7 % len(ids)
+    ids = (ids * (2 + length // len(ids)))[offset : offset + length]
+    return tokenizer.decode(ids)
+
+
+def request(model, task, prompt, stream, max_new_tokens):
+    inputs = prompt if task == "text-generation" else [{"role": "user", "content": prompt}]
+    metrics = []
+    kwargs = dict(
+        max_new_tokens=max_new_tokens,
+        min_new_tokens=max_new_tokens,
+        do_sample=False,
+        on_metrics=metrics.append,
+    )
+    start = time.perf_counter()
+    if not stream:
+        model.generate(inputs, **kwargs)
+        latency = time.perf_counter() - start
+        return {"latency": latency, "ttft": None, "itl": [], "new_tokens": metrics[0].new_tokens}
+
+    # text generation streams the prompt back before the new text
+    skip = len(prompt) if task == "text-generation" else 0
+    received = 0
+    ttft = None
+    last = None
+    itl = []
+    for chunk in model.generate(inputs, stream=True, **kwargs):
+        now = time.perf_counter()
+        new_text = chunk[max(0, skip - received) :]
+        received += len(chunk)
+        if not new_text:
+            continue
+        if ttft is None:
+            ttft = now - start
+        else:
+            tokens = max(1, len(model.tokenizer.encode(new_text, add_special_tokens=False)))
+            itl.extend([(now - last) / tokens] * tokens)
+        last = now
+    latency = time.perf_counter() - start
+    return {"latency": latency, "ttft": ttft, "itl": itl, "new_tokens": metrics[0].new_tokens}
+
+
+def run_case(model, task, mode, prompt_tokens, max_new_tokens, batch_size, repeats, baseline):
+    requests = []
+    elapsed = 0.0
+    reset_peak_rss()
+    for repeat in range(repeats):
+        results = [None] * batch_size
+
+        def worker(i):
+            prompt = make_prompt(model.tokenizer, prompt_tokens, seed=repeat * batch_size + i)
+            results[i] = request(model, task, prompt, mode == "stream", max_new_tokens)
+
+        threads = [threading.Thread(target=worker, args=(i,)) for i in range(batch_size)]
+        start = time.perf_counter()
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        elapsed += time.perf_counter() - start
+        requests.extend(results)
+
+    return {
+        "ttft_ms": percentiles([r["ttft"] for r in requests if r["ttft"] is not None]),
+        "itl_ms": percentiles([gap for r in requests for gap in r["itl"]]),
+        "latency_ms": percentiles([r["latency"] for r in requests]),
+        "tokens_per_second": round(sum(r["new_tokens"] for r in requests) / elapsed, 2),
+        "peak_rss_mb": round((peak_rss() - baseline) / 1024**2, 1),
+    }
+
+
+def measure(task, dtype, cases, repeats):
+    baseline = psutil.Process().memory_info().rss
+    model = TASKS[task]("bench", load_mode=dtype)
+    model.load()
+    model.warmup()
+    results = []
+    for mode, prompt_tokens, max_new_tokens, batch_size in cases:
+        result = dict(
+            zip(KEY_FIELDS, (task, mode, dtype, prompt_tokens, max_new_tokens, batch_size))
+        )
+        # compiles and allocates whatever the case shape needs first
+        run_case(model, task, mode, prompt_tokens, 2, batch_size, 1, baseline)
+        result.update(
+            run_case(
+                model, task, mode, prompt_tokens, max_new_tokens, batch_size, repeats, baseline
+            )
+        )
+        results.append(result)
+        print(format_result(result), flush=True)
+    model.unload()
+    return results
+
+
+def format_result(result):
+    def p50(metric):
+        return f"{result[metric]['p50']:>9.1f}" if result[metric] else f"{'-':>9}"
+
+    return (
+        f"{result['task']:>15} {result['mode']:>10} {result['dtype']:>5}"
+        f" {result['prompt_tokens']:>6} {result['max_new_tokens']:>7} {result['batch_size']:>5}"
+        f" {p50('ttft_ms')} {p50('itl_ms')} {result['tokens_per_second']:>9.1f}"
+        f" {result['peak_rss_mb']:>8.0f}"
+    )
+
+
+def git_commit():
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "HEAD"],
+            cwd=os.path.dirname(os.path.abspath(__file__)),
+            capture_output=True,
+            text=True,
+            check=True,
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--size", default="small")
+    parser.add_argument("--output", default="generation.json")
+    parser.add_argument("--tasks", nargs="+", default=list(TASKS))
+    parser.add_argument("--modes", nargs="+", default=["stream", "non-stream"])
+    parser.add_argument("--prompt-tokens", type=int, nargs="+", default=[32, 256])
+    parser.add_argument("--max-new-tokens", type=int, nargs="+", default=[32, 128])
+    parser.add_argument("--batch-sizes", type=int, nargs="+", default=[1, 4])
+    parser.add_argument("--dtypes", nargs="+", default=["fp32", "bf16"])
+    parser.add_argument("--repeats", type=int, default=3)
+    args = parser.parse_args()
+
+    output = os.path.abspath(args.output)
+    cases = list(
+        itertools.product(args.modes, args.prompt_tokens, args.max_new_tokens, args.batch_sizes)
+    )
+    metadata = {
+        "commit": git_commit(),
+        "date": datetime.datetime.now(datetime.timezone.utc).isoformat(timespec="seconds"),
+        "size": args.size,
+        "repeats": args.repeats,
+        "torch": torch.__version__,
+        "transformers": transformers.__version__,
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "cpus": os.cpu_count(),
+    }
+
+    context = multiprocessing.get_context("spawn")
+    models = {(task, "bench"): {"size": args.size} for task in args.tasks}
+    results = []
+    with tiny_models_dir(models):
+        print(
+            f"{'task':>15} {'mode':>10} {'dtype':>5} {'prompt':>6} {'new':>7} {'batch':>5}"
+            f" {'TTFT ms':>9} {'ITL ms':>9} {'tokens/s':>9} {'RSS MB':>8}"
+        )
+        for task, dtype in itertools.product(args.tasks, args.dtypes):
+            with context.Pool(1) as pool:
+                results.extend(pool.apply(measure, (task, dtype, cases, args.repeats)))
+
+    with open(output, "w") as f:
+        json.dump({"metadata": metadata, "results": results}, f, indent=2)
+    print(f"Results written to {output}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,105 @@
+"""Load time, resident memory, greedy tokens/s and output drift of a
+TextGenerationModel for each CPU load mode.
+
+Every mode runs in a fresh process so its RSS is not mixed with the
+others. Drift is measured against fp32: the share of generated tokens
+equal to the fp32 ones up to the first divergence, and the largest
+difference of the next-token probabilities after each prompt.
+
+Usage: python -m benchmarks.load_modes [--size large] [--modes fp32 bf16 int8 int4]
+"""
+
+import argparse
+import multiprocessing
+import os
+import time
+
+import psutil
+import torch
+
+from src.domain.models.constants import MODELS_DIR
+from src.domain.models.text.text_generation import TextGenerationModel
+
+from .tiny_models import CORPUS, sharpen_head, tiny_models_dir
+
+
+def measure(mode, max_new_tokens):
+    process = psutil.Process()
+    rss_before = process.memory_info().rss
+    start = time.perf_counter()
+    model = TextGenerationModel("bench", batching=False, load_mode=mode)
+    model.load()
+    load_time = time.perf_counter() - start
+
+    generated, probabilities = [], []
+    elapsed = 0.0
+    with torch.no_grad():
+        for prompt in CORPUS:
+            inputs = model.tokenizer(prompt, return_tensors="pt")
+            logits = model.model(**inputs).logits[0, -1].float()
+            probabilities.append(torch.softmax(logits, dim=-1))
+            start = time.perf_counter()
+            ids = model.model.generate(
+                **inputs,
+                max_new_tokens=max_new_tokens,
+                min_new_tokens=max_new_tokens,
+                do_sample=False,
+                pad_token_id=model.tokenizer.pad_token_id,
+            )
+            elapsed += time.perf_counter() - start
+            generated.append(ids[0, inputs["input_ids"].shape[1] :].tolist())
+    return {
+        "load_time": load_time,
+        # after generating, so lazily mapped weights have been paged in
+        "rss": process.memory_info().rss - rss_before,
+        "footprint": model.memory_footprint(),
+        "tokens_per_second": sum(map(len, generated)) / elapsed,
+        "generated": generated,
+        "probabilities": torch.stack(probabilities),
+    }
+
+
+def agreement(reference, generated):
+    matching = 0
+    for expected, actual in zip(reference, generated):
+        for a, b in zip(expected, actual):
+            if a != b:
+                break
+            matching += 1
+    return matching / sum(map(len, reference))
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--size", default="large")
+    parser.add_argument("--modes", nargs="+", default=["fp32", "bf16", "int8", "int4"])
+    parser.add_argument("--max-new-tokens", type=int, default=32)
+    args = parser.parse_args()
+
+    context = multiprocessing.get_context("spawn")
+    with tiny_models_dir({("text-generation", "bench"): {"size": args.size}}):
+        sharpen_head(os.path.join(MODELS_DIR, "text-generation", "bench"))
+        print(
+            f"{'mode':>5} {'load s':>7} {'RSS MB':>7} {'weights MB':>10}"
+            f" {'tokens/s':>9} {'agree':>6} {'max dP':>7}"
+        )
+        reference = None
+        for mode in ["fp32"] + [mode for mode in args.modes if mode != "fp32"]:
+            with context.Pool(1) as pool:
+                try:
+                    result = pool.apply(measure, (mode, args.max_new_tokens))
+                except Exception as e:
+                    print(f"{mode:>5} unavailable: {e}")
+                    continue
+            if reference is None:
+                reference = result
+            drift = (result["probabilities"] - reference["probabilities"]).abs().max().item()
+            print(
+                f"{mode:>5} {result['load_time']:>7.2f} {result['rss'] / 1024**2:>7.0f}"
+                f" {result['footprint'] / 1024**2:>10.0f} {result['tokens_per_second']:>9.1f}"
+                f" {agreement(reference['generated'], result['generated']):>6.0%} {drift:>7.4f}"
+            )
+
+
+if __name__ == "__main__":
+    main()
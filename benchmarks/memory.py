@@ -0,0 +1,19 @@
+import os
+
+import psutil
+
+
+def peak_rss() -> int:
+    """Peak resident memory of the process since the last `reset_peak_rss`."""
+    with open("/proc/self/status") as f:
+        for line in f:
+            if line.startswith("VmHWM:"):
+                return int(line.split()[1]) * 1024
+    return psutil.Process().memory_info().rss
+
+
+def reset_peak_rss():
+    # Linux only, elsewhere the peak includes the imports
+    if os.path.exists("/proc/self/clear_refs"):
+        with open("/proc/self/clear_refs", "w") as f:
+            f.write("5")
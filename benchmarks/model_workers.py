@@ -0,0 +1,88 @@
+"""Throughput of a burst of concurrent text generations with the model loaded
+in the app process vs. run by 1, 2, ... worker processes, each pinned to its
+own share of the cores (see `RemoteModel`).
+
+Also reports the memory of each setup: the footprint of the weights and the
+private memory (USS) of every worker, which stays small when the workers
+share the mapped weight files.
+
+Usage: python -m benchmarks.model_workers [--requests 16] [--workers 1 2 4]
+"""
+
+import argparse
+import os
+import threading
+import time
+
+from src.domain.models.remote import RemoteModel, core_sets
+from src.domain.models.text.text_generation import TextGenerationModel
+
+from .generation import percentiles
+from .tiny_models import CORPUS, tiny_models_dir
+
+
+def burst(model, requests, max_new_tokens):
+    latencies = []
+
+    def request(i):
+        start = time.perf_counter()
+        model.generate(
+            CORPUS[i % len(CORPUS)],
+            max_new_tokens=max_new_tokens,
+            min_new_tokens=max_new_tokens,
+            do_sample=False,
+        )
+        latencies.append(time.perf_counter() - start)
+
+    threads = [threading.Thread(target=request, args=(i,)) for i in range(requests)]
+    start = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return time.perf_counter() - start, latencies
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--requests", type=int, default=16)
+    parser.add_argument("--workers", type=int, nargs="+", default=[1, 2, 4])
+    parser.add_argument("--max-new-tokens", type=int, default=32)
+    parser.add_argument("--size", default="small")
+    args = parser.parse_args()
+
+    with tiny_models_dir({("text-generation", "bench"): {"size": args.size}}):
+        cores = len(os.sched_getaffinity(0)) if hasattr(os, "sched_getaffinity") else os.cpu_count()
+        print(f"{args.requests} concurrent requests of {args.max_new_tokens} tokens, {cores} cores")
+        print(
+            f"{'setup':>12} {'cores each':>10} {'seconds':>8} {'p50 ms':>7} {'p90 ms':>7}"
+            f" {'tokens/s':>9} {'weights MB':>10} {'USS/worker MB':>13}"
+        )
+        setups = [("in-process", None)] + [(f"{n} workers", n) for n in args.workers]
+        for name, workers in setups:
+            if workers is None:
+                model = TextGenerationModel("bench")
+                cores_each, private = cores, "-"
+            else:
+                model = RemoteModel(TextGenerationModel, "bench", workers=workers)
+                cores_each = min(len(core_set) for core_set in core_sets(workers))
+            model.load()
+            model.warmup()
+            elapsed, latencies = burst(model, args.requests, args.max_new_tokens)
+            p = percentiles(latencies)
+            tokens_per_second = args.requests * args.max_new_tokens / elapsed
+            if workers is None:
+                weights = model.memory_footprint()
+            else:
+                stats = model.worker_stats()
+                weights = stats[0]["footprint"]
+                private = " ".join(str(worker["private_memory"] >> 20) for worker in stats)
+            print(
+                f"{name:>12} {cores_each:>10} {elapsed:>8.2f} {p['p50']:>7.0f} {p['p90']:>7.0f}"
+                f" {tokens_per_second:>9.1f} {weights >> 20:>10} {private:>13}"
+            )
+            model.unload()
+
+
+if __name__ == "__main__":
+    main()
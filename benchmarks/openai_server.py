@@ -0,0 +1,160 @@
+"""Load test of the OpenAI-compatible server: concurrent clients on
+keep-alive connections send chat completion requests, streamed or not, to
+a server started in the same process on a tiny model.
+
+Reports requests/s, latency and (when streaming) time to first token
+percentiles. Requests answered 429 because the model was busy are retried
+after a random part of their Retry-After (at most 1 s) and counted; the
+latency of a request includes its retries.
+
+Usage: python -m benchmarks.openai_server [--clients 32] [--requests 256] [--stream]
+"""
+
+import argparse
+import asyncio
+import json
+import random
+import time
+
+from src.api.openai_server import OpenAIServer
+
+from .generation import percentiles
+from .tiny_models import CORPUS, tiny_models_dir
+
+
+async def read_response(reader: asyncio.StreamReader, on_chunk=None):
+    """Status, headers and body of one response, chunked or not. `on_chunk`
+    is called with the index of every chunk of a chunked response."""
+    status = int((await reader.readline()).split()[1])
+    headers = {}
+    while True:
+        line = await reader.readline()
+        if line in (b"\r\n", b""):
+            break
+        name, _, value = line.decode().partition(":")
+        headers[name.strip().lower()] = value.strip()
+    if headers.get("transfer-encoding") == "chunked":
+        body = b""
+        chunks = 0
+        while True:
+            size = int((await reader.readline()).strip(), 16)
+            if size == 0:
+                await reader.readline()
+                break
+            body += await reader.readexactly(size)
+            await reader.readline()
+            if on_chunk is not None:
+                on_chunk(chunks)
+            chunks += 1
+        return status, headers, body
+    return status, headers, await reader.readexactly(int(headers.get("content-length", 0)))
+
+
+def completion_tokens(body: bytes, stream: bool) -> int:
+    if not stream:
+        return json.loads(body)["usage"]["completion_tokens"]
+    for line in body.decode().splitlines():
+        if line.startswith("data: {"):
+            usage = json.loads(line[len("data: ") :]).get("usage")
+            if usage:
+                return usage["completion_tokens"]
+    return 0
+
+
+async def client(port, requests, stream, max_tokens, results):
+    reader, writer = await asyncio.open_connection("127.0.0.1", port)
+    try:
+        while True:
+            try:
+                i = next(requests)
+            except StopIteration:
+                return
+            payload = json.dumps(
+                {
+                    "model": "bench",
+                    "messages": [{"role": "user", "content": CORPUS[i % len(CORPUS)]}],
+                    "max_tokens": max_tokens,
+                    "temperature": 0,
+                    "stream": stream,
+                    "stream_options": {"include_usage": True},
+                }
+            ).encode()
+            start = time.perf_counter()
+            first_token = []
+
+            def on_chunk(index):
+                # the first event only holds the role of the message
+                if index == 1:
+                    first_token.append(time.perf_counter() - start)
+
+            while True:
+                writer.write(
+                    b"POST /v1/chat/completions HTTP/1.1\r\nHost: localhost\r\n"
+                    b"Content-Type: application/json\r\n"
+                    + f"Content-Length: {len(payload)}\r\n\r\n".encode()
+                    + payload
+                )
+                await writer.drain()
+                status, headers, body = await read_response(reader, on_chunk)
+                if status != 429:
+                    break
+                # the model is busy, retry like a well-behaved client
+                results["rejected"] += 1
+                await asyncio.sleep(min(float(headers.get("retry-after", 1)), 1.0) * random.random())
+            if status == 200:
+                results["latencies"].append(time.perf_counter() - start)
+                results["ttft"].extend(first_token)
+                results["tokens"] += completion_tokens(body, stream)
+            else:
+                results["errors"] += 1
+    finally:
+        writer.close()
+
+
+async def run(args):
+    server = OpenAIServer(port=0, use_response_cache=False)
+    port = await server.start()
+    serving = asyncio.ensure_future(server.serve())
+
+    # load and warm up the model
+    warmup = {"latencies": [], "ttft": [], "tokens": 0, "rejected": 0, "errors": 0}
+    await client(port, iter(range(1)), False, 2, warmup)
+
+    results = {"latencies": [], "ttft": [], "tokens": 0, "rejected": 0, "errors": 0}
+    requests = iter(range(args.requests))
+    start = time.perf_counter()
+    await asyncio.gather(
+        *(client(port, requests, args.stream, args.max_tokens, results) for _ in range(args.clients))
+    )
+    elapsed = time.perf_counter() - start
+    server.stop()
+    await serving
+
+    mode = "streamed" if args.stream else "non-streamed"
+    print(f"{args.requests} {mode} chat requests of up to {args.max_tokens} tokens, {args.clients} clients")
+    served = len(results["latencies"])
+    print(f"served {served}, 429 answers {results['rejected']}, errors {results['errors']}")
+    print(f"requests/s {served / elapsed:.1f}, tokens/s {results['tokens'] / elapsed:.1f}")
+    latency = percentiles(results["latencies"])
+    if latency:
+        print(f"latency ms p50 {latency['p50']:.0f} p90 {latency['p90']:.0f} p99 {latency['p99']:.0f}")
+    ttft = percentiles(results["ttft"])
+    if ttft:
+        print(f"first token ms p50 {ttft['p50']:.0f} p90 {ttft['p90']:.0f} p99 {ttft['p99']:.0f}")
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--clients", type=int, default=32)
+    parser.add_argument("--requests", type=int, default=256)
+    parser.add_argument("--max-tokens", type=int, default=16)
+    parser.add_argument("--stream", action="store_true")
+    parser.add_argument("--size", default="small")
+    args = parser.parse_args()
+
+    with tiny_models_dir({("conversational", "bench"): {"size": args.size}}):
+        asyncio.run(run(args))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,56 @@
+"""Wall-clock time of `HfApiService.search_models` against a local stub Hub,
+for several concurrency limits and for cold vs. warm on-disk cache.
+
+Usage: python -m benchmarks.search_models [--models 50] [--latency 0.05]
+"""
+
+import argparse
+import os
+import tempfile
+import time
+
+from src.use_cases.hf_api_service import HfApiService
+from src.use_cases.sqlite_cache import SqliteCache
+
+from .stub_hub import StubHub
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--models", type=int, default=50)
+    parser.add_argument("--latency", type=float, default=0.05)
+    parser.add_argument("--workers", type=int, nargs="+", default=[1, 2, 4, 8, 16, 32])
+    args = parser.parse_args()
+
+    with StubHub(num_models=args.models, latency=args.latency) as hub:
+        print(f"{args.models} models, {args.latency * 1000:.0f} ms per request")
+        print(f"{'workers':>8} {'seconds':>9} {'speedup':>8}")
+        baseline = None
+        for workers in args.workers:
+            service = HfApiService(
+                endpoint=hub.endpoint, max_workers=workers, use_cache=False
+            )
+            start = time.perf_counter()
+            models = service.search_models(
+                "", "", "<1B", ">500B", "conversational", "trendingScore", args.models
+            )
+            elapsed = time.perf_counter() - start
+            assert [m["modelId"] for m in models] == list(hub.repos)
+            baseline = baseline or elapsed
+            print(f"{workers:>8} {elapsed:>9.3f} {baseline / elapsed:>7.1f}x")
+
+        with tempfile.TemporaryDirectory() as tmp:
+            service = HfApiService(endpoint=hub.endpoint, max_workers=args.workers[-1], use_cache=False)
+            service.cache = SqliteCache(os.path.join(tmp, "hub.sqlite"))
+            print(f"\n{'run':>8} {'ms':>9}")
+            for run in ("cold", "warm", "warm"):
+                start = time.perf_counter()
+                service.search_models(
+                    "", "", "<1B", ">500B", "conversational", "trendingScore", args.models
+                )
+                print(f"{run:>8} {(time.perf_counter() - start) * 1000:>9.2f}")
+            print(service.get_cache_stats())
+
+
+if __name__ == "__main__":
+    main()
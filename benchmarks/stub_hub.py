@@ -0,0 +1,190 @@
+import hashlib
+import json
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import unquote, urlparse
+
+
+class StubHub:
+    """Minimal local stand-in for the Hugging Face Hub HTTP API.
+
+    Every request sleeps `latency` seconds before answering, which is what
+    makes sequential vs concurrent clients distinguishable. File downloads
+    (`/{repo_id}/resolve/{revision}/{filename}`) honour single `Range`
+    headers, are throttled to `bandwidth` bytes/s per connection and, when
+    `drop_after` is set, the first request of every file is cut after
+    that many bytes to simulate an interrupted transfer. Files carry their
+    sha256 as ETag, like LFS files on the Hub; `ranges=False` turns the
+    server into a single-stream one.
+    """
+
+    def __init__(
+        self, num_models=20, latency=0.05, bandwidth=None, drop_after=None, ranges=True
+    ):
+        self.latency = latency
+        self.bandwidth = bandwidth
+        self.drop_after = drop_after
+        self.ranges = ranges
+        self._dropped = set()
+        self._etags = {}
+        self.repos = {
+            f"stub/model-{i}": {
+                "config.json": b"{}",
+                "model.safetensors": b"\0" * 1024 * (i + 1),
+            }
+            for i in range(num_models)
+        }
+        self.requests_count = 0
+        self._lock = threading.Lock()
+        self._server = None
+        self._thread = None
+
+    @property
+    def endpoint(self):
+        host, port = self._server.server_address
+        return f"http://{host}:{port}"
+
+    def start(self):
+        hub = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def log_message(self, format, *args):
+                pass
+
+            def do_GET(self):
+                hub._handle(self)
+
+            def do_HEAD(self):
+                hub._handle(self, head_only=True)
+
+        class Server(ThreadingHTTPServer):
+            # the default backlog of 5 drops bursts of concurrent connects
+            request_queue_size = 128
+            daemon_threads = True
+
+        self._server = Server(("127.0.0.1", 0), Handler)
+        self._thread = threading.Thread(target=self._server.serve_forever, daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._server.shutdown()
+        self._server.server_close()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc):
+        self.stop()
+
+    def _send_json(self, handler, payload, status=200):
+        body = json.dumps(payload).encode()
+        handler.send_response(status)
+        handler.send_header("Content-Type", "application/json")
+        handler.send_header("Content-Length", str(len(body)))
+        handler.end_headers()
+        handler.wfile.write(body)
+
+    def _model_summary(self, repo_id):
+        return {
+            "_id": repo_id,
+            "id": repo_id,
+            "modelId": repo_id,
+            "downloads": 1000,
+            "likes": 10,
+            "pipeline_tag": "text-generation",
+            "tags": ["transformers", "conversational"],
+        }
+
+    def _model_info(self, repo_id):
+        files = self.repos[repo_id]
+        total = sum(len(content) for content in files.values()) // 4
+        return {
+            **self._model_summary(repo_id),
+            "siblings": [
+                {"rfilename": name, "size": len(content)}
+                for name, content in files.items()
+            ],
+            "safetensors": {"parameters": {"F32": total}, "total": total},
+        }
+
+    def add_repo(self, repo_id, files):
+        self.repos[repo_id] = files
+
+    def _parse_range(self, header, size):
+        start, _, end = header.replace("bytes=", "").partition("-")
+        start = int(start)
+        end = int(end) if end else size - 1
+        return start, min(end, size - 1)
+
+    def _send_file(self, handler, repo_id, filename, head_only=False):
+        content = self.repos[repo_id][filename]
+        start, end = 0, len(content) - 1
+        range_header = handler.headers.get("Range")
+        if not self.ranges:
+            range_header = None
+        if range_header:
+            start, end = self._parse_range(range_header, len(content))
+            if start >= len(content):
+                handler.send_response(416)
+                handler.send_header("Content-Range", f"bytes */{len(content)}")
+                handler.end_headers()
+                return
+            handler.send_response(206)
+            handler.send_header("Content-Range", f"bytes {start}-{end}/{len(content)}")
+        else:
+            handler.send_response(200)
+        handler.send_header("Content-Length", str(end - start + 1))
+        handler.send_header("ETag", f'"{self._etag(content)}"')
+        if self.ranges:
+            handler.send_header("Accept-Ranges", "bytes")
+        handler.end_headers()
+        if head_only:
+            return
+
+        limit = end + 1
+        key = (repo_id, filename)
+        if self.drop_after and key not in self._dropped:
+            self._dropped.add(key)
+            limit = min(limit, start + self.drop_after)
+
+        block = 64 * 1024
+        position = start
+        while position < limit:
+            chunk = content[position : min(position + block, limit)]
+            handler.wfile.write(chunk)
+            position += len(chunk)
+            if self.bandwidth:
+                time.sleep(len(chunk) / self.bandwidth)
+        if limit <= end:
+            handler.close_connection = True
+
+    def _etag(self, content):
+        if id(content) not in self._etags:
+            self._etags[id(content)] = hashlib.sha256(content).hexdigest()
+        return self._etags[id(content)]
+
+    def _handle(self, handler, head_only=False):
+        with self._lock:
+            self.requests_count += 1
+        time.sleep(self.latency)
+
+        path = urlparse(handler.path).path
+        if path == "/api/models":
+            self._send_json(handler, [self._model_summary(r) for r in self.repos])
+        elif path.startswith("/api/models/"):
+            repo_id = path[len("/api/models/") :]
+            if repo_id in self.repos:
+                self._send_json(handler, self._model_info(repo_id))
+            else:
+                self._send_json(handler, {"error": "Repository not found"}, 404)
+        elif "/resolve/" in path:
+            repo_id, _, rest = path.lstrip("/").partition("/resolve/")
+            filename = unquote(rest.partition("/")[2])
+            if filename in self.repos.get(repo_id, {}):
+                self._send_file(handler, repo_id, filename, head_only)
+            else:
+                self._send_json(handler, {"error": "Entry not found"}, 404)
+        else:
+            self._send_json(handler, {"error": "Not found"}, 404)
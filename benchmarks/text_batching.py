@@ -0,0 +1,53 @@
+"""Aggregate throughput of concurrent TextGenerationModel callers, each
+generating on its own thread vs. grouped by the BatchScheduler.
+
+Usage: python -m benchmarks.text_batching [--clients 8] [--max-new-tokens 32]
+"""
+
+import argparse
+import threading
+import time
+
+from src.domain.models.text.text_generation import TextGenerationModel
+
+from .tiny_models import CORPUS, tiny_models_dir
+
+
+def run(model, clients, max_new_tokens):
+    def client(i):
+        model.generate(
+            CORPUS[i % len(CORPUS)], max_new_tokens=max_new_tokens, do_sample=False
+        )
+
+    threads = [threading.Thread(target=client, args=(i,)) for i in range(clients)]
+    start = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return time.perf_counter() - start
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--clients", type=int, default=8)
+    parser.add_argument("--max-new-tokens", type=int, default=32)
+    parser.add_argument("--size", default="small")
+    args = parser.parse_args()
+
+    with tiny_models_dir({("text-generation", "bench"): {"size": args.size}}):
+        print(f"{args.clients} concurrent clients, {args.max_new_tokens} new tokens each")
+        print(f"{'mode':>10} {'seconds':>9} {'tokens/s':>9}")
+        for batching in (False, True):
+            model = TextGenerationModel("bench", batching=batching)
+            model.load()
+            run(model, 1, 2)  # warmup
+            elapsed = run(model, args.clients, args.max_new_tokens)
+            tokens = args.clients * args.max_new_tokens
+            mode = "batched" if batching else "threads"
+            print(f"{mode:>10} {elapsed:>9.2f} {tokens / elapsed:>9.1f}")
+            model.unload()
+
+
+if __name__ == "__main__":
+    main()
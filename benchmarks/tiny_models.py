@@ -0,0 +1,110 @@
+import contextlib
+import os
+import tempfile
+
+import torch
+from tokenizers import Tokenizer, decoders, models, pre_tokenizers, trainers
+from transformers import LlamaConfig, LlamaForCausalLM, PreTrainedTokenizerFast
+
+from src.domain.models.constants import MODELS_DIR
+
+CHATML_TEMPLATE = (
+    "{% for message in messages %}"
+    "<|im_start|>{{ message['role'] }}\n{{ message['content'] }}<|im_end|>\n"
+    "{% endfor %}"
+    "{% if add_generation_prompt %}<|im_start|>assistant\n{% endif %}"
+)
+
+CORPUS = [
+    "You are a helpful assistant.",
+    "The quick brown fox jumps over the lazy dog.",
+    "Hello world, how are you today? I am fine, thank you.",
+    "def main():\n    print('hello')\n    return 0\n",
+    "Ünïcødé, 日本語のテキスト and emojis 🙂🚀 should round-trip.",
+]
+
+SIZES = {
+    "tiny": dict(hidden_size=64, intermediate_size=128, num_hidden_layers=2),
+    "small": dict(hidden_size=256, intermediate_size=688, num_hidden_layers=4),
+    "medium": dict(hidden_size=512, intermediate_size=1376, num_hidden_layers=8),
+    "large": dict(hidden_size=1024, intermediate_size=2816, num_hidden_layers=16),
+}
+
+
+def build_tokenizer(vocab_size=2000) -> PreTrainedTokenizerFast:
+    tokenizer = Tokenizer(models.BPE())
+    tokenizer.pre_tokenizer = pre_tokenizers.ByteLevel(add_prefix_space=False)
+    tokenizer.decoder = decoders.ByteLevel()
+    trainer = trainers.BpeTrainer(
+        vocab_size=vocab_size,
+        special_tokens=["<|endoftext|>", "<|im_start|>", "<|im_end|>"],
+        initial_alphabet=pre_tokenizers.ByteLevel.alphabet(),
+    )
+    tokenizer.train_from_iterator(CORPUS * 20, trainer)
+    fast_tokenizer = PreTrainedTokenizerFast(
+        tokenizer_object=tokenizer,
+        bos_token="<|endoftext|>",
+        eos_token="<|im_end|>",
+        pad_token="<|endoftext|>",
+        model_input_names=["input_ids", "attention_mask"],
+    )
+    fast_tokenizer.chat_template = CHATML_TEMPLATE
+    return fast_tokenizer
+
+
+def build_tiny_model(path: str, size="tiny", seed=0, dtype=torch.float32, **overrides):
+    """Save a randomly initialized Llama-style causal LM with a ChatML
+    tokenizer to `path`, no network needed."""
+    tokenizer = build_tokenizer()
+    config = LlamaConfig(
+        vocab_size=len(tokenizer),
+        num_attention_heads=4,
+        num_key_value_heads=2,
+        max_position_embeddings=4096,
+        bos_token_id=tokenizer.bos_token_id,
+        eos_token_id=tokenizer.eos_token_id,
+        pad_token_id=tokenizer.pad_token_id,
+        **{**SIZES[size], **overrides},
+    )
+    torch.manual_seed(seed)
+    model = LlamaForCausalLM(config).to(dtype)
+    tokenizer.save_pretrained(path)
+    model.save_pretrained(path)
+    return path
+
+
+@contextlib.contextmanager
+def tiny_models_dir(models):
+    """Build `models` (`{(tag, id): build_tiny_model kwargs}`) in a temporary
+    directory laid out like `MODELS_DIR` and make it the working directory."""
+    cwd = os.getcwd()
+    with tempfile.TemporaryDirectory() as tmp:
+        os.chdir(tmp)
+        try:
+            for (tag, id), kwargs in models.items():
+                build_tiny_model(os.path.join(MODELS_DIR, tag, id), **kwargs)
+            yield tmp
+        finally:
+            os.chdir(cwd)
+
+
+def build_draft_model(target_path: str, path: str, num_hidden_layers=1):
+    """Save the first `num_hidden_layers` layers of the model at
+    `target_path` (plus its embeddings, norm and head) as a draft model
+    sharing its tokenizer."""
+    model = LlamaForCausalLM.from_pretrained(target_path)
+    model.model.layers = model.model.layers[:num_hidden_layers]
+    model.config.num_hidden_layers = num_hidden_layers
+    model.config.layer_types = None
+    PreTrainedTokenizerFast.from_pretrained(target_path).save_pretrained(path)
+    model.save_pretrained(path)
+    return path
+
+
+def sharpen_head(path: str, factor=8.0):
+    """Scale the output head of the model at `path` so its next-token
+    distributions are as peaked as a trained model's instead of near uniform."""
+    model = LlamaForCausalLM.from_pretrained(path)
+    with torch.no_grad():
+        model.lm_head.weight.mul_(factor)
+    model.save_pretrained(path)
@@ -0,0 +1,93 @@
+"""Latency of a burst of concurrent requests on a model without a batching
+decode loop, by number of generations allowed to run at once. The burst
+size is what the app did before generations went through a bounded pool:
+one thread per request, all competing for the cores.
+
+Then the latency of a larger burst with a short and an unbounded queue:
+requests beyond the short queue are rejected instead of waiting.
+
+Usage: python -m benchmarks.worker_pool [--requests 16] [--workers 1 2 4 16]
+"""
+
+import argparse
+import threading
+import time
+
+from src.domain.models.text.text_generation import TextGenerationModel
+from src.domain.models.text.worker_pool import GenerationPool, QueueFullError
+
+from .generation import percentiles
+from .tiny_models import CORPUS, tiny_models_dir
+
+
+def burst(model, requests, max_new_tokens):
+    latencies = []
+    rejected = [0]
+
+    def request(i):
+        start = time.perf_counter()
+        try:
+            model.generate(
+                CORPUS[i % len(CORPUS)],
+                max_new_tokens=max_new_tokens,
+                min_new_tokens=max_new_tokens,
+                do_sample=False,
+            )
+        except QueueFullError:
+            rejected[0] += 1
+            return
+        latencies.append(time.perf_counter() - start)
+
+    threads = [threading.Thread(target=request, args=(i,)) for i in range(requests)]
+    start = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return time.perf_counter() - start, latencies, rejected[0]
+
+
+def use_pool(model, workers, max_queue):
+    model.pool.close()
+    model.pool = GenerationPool(workers, max_queue=max_queue)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--requests", type=int, default=16)
+    parser.add_argument("--workers", type=int, nargs="+", default=[1, 2, 4, 16])
+    parser.add_argument("--max-new-tokens", type=int, default=32)
+    parser.add_argument("--size", default="small")
+    args = parser.parse_args()
+
+    with tiny_models_dir({("text-generation", "bench"): {"size": args.size}}):
+        model = TextGenerationModel("bench", batching=False)
+        model.load()
+        model.warmup()
+
+        print(f"{args.requests} concurrent requests of {args.max_new_tokens} tokens")
+        print(f"{'workers':>8} {'seconds':>8} {'p50 ms':>7} {'p90 ms':>7} {'tokens/s':>9}")
+        for workers in args.workers:
+            use_pool(model, workers, max_queue=args.requests)
+            elapsed, latencies, _ = burst(model, args.requests, args.max_new_tokens)
+            p = percentiles(latencies)
+            tokens_per_second = len(latencies) * args.max_new_tokens / elapsed
+            print(
+                f"{workers:>8} {elapsed:>8.2f} {p['p50']:>7.0f} {p['p90']:>7.0f}"
+                f" {tokens_per_second:>9.1f}"
+            )
+
+        requests = 4 * args.requests
+        print(f"\n{requests} concurrent requests, 1 worker")
+        for max_queue in (4, requests):
+            use_pool(model, 1, max_queue)
+            _, latencies, rejected = burst(model, requests, args.max_new_tokens)
+            print(
+                f"queue of {max_queue:>3}: {len(latencies):>3} served,"
+                f" max latency {max(latencies):.2f} s, {rejected} rejected"
+            )
+        model.unload()
+
+
+if __name__ == "__main__":
+    main()
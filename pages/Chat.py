@@ -1,7 +1,9 @@
 import re
+import time
 import streamlit as st
 import json
 
+from src.domain.models.text.worker_pool import QueueFullError
 from src.use_cases.chat_service import ChatService
 
 if "chat_service" not in st.session_state:
@@ -24,13 +26,59 @@ else:
     with st.sidebar:
         st.title("💬 Chat")
 
-        @st.cache_resource(show_spinner=False)
-        def set_assistant_cached(id: str):
-            return chat_service.set_assistant(id)
+        selected_model_id = st.selectbox(label="Model:", options=models)
+        # models are shared across sessions by the model registry and load in
+        # the background, the page is rerun once the model is ready
+        load_status, load_error = chat_service.request_assistant(selected_model_id)
+        assistant_ready = load_status == "ready"
+        if load_status == "failed":
+            st.error(f"Failed to load {selected_model_id}: {load_error}")
+            if st.button("Retry", icon="🔄"):
+                chat_service.request_assistant(selected_model_id, retry=True)
+                st.rerun()
+        elif not assistant_ready:
 
-        with st.spinner("Loading model..."):
-            selected_model_id = st.selectbox(label="Model:", options=models)
-            set_assistant_cached(selected_model_id)
+            @st.fragment(run_every=0.5)
+            def show_load_status():
+                status, _ = chat_service.request_assistant(selected_model_id)
+                if status in ("ready", "failed"):
+                    st.rerun()
+                st.info(f"⏳ {selected_model_id}: {status}...")
+
+            show_load_status()
+
+        if assistant_ready:
+            chat_service.preload_next(models)
+
+            # the draft is attached to the shared model, start from its current pairing
+            draft_options = ["None"] + chat_service.get_draft_options()
+            draft_id = chat_service.assistant.draft_id
+            selected_draft_id = st.selectbox(
+                label="Draft model:",
+                options=draft_options,
+                index=draft_options.index(draft_id) if draft_id in draft_options else 0,
+                help="Smaller model sharing the tokenizer that proposes tokens for assisted generation.",
+            )
+            try:
+                with st.spinner("Loading draft model..."):
+                    chat_service.set_draft(None if selected_draft_id == "None" else selected_draft_id)
+            except ValueError as e:
+                st.error(str(e))
+            assisted_stats = chat_service.assistant.assisted_stats
+            if chat_service.assistant.draft_id and assisted_stats.generations:
+                st.caption(
+                    f"🎯 Draft acceptance: {assisted_stats.acceptance_rate:.0%}"
+                    f" · {assisted_stats.tokens_per_pass:.2f} tokens/pass"
+                    f" · {assisted_stats.tokens_per_second:.1f} tokens/s"
+                )
+            # the page reruns after every reply, so the last one is shown here
+            metrics = chat_service.last_metrics
+            if metrics is not None:
+                st.caption(
+                    f"⏱️ {metrics.prompt_tokens} prompt + {metrics.new_tokens} new tokens"
+                    f" · TTFT {metrics.ttft or 0:.2f} s · {metrics.tokens_per_second:.1f} tokens/s"
+                    f" · queued {metrics.queue_wait or 0:.2f} s · {metrics.memory_delta / 1024**2:+.0f} MB RSS"
+                )
 
         chat_service.set_system_message(
             st.text_input(
@@ -121,6 +169,30 @@ else:
             "repetition_penalty", min_value=1.0, max_value=2.0, value=1.0, step=0.1
         )
 
+        st.divider()
+        st.title("🪟 Context Window")
+
+        context_strategies = {
+            "Sliding window": "sliding_window",
+            "Keep system + last messages": "keep_system_last_n",
+            "Drop middle": "drop_middle",
+        }
+        context_strategy = context_strategies.get(
+            st.selectbox(label="When too long:", options=context_strategies.keys())
+        )
+        context_max_tokens = st.number_input(
+            "Token budget (0 = model context length)",
+            min_value=0,
+            max_value=131072,
+            value=0,
+            step=512,
+        )
+        chat_service.set_context_budget(context_strategy, context_max_tokens or None)
+        if chat_service.trimmed_tokens:
+            st.caption(
+                f"✂️ {chat_service.trimmed_tokens} tokens of history left out of the last prompt"
+            )
+
     def reasoning_expander(placeholder, reasoning_text, expanded=False):
         if reasoning_text != "":
             with placeholder.container():
@@ -150,7 +222,11 @@ else:
             else:
                 markdown_placeholder.markdown(msg["content"])
 
-    if prompt := st.chat_input("Write a message..."):
+    # set when the last message was rejected, shown after the rerun
+    if busy_message := st.session_state.pop("busy_message", None):
+        st.warning(busy_message)
+
+    if prompt := st.chat_input("Write a message...", disabled=not assistant_ready):
         st.html(
             """
                 <style>
@@ -183,9 +259,14 @@ else:
 
             response_placeholder = st.empty()
             full_response = ""
+            answered = True
             try:
                 if stream:
                     streamer = chat_service.send(prompt, stream=True, **kwargs)
+                    while (status := chat_service.queue_status()) is not None:
+                        wait = f", about {status.estimated_wait:.0f} s" if status.estimated_wait else ""
+                        response_placeholder.info(f"⏳ Queued: position {status.position}{wait}")
+                        time.sleep(0.25)
                     for chunk in streamer:
                         full_response += chunk
                         response_placeholder.markdown(full_response + "▌")
@@ -196,8 +277,15 @@ else:
                             prompt, stream=False, **kwargs
                         )
                     response_placeholder.markdown(full_response)
+            except QueueFullError as e:
+                # the service took the message back
+                answered = False
+                st.session_state.busy_message = f"⏳ {e} Please send your message again shortly."
             except Exception as e:
                 response_placeholder.error(f"Something went wrong: {e}")
             finally:
-                chat_service.append_message("assistant", full_response)
+                # also runs when the page is rerun or the session closes mid-stream
+                chat_service.cancel_generation()
+                if answered:
+                    chat_service.append_message("assistant", full_response)
         st.rerun()
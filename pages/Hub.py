@@ -35,6 +35,15 @@ with st.sidebar:
 
     show_limit = st.select_slider("Show:", options=range(1, 101), value=20)
 
+    cache_stats = hf_api_service.get_cache_stats()
+    if cache_stats:
+        st.caption(
+            f"🗄️ Cache: {cache_stats['hits']} hits / {cache_stats['misses']} misses"
+            f" ({cache_stats['entries']} entries)"
+        )
+        if st.button("Clear cache", icon="🧹"):
+            hf_api_service.clear_cache()
+
 
 download_status = st.empty()
 download_progress = st.empty()
@@ -48,26 +57,18 @@ try:
 
     def download_model_repo_callback(repo_id, pipeline_tag):
         try:
-            files = hf_api_service.get_repo_files(repo_id)
-            i = 0
-            for filename in files:
-                if i < len(files):
-                    download_progress.progress(
-                        value=(i + 1) / len(files),
-                        text=f"Downloading { files[i] } ({i+1}/{len(files)})",
-                    )
-
-                elapsed, file_size = hf_api_service.download_file(
-                    repo_id, filename, pipeline_tag
-                )
-                st.toast(
-                    f"Downloaded {filename} in {elapsed} ({file_size})",
-                    icon="✅",
-                )
-                i += 1
+            elapsed, download_size = hf_api_service.download_repo(
+                repo_id,
+                pipeline_tag,
+                on_progress=lambda progress: download_progress.progress(
+                    value=progress.fraction,
+                    text=f"Downloading {repo_id}: "
+                    + hf_api_service.format_download_progress(progress),
+                ),
+            )
 
             st.success(
-                f"Successfully downloaded {repo_id}",
+                f"Successfully downloaded {repo_id} in {elapsed} ({download_size})",
                 icon="✅",
             )
         except Exception as e:
@@ -79,6 +80,7 @@ try:
         likes = model["likes"]
         parameter_size = model["parameter_size"]
         download_size = model["download_size"]
+        repo_size = model["repo_size"]
         pipeline_tag = model["pipeline_tag"]
         if pipeline_tag == "text-generation" and "conversational" in model["tags"]:
             pipeline_tag = "conversational"
@@ -121,6 +123,7 @@ try:
                     st.button(
                         f"⬇️ {download_size}",
                         key=modelId + str(i),
+                        help=f"Config, tokenizer and one weight format (full repository: {repo_size})",
                         on_click=lambda model_id=modelId, pipeline_tag=pipeline_tag: download_model_repo_callback(
                             model_id, pipeline_tag
                         ),
@@ -1,5 +1,8 @@
+import time
+
 import streamlit as st
 
+from src.domain.models.text.worker_pool import QueueFullError
 from src.use_cases.text_generation_service import TextGenerationService
 
 if "text_generation_service" not in st.session_state:
@@ -17,14 +20,51 @@ else:
     with st.sidebar:
         st.title("📝 Text Generation")
 
-        @st.cache_resource(show_spinner=True)
-        def get_assistant_cached(id: str):
-            assistant = text_generation_service.set_assistant(id)
-            return assistant
-
-        with st.spinner("Loading model..."):
-            selected_model_id = st.selectbox(label="Model:", options=models)
-            cached_assistant = get_assistant_cached(selected_model_id)
+        selected_model_id = st.selectbox(label="Model:", options=models)
+        # models are shared across sessions by the model registry and load in
+        # the background, the page is rerun once the model is ready
+        load_status, load_error = text_generation_service.request_assistant(selected_model_id)
+        assistant_ready = load_status == "ready"
+        if load_status == "failed":
+            st.error(f"Failed to load {selected_model_id}: {load_error}")
+            if st.button("Retry", icon="🔄"):
+                text_generation_service.request_assistant(selected_model_id, retry=True)
+                st.rerun()
+        elif not assistant_ready:
+
+            @st.fragment(run_every=0.5)
+            def show_load_status():
+                status, _ = text_generation_service.request_assistant(selected_model_id)
+                if status in ("ready", "failed"):
+                    st.rerun()
+                st.info(f"⏳ {selected_model_id}: {status}...")
+
+            show_load_status()
+
+        if assistant_ready:
+            text_generation_service.preload_next(models)
+
+            # the draft is attached to the shared model, start from its current pairing
+            draft_options = ["None"] + text_generation_service.get_draft_options()
+            draft_id = text_generation_service.assistant.draft_id
+            selected_draft_id = st.selectbox(
+                label="Draft model:",
+                options=draft_options,
+                index=draft_options.index(draft_id) if draft_id in draft_options else 0,
+                help="Smaller model sharing the tokenizer that proposes tokens for assisted generation.",
+            )
+            try:
+                with st.spinner("Loading draft model..."):
+                    text_generation_service.set_draft(None if selected_draft_id == "None" else selected_draft_id)
+            except ValueError as e:
+                st.error(str(e))
+            assisted_stats = text_generation_service.assistant.assisted_stats
+            if text_generation_service.assistant.draft_id and assisted_stats.generations:
+                st.caption(
+                    f"🎯 Draft acceptance: {assisted_stats.acceptance_rate:.0%}"
+                    f" · {assisted_stats.tokens_per_pass:.2f} tokens/pass"
+                    f" · {assisted_stats.tokens_per_second:.1f} tokens/s"
+                )
 
         stream = st.checkbox("Stream response")
 
@@ -67,7 +107,7 @@ else:
     
     text_input_palceholder = st.empty()
     assistant_response_placeholder = st.container()
-    if prompt := text_input_palceholder.text_input("Prompt:"):
+    if prompt := text_input_palceholder.text_input("Prompt:", disabled=not assistant_ready):
         with assistant_response_placeholder:
             with st.chat_message("assistant"):
                 kwargs = {
@@ -84,6 +124,10 @@ else:
                 try:
                     if stream:
                         streamer = text_generation_service.send(prompt, stream=True, **kwargs)
+                        while (status := text_generation_service.queue_status()) is not None:
+                            wait = f", about {status.estimated_wait:.0f} s" if status.estimated_wait else ""
+                            response_placeholder.info(f"⏳ Queued: position {status.position}{wait}")
+                            time.sleep(0.25)
                         for chunk in streamer:
                             full_response += chunk
                             response_placeholder.markdown(full_response + "▌")
@@ -94,5 +138,19 @@ else:
                                 prompt, stream=False, **kwargs
                             )
                         response_placeholder.markdown(full_response)
+                    if text_generation_service.last_response_cached:
+                        st.caption("⚡ Served from the response cache")
+                    metrics = text_generation_service.last_metrics
+                    if metrics is not None:
+                        st.caption(
+                            f"⏱️ {metrics.prompt_tokens} prompt + {metrics.new_tokens} new tokens"
+                            f" · TTFT {metrics.ttft or 0:.2f} s · {metrics.tokens_per_second:.1f} tokens/s"
+                            f" · queued {metrics.queue_wait or 0:.2f} s · {metrics.memory_delta / 1024**2:+.0f} MB RSS"
+                        )
+                except QueueFullError as e:
+                    response_placeholder.warning(f"⏳ {e} Please try again shortly.")
                 except Exception as e:
-                    response_placeholder.error(f"Something went wrong: {e}")
\ No newline at end of file
+                    response_placeholder.error(f"Something went wrong: {e}")
+                finally:
+                    # also runs when the page is rerun or the session closes mid-stream
+                    text_generation_service.cancel_generation()
\ No newline at end of file
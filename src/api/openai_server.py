@@ -0,0 +1,575 @@
+"""Headless HTTP API compatible with the OpenAI chat and completions
+endpoints, over `ChatService` and `TextGenerationService`.
+
+Every connection is a coroutine on one event loop: tokens are streamed to
+the clients as server-sent events by `async for` over the generation
+streamers, no thread waits on a request. Generations run on the model's
+worker pool as in the app, so a busy model answers 429.
+
+Usage: python -m src.api.openai_server [--host 127.0.0.1] [--port 8000]
+"""
+
+import argparse
+import asyncio
+import functools
+import json
+import signal
+import time
+import uuid
+import warnings
+from http import HTTPStatus
+from typing import AsyncIterator, Dict, Iterable, List, Optional, Tuple, Union
+
+from ..domain.models.text.telemetry import generation_telemetry
+from ..domain.models.text.worker_pool import QueueFullError
+from ..domain.models.utils import list_local_models
+from ..use_cases.chat_service import ChatService
+from ..use_cases.response_cache import ResponseCache
+from ..use_cases.response_stream import ResponseStream
+from ..use_cases.text_generation_service import TextGenerationService
+
+MAX_BODY_BYTES = 4 * 1024**2
+# seconds between checks that the client of a running request is still there
+DISCONNECT_POLL = 0.5
+
+
+class HttpError(Exception):
+    """An error answered in the OpenAI format."""
+
+    def __init__(
+        self,
+        status: int,
+        message: str,
+        type: str = "invalid_request_error",
+        param: Optional[str] = None,
+        headers: Optional[Dict[str, str]] = None,
+    ):
+        super().__init__(message)
+        self.status = status
+        self.message = message
+        self.type = type
+        self.param = param
+        self.headers = headers or {}
+
+    def body(self) -> dict:
+        return {"error": {"message": self.message, "type": self.type, "param": self.param, "code": None}}
+
+
+class Request:
+    def __init__(self, method: str, path: str, version: str, headers: Dict[str, str], body: bytes):
+        self.method = method
+        self.path = path
+        self.version = version
+        self.headers = headers
+        self.body = body
+
+    @property
+    def keep_alive(self) -> bool:
+        connection = self.headers.get("connection", "").lower()
+        if self.version == "HTTP/1.0":
+            return connection == "keep-alive"
+        return connection != "close"
+
+    def json(self) -> dict:
+        try:
+            body = json.loads(self.body)
+        except ValueError as e:
+            raise HttpError(400, f"Invalid JSON body: {e}")
+        if not isinstance(body, dict):
+            raise HttpError(400, "The body must be a JSON object.")
+        return body
+
+
+async def read_request(reader: asyncio.StreamReader) -> Optional[Request]:
+    """The next request on the connection, `None` once the client closed it."""
+    try:
+        line = await reader.readline()
+    except (ConnectionError, asyncio.LimitOverrunError, ValueError):
+        return None
+    if not line.strip():
+        return None
+    try:
+        method, target, version = line.decode("latin-1").split()
+    except ValueError:
+        raise HttpError(400, "Malformed request line.")
+    headers = {}
+    while True:
+        line = await reader.readline()
+        if line in (b"\r\n", b"\n", b""):
+            break
+        name, _, value = line.decode("latin-1").partition(":")
+        headers[name.strip().lower()] = value.strip()
+    if "chunked" in headers.get("transfer-encoding", "").lower():
+        raise HttpError(411, "Chunked request bodies are not supported, send a Content-Length.")
+    try:
+        length = int(headers.get("content-length", 0))
+    except ValueError:
+        raise HttpError(400, "Invalid Content-Length.")
+    if length > MAX_BODY_BYTES:
+        raise HttpError(413, f"The body exceeds {MAX_BODY_BYTES} bytes.")
+    body = await reader.readexactly(length) if length else b""
+    return Request(method, target.split("?")[0], version, headers, body)
+
+
+def _head(status: int, headers: Dict[str, str]) -> bytes:
+    lines = [f"HTTP/1.1 {status} {HTTPStatus(status).phrase}"]
+    lines += [f"{name}: {value}" for name, value in headers.items()]
+    return ("\r\n".join(lines) + "\r\n\r\n").encode("latin-1")
+
+
+async def send_body(
+    writer: asyncio.StreamWriter,
+    status: int,
+    body: bytes,
+    content_type: str,
+    keep_alive: bool,
+    headers: Optional[Dict[str, str]] = None,
+):
+    headers = {
+        "Content-Type": content_type,
+        "Content-Length": str(len(body)),
+        "Connection": "keep-alive" if keep_alive else "close",
+        **(headers or {}),
+    }
+    writer.write(_head(status, headers) + body)
+    await writer.drain()
+
+
+async def send_json(writer: asyncio.StreamWriter, status: int, payload: dict, keep_alive: bool, headers=None):
+    await send_body(writer, status, json.dumps(payload).encode(), "application/json", keep_alive, headers)
+
+
+class EventStream:
+    """Server-sent events in a chunked response, so the connection can be
+    kept alive after the stream."""
+
+    def __init__(self, writer: asyncio.StreamWriter, keep_alive: bool):
+        self.writer = writer
+        self.keep_alive = keep_alive
+
+    async def open(self):
+        self.writer.write(
+            _head(
+                200,
+                {
+                    "Content-Type": "text/event-stream",
+                    "Cache-Control": "no-cache",
+                    "Transfer-Encoding": "chunked",
+                    "Connection": "keep-alive" if self.keep_alive else "close",
+                },
+            )
+        )
+        await self.writer.drain()
+
+    async def send(self, data: Union[dict, str]):
+        if isinstance(data, dict):
+            data = json.dumps(data)
+        event = f"data: {data}\n\n".encode()
+        self.writer.write(f"{len(event):x}\r\n".encode() + event + b"\r\n")
+        await self.writer.drain()
+
+    async def close(self):
+        await self.send("[DONE]")
+        self.writer.write(b"0\r\n\r\n")
+        await self.writer.drain()
+
+
+async def _chunks(chunks: Iterable[str]) -> AsyncIterator[str]:
+    if isinstance(chunks, ResponseStream):
+        async for chunk in chunks:
+            yield chunk
+    else:
+        # a response from the response cache, replayed from memory
+        for chunk in chunks:
+            yield chunk
+
+
+def _failed(chunks: Iterable[str]) -> bool:
+    return isinstance(chunks, ResponseStream) and chunks.error is not None
+
+
+async def _skip_prompt(chunks: AsyncIterator[str], prompt: str) -> AsyncIterator[str]:
+    """Drop the `prompt` that text generation models output first. If the
+    decoded text does not start with it exactly, nothing is dropped."""
+    head = ""
+    async for chunk in chunks:
+        if head is None:
+            yield chunk
+            continue
+        head += chunk
+        if len(head) >= len(prompt) or not prompt.startswith(head):
+            rest = head[len(prompt) :] if head.startswith(prompt) else head
+            head = None
+            if rest:
+                yield rest
+    if head:
+        yield head
+
+
+def _optional(body: dict, name: str, kind, minimum=None, maximum=None):
+    value = body.get(name)
+    if value is None:
+        return None
+    # bool is an int, but not a valid number here
+    if isinstance(value, bool) or not isinstance(value, kind):
+        raise HttpError(400, f"`{name}` has the wrong type.", param=name)
+    if minimum is not None and value < minimum:
+        raise HttpError(400, f"`{name}` must be at least {minimum}.", param=name)
+    if maximum is not None and value > maximum:
+        raise HttpError(400, f"`{name}` must be at most {maximum}.", param=name)
+    return value
+
+
+def generation_kwargs(body: dict, default_max_tokens: int) -> dict:
+    """The `generate` arguments of an OpenAI request. Without `temperature`
+    the generation config of the model decides whether to sample."""
+    if body.get("n", 1) != 1:
+        raise HttpError(400, "Only `n` = 1 is supported.", param="n")
+    if body.get("stop"):
+        raise HttpError(400, "`stop` is not supported.", param="stop")
+    if body.get("logprobs"):
+        raise HttpError(400, "`logprobs` is not supported.", param="logprobs")
+    max_tokens = _optional(body, "max_completion_tokens", int, 1) or _optional(body, "max_tokens", int, 1)
+    kwargs = {"max_new_tokens": max_tokens or default_max_tokens}
+    temperature = _optional(body, "temperature", (int, float), 0, 2)
+    if temperature is not None:
+        kwargs["do_sample"] = temperature > 0
+        if temperature > 0:
+            kwargs["temperature"] = float(temperature)
+    top_p = _optional(body, "top_p", (int, float), 0, 1)
+    if top_p is not None:
+        kwargs["top_p"] = float(top_p)
+    return kwargs
+
+
+def _messages(body: dict) -> List[dict]:
+    messages = body.get("messages")
+    if not isinstance(messages, list) or not messages:
+        raise HttpError(400, "`messages` must be a non-empty list.", param="messages")
+    parsed = []
+    for message in messages:
+        if not isinstance(message, dict) or message.get("role") not in ("system", "user", "assistant"):
+            raise HttpError(400, "Messages need a system, user or assistant `role`.", param="messages")
+        content = message.get("content")
+        if isinstance(content, list):
+            # content parts, only text is supported
+            if any(not isinstance(part, dict) or part.get("type") != "text" for part in content):
+                raise HttpError(400, "Only text content parts are supported.", param="messages")
+            content = "".join(part.get("text", "") for part in content)
+        if not isinstance(content, str):
+            raise HttpError(400, "Message `content` must be a string.", param="messages")
+        parsed.append({"role": message["role"], "content": content})
+    if parsed[-1]["role"] != "user":
+        raise HttpError(400, "The last message must be from the user.", param="messages")
+    return parsed
+
+
+def _prompt(body: dict) -> str:
+    prompt = body.get("prompt")
+    if isinstance(prompt, list) and len(prompt) == 1:
+        prompt = prompt[0]
+    if not isinstance(prompt, str):
+        raise HttpError(400, "`prompt` must be a string.", param="prompt")
+    return prompt
+
+
+class OpenAIServer:
+    """Serves `/v1/chat/completions` (conversational models),
+    `/v1/completions` (text generation models), `/v1/models` and the
+    generation metrics at `/metrics`.
+
+    Each request gets its own service session on the shared models. On
+    `stop()`, the server stops accepting connections, lets the running
+    requests finish for up to `shutdown_timeout` seconds, then cancels the
+    rest.
+    """
+
+    def __init__(
+        self,
+        host: str = "127.0.0.1",
+        port: int = 8000,
+        use_response_cache=True,
+        default_max_tokens: int = 256,
+        shutdown_timeout: float = 30.0,
+    ):
+        self.host = host
+        self.port = port
+        self.default_max_tokens = default_max_tokens
+        self.shutdown_timeout = shutdown_timeout
+        # shared by the sessions of all requests
+        self.response_cache = ResponseCache() if use_response_cache else None
+        self._server: Optional[asyncio.AbstractServer] = None
+        self._stopping: Optional[asyncio.Event] = None
+        # connection tasks, and whether they are handling a request
+        self._connections: Dict[asyncio.Task, bool] = {}
+
+    async def start(self) -> int:
+        """Start listening, returns the port (useful with port 0)."""
+        self._stopping = asyncio.Event()
+        self._server = await asyncio.start_server(self._connection, self.host, self.port)
+        self.port = self._server.sockets[0].getsockname()[1]
+        return self.port
+
+    def stop(self):
+        """Start the graceful shutdown, `serve` returns once it is done."""
+        self._stopping.set()
+
+    async def serve(self):
+        """Run until `stop()`, SIGINT or SIGTERM."""
+        if self._server is None:
+            await self.start()
+        loop = asyncio.get_running_loop()
+        signals = []
+        for signum in (signal.SIGINT, signal.SIGTERM):
+            try:
+                loop.add_signal_handler(signum, self.stop)
+                signals.append(signum)
+            except (NotImplementedError, RuntimeError):
+                # e.g. Windows, or not on the main thread
+                pass
+        try:
+            await self._stopping.wait()
+        finally:
+            for signum in signals:
+                loop.remove_signal_handler(signum)
+
+        self._server.close()
+        # idle keep-alive connections go right away, the others after their request
+        for task, busy in list(self._connections.items()):
+            if not busy:
+                task.cancel()
+        busy = [task for task in self._connections if not task.done()]
+        if busy:
+            _, pending = await asyncio.wait(busy, timeout=self.shutdown_timeout)
+            for task in pending:
+                task.cancel()
+            if pending:
+                await asyncio.wait(pending)
+        await self._server.wait_closed()
+
+    async def _connection(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        task = asyncio.current_task()
+        self._connections[task] = False
+        try:
+            while not self._stopping.is_set():
+                try:
+                    request = await read_request(reader)
+                except HttpError as e:
+                    await send_json(writer, e.status, e.body(), keep_alive=False, headers=e.headers)
+                    break
+                except asyncio.IncompleteReadError:
+                    break
+                if request is None:
+                    break
+                self._connections[task] = True
+                keep_alive = request.keep_alive
+                try:
+                    await self._dispatch(request, reader, writer, keep_alive)
+                except HttpError as e:
+                    await send_json(writer, e.status, e.body(), keep_alive, headers=e.headers)
+                except (ConnectionError, asyncio.CancelledError):
+                    raise
+                except Exception as e:
+                    warnings.warn(f"{request.method} {request.path} failed: {e}")
+                    error = HttpError(500, str(e), type="server_error")
+                    await send_json(writer, 500, error.body(), keep_alive=False)
+                    break
+                self._connections[task] = False
+                if not keep_alive:
+                    break
+        except (ConnectionError, asyncio.CancelledError):
+            pass
+        finally:
+            self._connections.pop(task, None)
+            writer.close()
+
+    async def _dispatch(self, request: Request, reader, writer, keep_alive: bool):
+        # answered with "Connection: close" while shutting down
+        keep_alive = keep_alive and not self._stopping.is_set()
+        route = (request.method, request.path)
+        if route == ("POST", "/v1/chat/completions"):
+            await self._chat_completions(request.json(), reader, writer, keep_alive)
+        elif route == ("POST", "/v1/completions"):
+            await self._completions(request.json(), reader, writer, keep_alive)
+        elif route == ("GET", "/v1/models"):
+            await send_json(writer, 200, self._models(), keep_alive)
+        elif route == ("GET", "/metrics"):
+            body = generation_telemetry.prometheus().encode()
+            await send_body(writer, 200, body, "text/plain; version=0.0.4; charset=utf-8", keep_alive)
+        elif route == ("GET", "/health"):
+            await send_json(writer, 200, {"status": "ok"}, keep_alive)
+        else:
+            raise HttpError(404, f"No route for {request.method} {request.path}.")
+
+    def _models(self) -> dict:
+        return {
+            "object": "list",
+            "data": [
+                {"id": id, "object": "model", "created": 0, "owned_by": task}
+                for task in ("conversational", "text-generation")
+                for id in list_local_models(task)
+            ],
+        }
+
+    async def _run(self, fn, *args, **kwargs):
+        # tokenization, cache lookups and model loads, off the event loop
+        return await asyncio.get_running_loop().run_in_executor(None, functools.partial(fn, *args, **kwargs))
+
+    async def _start(self, service, task: str, body: dict, content: str, setup=None) -> Iterable[str]:
+        """Start the generation of `service` for `content`, returns its chunks."""
+        model = body.get("model")
+        if model not in list_local_models(task):
+            raise HttpError(404, f"The model `{model}` does not exist.", param="model")
+        kwargs = generation_kwargs(body, self.default_max_tokens)
+        service.response_cache = self.response_cache
+        await self._run(service.set_assistant, model)
+        if setup is not None:
+            setup()
+        try:
+            return await self._run(service.send, content, stream=True, **kwargs)
+        except QueueFullError as e:
+            headers = {}
+            if e.retry_after is not None:
+                headers["Retry-After"] = str(max(1, round(e.retry_after)))
+            raise HttpError(429, str(e), type="server_busy", headers=headers)
+
+    def _finish(self, service, body: dict) -> Tuple[str, Optional[dict]]:
+        """Finish reason and usage of the last generation of `service`,
+        usage is unknown for responses from the response cache."""
+        metrics = service.last_metrics
+        if metrics is None:
+            return "stop", None
+        max_new_tokens = generation_kwargs(body, self.default_max_tokens)["max_new_tokens"]
+        usage = {
+            "prompt_tokens": metrics.prompt_tokens,
+            "completion_tokens": metrics.new_tokens,
+            "total_tokens": metrics.prompt_tokens + metrics.new_tokens,
+        }
+        return ("length" if metrics.new_tokens >= max_new_tokens else "stop"), usage
+
+    async def _respond(
+        self,
+        service,
+        body: dict,
+        chunks: Iterable[str],
+        reader,
+        writer,
+        keep_alive: bool,
+        kind: str,
+        prompt: Optional[str] = None,
+    ):
+        """Answer with the generated chunks, as events or in one response.
+        `kind` is `"chat"` or `"text"`, the `prompt` of a text completion is
+        left out of the answer unless the request asks to `echo` it."""
+        id = f"{'chatcmpl' if kind == 'chat' else 'cmpl'}-{uuid.uuid4().hex}"
+        created = int(time.time())
+        base = {
+            "id": id,
+            "object": "chat.completion" if kind == "chat" else "text_completion",
+            "created": created,
+            "model": body["model"],
+        }
+
+        def choice(text: Optional[str], finish_reason: Optional[str], delta: bool) -> dict:
+            if kind == "text":
+                return {"index": 0, "text": text or "", "logprobs": None, "finish_reason": finish_reason}
+            message = {} if text is None else {"content": text}
+            if not delta:
+                message = {"role": "assistant", "content": text or ""}
+            return {"index": 0, "delta" if delta else "message": message, "finish_reason": finish_reason}
+
+        texts = _chunks(chunks)
+        if prompt is not None and not body.get("echo"):
+            texts = _skip_prompt(texts, prompt)
+        watcher = asyncio.ensure_future(self._watch(reader, writer, chunks))
+        try:
+            if not body.get("stream"):
+                text = "".join([chunk async for chunk in texts])
+                if _failed(chunks):
+                    raise HttpError(500, str(chunks.error), type="server_error")
+                finish_reason, usage = self._finish(service, body)
+                payload = {**base, "choices": [choice(text, finish_reason, False)]}
+                if usage is not None:
+                    payload["usage"] = usage
+                await send_json(writer, 200, payload, keep_alive)
+                return
+
+            if kind == "chat":
+                base["object"] = "chat.completion.chunk"
+            events = EventStream(writer, keep_alive)
+            await events.open()
+            if kind == "chat":
+                first = choice(None, None, True)
+                first["delta"] = {"role": "assistant", "content": ""}
+                await events.send({**base, "choices": [first]})
+            async for chunk in texts:
+                if chunk:
+                    await events.send({**base, "choices": [choice(chunk, None, True)]})
+            if _failed(chunks):
+                # the status line is sent already, the error ends the events
+                await events.send(HttpError(500, str(chunks.error), type="server_error").body())
+                await events.close()
+                return
+            finish_reason, usage = self._finish(service, body)
+            await events.send({**base, "choices": [choice(None if kind == "chat" else "", finish_reason, True)]})
+            if (body.get("stream_options") or {}).get("include_usage"):
+                await events.send({**base, "choices": [], "usage": usage})
+            await events.close()
+        finally:
+            watcher.cancel()
+            if isinstance(chunks, ResponseStream):
+                chunks.cancel()
+
+    async def _watch(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter, chunks):
+        """Cancel the generation if the client goes away before the end."""
+        while not (reader.at_eof() or writer.transport.is_closing()):
+            await asyncio.sleep(DISCONNECT_POLL)
+        if isinstance(chunks, ResponseStream):
+            chunks.cancel()
+
+    async def _chat_completions(self, body: dict, reader, writer, keep_alive: bool):
+        messages = _messages(body)
+        service = ChatService(use_response_cache=False)
+        chunks = await self._start(
+            service,
+            "conversational",
+            body,
+            messages[-1]["content"],
+            setup=lambda: service.set_messages(messages[:-1]),
+        )
+        await self._respond(service, body, chunks, reader, writer, keep_alive, "chat")
+
+    async def _completions(self, body: dict, reader, writer, keep_alive: bool):
+        prompt = _prompt(body)
+        service = TextGenerationService(use_response_cache=False)
+        chunks = await self._start(service, "text-generation", body, prompt)
+        await self._respond(service, body, chunks, reader, writer, keep_alive, "text", prompt)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8000)
+    parser.add_argument("--default-max-tokens", type=int, default=256)
+    parser.add_argument("--shutdown-timeout", type=float, default=30.0)
+    parser.add_argument("--no-response-cache", action="store_true")
+    args = parser.parse_args()
+
+    server = OpenAIServer(
+        args.host,
+        args.port,
+        use_response_cache=not args.no_response_cache,
+        default_max_tokens=args.default_max_tokens,
+        shutdown_timeout=args.shutdown_timeout,
+    )
+
+    async def run():
+        port = await server.start()
+        print(f"Serving on http://{args.host}:{port}/v1")
+        await server.serve()
+
+    asyncio.run(run())
+
+
+if __name__ == "__main__":
+    main()
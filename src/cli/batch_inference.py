@@ -0,0 +1,304 @@
+"""Run the prompts of a JSONL file through a local text generation model in
+batches, writing the generated texts to an output JSONL file.
+
+Each input line is an object with a `prompt` and optionally an `id` (by
+default its line number). Prompts are read a window at a time and sorted by
+token length within it, so each batch pads its prompts to similar lengths.
+Every output line holds the `id`, the generated `output` and the token
+counts, or an `error`. Lines are written in batch order, not in input order.
+
+The output file is the checkpoint: it is flushed after every batch, and a
+new run with the same output skips the ids already in it (retrying the
+failed ones). Interrupt a run at any point and start it again to resume.
+
+Usage: python -m src.cli.batch_inference prompts.jsonl outputs.jsonl --model <id>
+    [--batch-size 8] [--max-batch-tokens 4096] [--window 512] [--max-new-tokens 128]
+"""
+
+import argparse
+import json
+import os
+import sys
+import time
+from dataclasses import asdict, dataclass
+from typing import Iterator, List, Set, Tuple
+
+from ..domain.models.text.telemetry import GenerationMetrics, MetricsStreamer, generation_telemetry
+from ..domain.models.text.text_generation import TextGenerationModel
+from ..domain.models.utils import list_local_models
+
+
+@dataclass
+class BatchReport:
+    prompts: int = 0
+    # already in the output when the run started
+    skipped: int = 0
+    generated: int = 0
+    failed: int = 0
+    batches: int = 0
+    prompt_tokens: int = 0
+    new_tokens: int = 0
+    # prompt tokens including the padding of the batches
+    padded_tokens: int = 0
+    elapsed: float = 0.0
+
+    @property
+    def prompts_per_second(self) -> float:
+        return self.generated / self.elapsed if self.elapsed else 0.0
+
+    @property
+    def tokens_per_second(self) -> float:
+        return self.new_tokens / self.elapsed if self.elapsed else 0.0
+
+    @property
+    def padding_efficiency(self) -> float:
+        """Share of the batched prompt tokens that are not padding."""
+        return self.prompt_tokens / self.padded_tokens if self.padded_tokens else 1.0
+
+    def to_dict(self) -> dict:
+        return {
+            **asdict(self),
+            "prompts_per_second": self.prompts_per_second,
+            "tokens_per_second": self.tokens_per_second,
+            "padding_efficiency": self.padding_efficiency,
+        }
+
+
+@dataclass
+class _Prompt:
+    id: object
+    text: str
+    length: int = 0
+
+
+def read_prompts(path: str) -> Iterator[Tuple[object, str]]:
+    """`(id, prompt)` of every line of a JSONL file, skipping blank lines."""
+    with open(path, encoding="utf-8") as f:
+        for number, line in enumerate(f, 1):
+            if not line.strip():
+                continue
+            try:
+                record = json.loads(line)
+            except ValueError as e:
+                raise ValueError(f"{path}:{number} is not valid JSON: {e}")
+            if not isinstance(record, dict) or not isinstance(record.get("prompt"), str):
+                raise ValueError(f"{path}:{number} has no `prompt` string.")
+            yield record.get("id", number), record["prompt"]
+
+
+def completed_ids(path: str) -> Set[str]:
+    """Ids with an output in `path`. The file may end with the partial line
+    of an interrupted write, which is cut off."""
+    done = set()
+    if not os.path.exists(path):
+        return done
+    with open(path, "rb+") as f:
+        valid = 0
+        for number, line in enumerate(f, 1):
+            try:
+                record = json.loads(line) if line.endswith(b"\n") else None
+            except ValueError:
+                record = None
+            if record is None:
+                if f.read(1):
+                    raise ValueError(f"{path}:{number} is not a valid result line.")
+                f.truncate(valid)
+                break
+            valid += len(line)
+            if "error" not in record:
+                done.add(json.dumps(record["id"]))
+    return done
+
+
+def length_batches(prompts: List[_Prompt], batch_size: int, max_batch_tokens: int) -> List[List[_Prompt]]:
+    """Sort `prompts` by length and cut them into batches of at most
+    `batch_size` prompts and `max_batch_tokens` padded prompt tokens."""
+    batches, batch = [], []
+    for prompt in sorted(prompts, key=lambda prompt: prompt.length):
+        # sorted, so the new prompt is the longest of the batch
+        if batch and (len(batch) == batch_size or (len(batch) + 1) * prompt.length > max_batch_tokens):
+            batches.append(batch)
+            batch = []
+        batch.append(prompt)
+    if batch:
+        batches.append(batch)
+    return batches
+
+
+class BatchRunner:
+    """Generates for the prompts of an input file with `model`, see the
+    module docstring. `generation_kwargs` apply to every prompt."""
+
+    def __init__(
+        self,
+        model: TextGenerationModel,
+        batch_size: int = 8,
+        max_batch_tokens: int = 4096,
+        window: int = 512,
+        sort: bool = True,
+        progress=sys.stderr,
+        **generation_kwargs,
+    ):
+        self.model = model
+        self.batch_size = batch_size
+        self.max_batch_tokens = max_batch_tokens
+        # with `sort` off, batches follow the input order
+        self.window = window if sort else batch_size
+        self.progress = progress
+        self.generation_kwargs = generation_kwargs
+        self.report = BatchReport()
+
+    def _generate(self, batch: List[_Prompt]) -> List[dict]:
+        metrics = [
+            MetricsStreamer(
+                GenerationMetrics(self.model.id, self.model.tag, stream=False),
+                on_finish=generation_telemetry.record,
+            )
+            for _ in batch
+        ]
+        outputs = self.model.generate_batch(
+            [prompt.text for prompt in batch], metrics, skip_prompt=True, **self.generation_kwargs
+        )
+        self.report.batches += 1
+        self.report.padded_tokens += len(batch) * max(prompt.length for prompt in batch)
+        return [
+            {
+                "id": prompt.id,
+                "output": output,
+                "prompt_tokens": tracker.metrics.prompt_tokens,
+                "new_tokens": tracker.metrics.new_tokens,
+            }
+            for prompt, output, tracker in zip(batch, outputs, metrics)
+        ]
+
+    def _run_batch(self, batch: List[_Prompt]) -> List[dict]:
+        """Results of `batch`, split in halves if it fails (e.g. out of memory)
+        until the prompts that fail on their own are found."""
+        try:
+            return self._generate(batch)
+        except Exception as e:
+            if len(batch) == 1:
+                return [{"id": batch[0].id, "error": f"{type(e).__name__}: {e}"}]
+            half = len(batch) // 2
+            return self._run_batch(batch[:half]) + self._run_batch(batch[half:])
+
+    def _write(self, out, results: List[dict]):
+        for result in results:
+            out.write(json.dumps(result, ensure_ascii=False) + "\n")
+            if "error" in result:
+                self.report.failed += 1
+            else:
+                self.report.generated += 1
+                self.report.prompt_tokens += result["prompt_tokens"]
+                self.report.new_tokens += result["new_tokens"]
+        out.flush()
+        os.fsync(out.fileno())
+
+    def _show_progress(self, total: int):
+        if self.progress is None:
+            return
+        report = self.report
+        done = report.skipped + report.generated + report.failed
+        print(
+            f"{done}/{total} prompts, {report.failed} failed,"
+            f" {report.tokens_per_second:.1f} tokens/s",
+            file=self.progress,
+            flush=True,
+        )
+
+    def run(self, input_path: str, output_path: str) -> BatchReport:
+        """Generate for the prompts of `input_path` without an output in
+        `output_path` yet. The report counts the work of this run."""
+        done = completed_ids(output_path)
+        total = sum(1 for _ in read_prompts(input_path))
+        start = time.perf_counter()
+        seen = set()
+        window: List[_Prompt] = []
+
+        def flush_window(out):
+            for batch in length_batches(window, self.batch_size, self.max_batch_tokens):
+                self._write(out, self._run_batch(batch))
+                self.report.elapsed = time.perf_counter() - start
+                self._show_progress(total)
+            window.clear()
+
+        with open(output_path, "a", encoding="utf-8") as out:
+            try:
+                for id, text in read_prompts(input_path):
+                    key = json.dumps(id)
+                    if key in seen:
+                        raise ValueError(f"Duplicate id {key} in {input_path}.")
+                    seen.add(key)
+                    self.report.prompts += 1
+                    if key in done:
+                        self.report.skipped += 1
+                        continue
+                    window.append(_Prompt(id, text, len(self.model.encode(text))))
+                    if len(window) >= self.window:
+                        flush_window(out)
+                flush_window(out)
+            finally:
+                self.report.elapsed = time.perf_counter() - start
+        return self.report
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Batch inference over a JSONL file of prompts.")
+    parser.add_argument("input", help="JSONL file with a `prompt` (and optional `id`) per line")
+    parser.add_argument("output", help="JSONL file the results are appended to, resumed if it exists")
+    parser.add_argument("--model", required=True, help="id of a local text generation model")
+    parser.add_argument("--batch-size", type=int, default=8)
+    parser.add_argument("--max-batch-tokens", type=int, default=4096, help="padded prompt tokens per batch")
+    parser.add_argument("--window", type=int, default=512, help="prompts sorted by length at a time")
+    parser.add_argument("--no-sort", action="store_true", help="batch the prompts in input order")
+    parser.add_argument("--max-new-tokens", type=int, default=128)
+    parser.add_argument("--temperature", type=float, default=0.0, help="0 for greedy decoding")
+    parser.add_argument("--top-p", type=float, default=None)
+    parser.add_argument("--report", help="also write the final report to this JSON file")
+    args = parser.parse_args()
+
+    if args.model not in list_local_models("text-generation"):
+        parser.error(f"No local text generation model {args.model}.")
+    generation_kwargs = {"max_new_tokens": args.max_new_tokens, "do_sample": args.temperature > 0}
+    if args.temperature > 0:
+        generation_kwargs["temperature"] = args.temperature
+    if args.top_p is not None:
+        generation_kwargs["top_p"] = args.top_p
+
+    # batches are formed here, the model's own scheduler is not needed
+    model = TextGenerationModel(args.model, batching=False)
+    model.load()
+    runner = BatchRunner(
+        model,
+        batch_size=args.batch_size,
+        max_batch_tokens=args.max_batch_tokens,
+        window=args.window,
+        sort=not args.no_sort,
+        **generation_kwargs,
+    )
+    interrupted = False
+    try:
+        runner.run(args.input, args.output)
+    except KeyboardInterrupt:
+        interrupted = True
+    finally:
+        model.unload()
+
+    report = runner.report
+    print(
+        f"{report.generated} generated, {report.skipped} already done, {report.failed} failed"
+        f" in {report.elapsed:.1f} s ({report.batches} batches)\n"
+        f"{report.prompts_per_second:.2f} prompts/s, {report.tokens_per_second:.1f} new tokens/s,"
+        f" {report.prompt_tokens} prompt and {report.new_tokens} new tokens,"
+        f" padding efficiency {report.padding_efficiency:.0%}"
+    )
+    if args.report:
+        with open(args.report, "w") as f:
+            json.dump(report.to_dict(), f, indent=2)
+    if interrupted:
+        print("Interrupted, run the same command again to resume.")
+        sys.exit(130)
+
+
+if __name__ == "__main__":
+    main()
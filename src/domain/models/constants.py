@@ -3,7 +3,53 @@ from typing import Literal
 
 
 MODELS_DIR = os.path.join(".", ".models")
+CACHE_DIR = os.path.join(MODELS_DIR, ".cache")
+HUB_CACHE_PATH = os.path.join(CACHE_DIR, "hub.sqlite")
+RESPONSE_CACHE_PATH = os.path.join(CACHE_DIR, "responses.sqlite")
+
+# RAM budget (GB) shared by all loaded models, unset or 0 for no limit
+MODEL_MEMORY_BUDGET = (
+    int(float(os.environ.get("MODEL_MEMORY_BUDGET_GB", 0)) * 1024**3) or None
+)
 ModelTag = Literal[
     "conversational",
     "text-generation",
 ]
+
+# share one continuous-batching decode loop between the chats of a model
+CONTINUOUS_BATCHING = os.environ.get("CONTINUOUS_BATCHING", "1") == "1"
+
+# weight format of the models loaded on CPU: fp32, bf16, int8 (dynamic
+# quantization of Linear layers) or int4 (weight-only, requires torchao)
+LoadMode = Literal["fp32", "bf16", "int8", "int4"]
+CPU_LOAD_MODE: LoadMode = os.environ.get("CPU_LOAD_MODE", "fp32")
+
+# store models converted for CPU_LOAD_MODE in <model>/.snapshots/ so the next
+# load memory-maps the converted weights instead of converting again
+WEIGHT_SNAPSHOTS = os.environ.get("WEIGHT_SNAPSHOTS", "1") == "1"
+
+# load the model after the selected one in the list in the background
+PRELOAD_NEXT_MODEL = os.environ.get("PRELOAD_NEXT_MODEL", "0") == "1"
+
+# run single-prompt generations through a torch.compile'd decode step over
+# a static KV cache, the first generation of every cache size compiles
+COMPILED_GENERATION = os.environ.get("COMPILED_GENERATION", "0") == "1"
+
+# append the metrics of every generation to this file as JSON lines, unset
+# to disable
+GENERATION_METRICS_LOG = os.environ.get("GENERATION_METRICS_LOG", "")
+# serve the generation metrics in the Prometheus text format at
+# http://127.0.0.1:<port>/metrics, 0 to disable
+METRICS_PORT = int(os.environ.get("METRICS_PORT", 0))
+
+# generations running at once per model, 0 for the batch size of its
+# batching decode loop, or 1 without one (each generation uses all cores)
+GENERATION_WORKERS = int(os.environ.get("GENERATION_WORKERS", 0))
+# generations that may wait for a worker of a model, more are rejected
+GENERATION_QUEUE_SIZE = int(os.environ.get("GENERATION_QUEUE_SIZE", 16))
+# also reject generations expected to wait longer (seconds), 0 for no limit
+GENERATION_MAX_WAIT = float(os.environ.get("GENERATION_MAX_WAIT", 0))
+
+# run every model in this many worker processes, each pinned to its own share
+# of the CPU cores, 0 to load the models in the app process
+MODEL_WORKERS = int(os.environ.get("MODEL_WORKERS", 0))
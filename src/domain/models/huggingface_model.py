@@ -17,10 +17,19 @@ class HuggingFaceModel(ABC):
     def unload(self):
         pass
 
+    @abstractmethod
+    def memory_footprint(self) -> int:
+        pass
+
     @abstractmethod
     def generate(self, text_inputs: str, **kwargs):
         pass
 
+    def warmup(self):
+        """Run a short generation after loading, so the first real request
+        doesn't pay the one-time costs."""
+        pass
+
     def __hash__(self):
         return hash(self.id)
 
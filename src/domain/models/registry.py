@@ -0,0 +1,260 @@
+import os
+import threading
+import time
+import warnings
+from collections import OrderedDict
+from concurrent.futures import Future, ThreadPoolExecutor
+from typing import Dict, List, Literal, Optional, Tuple, Type
+
+from .constants import MODEL_MEMORY_BUDGET, MODEL_WORKERS
+from .huggingface_model import HuggingFaceModel
+from .remote import RemoteModel
+from .text.cancellation import GenerationHandle
+
+LoadStatus = Literal["loading", "warming", "ready", "failed"]
+
+
+class _Entry:
+    def __init__(self, model: HuggingFaceModel):
+        self.model = model
+        self.refs = 0
+        self.footprint = 0
+        self.last_used = time.time()
+
+
+class LoadHandle:
+    """A model being acquired in the background by `ModelRegistry.acquire_async`."""
+
+    def __init__(self, registry: "ModelRegistry", model_class: Type[HuggingFaceModel], id: str):
+        self.registry = registry
+        self.model_class = model_class
+        self.id = id
+        self.future: Future = registry._loader.submit(registry.acquire, model_class, id)
+
+    def status(self) -> Tuple[LoadStatus, Optional[str]]:
+        """The load status and, if it failed, the error message."""
+        if self.future.done():
+            error = self.future.exception()
+            return ("failed", str(error)) if error else ("ready", None)
+        # shared with the other sessions loading the same model
+        status, _ = self.registry.status(self.model_class, self.id)
+        return ("warming" if status == "ready" else status or "loading"), None
+
+    def result(self) -> HuggingFaceModel:
+        """Wait for the model, the caller then owns the reference on it."""
+        return self.future.result()
+
+    def discard(self):
+        """Give the reference back once the load completes, for a model that is
+        no longer wanted."""
+
+        def release(future: Future):
+            if future.exception() is None:
+                self.registry.release(future.result())
+
+        self.future.add_done_callback(release)
+
+
+class ModelRegistry:
+    """Process-wide owner of the loaded models.
+
+    A model is loaded once and shared by every session that acquires it,
+    with a reference count per model. When the measured footprint of the
+    loaded models exceeds `memory_budget` (bytes, `None` for no limit), the
+    least recently used models that no session or running generation (see
+    `hold`) holds are unloaded. Models in use are never evicted, so the budget can be exceeded while they are all
+    held. With `MODEL_WORKERS`, models are loaded in worker processes and
+    acquired as their `RemoteModel`.
+    """
+
+    def __init__(self, memory_budget: Optional[int] = None, loader_workers=2):
+        self.memory_budget = memory_budget
+        self._entries: "OrderedDict[Tuple[Type, str], _Entry]" = OrderedDict()
+        self._load_locks: Dict[Tuple[Type, str], threading.Lock] = {}
+        # status of the loads in progress or failed, loaded models are ready
+        self._status: Dict[Tuple[Type, str], Tuple[LoadStatus, Optional[str]]] = {}
+        self._lock = threading.RLock()
+        self._loader = ThreadPoolExecutor(
+            max_workers=loader_workers, thread_name_prefix="model-loader"
+        )
+
+    def _key(self, model_class: Type[HuggingFaceModel], id: str):
+        return (model_class, id)
+
+    def _model_key(self, model: HuggingFaceModel):
+        # a model run by worker processes is registered under its own class
+        return self._key(getattr(model, "model_class", type(model)), model.id)
+
+    def _create(self, model_class: Type[HuggingFaceModel], id: str) -> HuggingFaceModel:
+        if MODEL_WORKERS:
+            return RemoteModel(model_class, id)
+        return model_class(id)
+
+    def _estimate_footprint(self, model: HuggingFaceModel) -> int:
+        try:
+            return sum(
+                os.path.getsize(os.path.join(model.path, name))
+                for name in os.listdir(model.path)
+                if name.endswith((".safetensors", ".bin"))
+            )
+        except FileNotFoundError:
+            return 0
+
+    def used_memory(self) -> int:
+        with self._lock:
+            return sum(entry.footprint for entry in self._entries.values())
+
+    def _evict_until(self, needed: int):
+        if self.memory_budget is None:
+            return
+        evicted = []
+        with self._lock:
+            used = self.used_memory()
+            for key, entry in list(self._entries.items()):
+                if used + needed <= self.memory_budget:
+                    break
+                if entry.refs == 0:
+                    del self._entries[key]
+                    used -= entry.footprint
+                    evicted.append(entry)
+        # unloading can be slow, the other sessions keep using the registry
+        for entry in evicted:
+            entry.model.unload()
+
+    def _set_status(self, key, status: LoadStatus, error: Optional[str] = None):
+        with self._lock:
+            self._status[key] = (status, error)
+
+    def acquire(self, model_class: Type[HuggingFaceModel], id: str) -> HuggingFaceModel:
+        """Return the loaded `model_class(id)`, loading it if needed, and take a
+        reference on it. Every `acquire` must be paired with a `release`."""
+        key = self._key(model_class, id)
+        with self._lock:
+            load_lock = self._load_locks.setdefault(key, threading.Lock())
+
+        # loading happens outside the registry lock so other models stay usable,
+        # the per-model lock makes concurrent sessions wait for a single load
+        with load_lock:
+            with self._lock:
+                entry = self._entries.get(key)
+                if entry is not None:
+                    entry.refs += 1
+                    self._touch(key)
+                    return entry.model
+
+            self._set_status(key, "loading")
+            model = self._create(model_class, id)
+            try:
+                self._evict_until(self._estimate_footprint(model))
+                model.load()
+            except Exception as e:
+                self._set_status(key, "failed", str(e))
+                raise
+            self._set_status(key, "warming")
+            self._warmup(model)
+
+            with self._lock:
+                entry = _Entry(model)
+                entry.refs = 1
+                entry.footprint = model.memory_footprint()
+                self._entries[key] = entry
+                self._status.pop(key, None)
+            self._evict_until(0)
+            return model
+
+    def _warmup(self, model: HuggingFaceModel):
+        # one-time costs (lazy initialization, allocator growth) are paid here
+        # instead of by the first request, a failed warmup doesn't fail the load
+        try:
+            model.warmup()
+        except Exception as e:
+            warnings.warn(f"Warmup of {model.id} failed: {e}")
+
+    def acquire_async(self, model_class: Type[HuggingFaceModel], id: str) -> LoadHandle:
+        """`acquire` on a background loader thread, poll the returned handle."""
+        return LoadHandle(self, model_class, id)
+
+    def preload_async(self, model_class: Type[HuggingFaceModel], id: str) -> Future:
+        """`preload` on a background loader thread."""
+        return self._loader.submit(self.preload, model_class, id)
+
+    def status(
+        self, model_class: Type[HuggingFaceModel], id: str
+    ) -> Tuple[Optional[LoadStatus], Optional[str]]:
+        """Load status of a model and error message if it failed, `None` if it
+        is neither loaded nor being loaded."""
+        key = self._key(model_class, id)
+        with self._lock:
+            if key in self._entries:
+                return "ready", None
+            return self._status.get(key, (None, None))
+
+    def preload(self, model_class: Type[HuggingFaceModel], id: str) -> HuggingFaceModel:
+        """Load a model without holding a reference on it, it stays evictable."""
+        model = self.acquire(model_class, id)
+        self.release(model)
+        return model
+
+    def hold(self, model: HuggingFaceModel, handle: GenerationHandle):
+        """Take another reference on an acquired model until the generation of
+        `handle` is finished, so that it is not evicted while it generates if
+        its session releases it (switches models or is closed) meanwhile."""
+        with self._lock:
+            entry = self._entries.get(self._model_key(model))
+            if entry is None or entry.model is not model:
+                return
+            entry.refs += 1
+        handle.on_finish(lambda: self.release(model))
+
+    def release(self, model: HuggingFaceModel):
+        with self._lock:
+            entry = self._entries.get(self._model_key(model))
+            if entry is not None and entry.model is model and entry.refs > 0:
+                entry.refs -= 1
+        self._evict_until(0)
+
+    def _touch(self, key):
+        self._entries[key].last_used = time.time()
+        self._entries.move_to_end(key)
+
+    def touch(self, model: HuggingFaceModel):
+        """Mark a model as just used, it becomes the last candidate for eviction."""
+        with self._lock:
+            key = self._model_key(model)
+            if key in self._entries:
+                self._touch(key)
+
+    def refresh(self, model: HuggingFaceModel):
+        """Measure the footprint of a model again after it changed, e.g. when a
+        draft model was attached to it, and evict others if needed."""
+        with self._lock:
+            entry = self._entries.get(self._model_key(model))
+            if entry is not None and entry.model is model:
+                entry.footprint = model.memory_footprint()
+        self._evict_until(0)
+
+    def unload(self, model_class: Type[HuggingFaceModel], id: str) -> bool:
+        """Unload an idle model right away, returns `False` if it is still in use."""
+        with self._lock:
+            entry = self._entries.get(self._key(model_class, id))
+            if entry is None or entry.refs > 0:
+                return False
+            del self._entries[self._key(model_class, id)]
+        entry.model.unload()
+        return True
+
+    def stats(self) -> List[dict]:
+        with self._lock:
+            return [
+                {
+                    "id": entry.model.id,
+                    "tag": entry.model.tag,
+                    "refs": entry.refs,
+                    "footprint": entry.footprint,
+                    "last_used": entry.last_used,
+                }
+                for entry in self._entries.values()
+            ]
+
+
+model_registry = ModelRegistry(MODEL_MEMORY_BUDGET)
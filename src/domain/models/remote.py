@@ -0,0 +1,489 @@
+import multiprocessing
+import os
+import pickle
+import signal
+import threading
+import time
+import warnings
+import weakref
+from concurrent.futures import Future
+from dataclasses import fields
+from itertools import count
+from typing import Callable, Dict, List, Optional, Tuple, Type
+
+import psutil
+import torch
+
+from .constants import MODEL_WORKERS
+from .huggingface_model import HuggingFaceModel
+from .text.assisted import AssistedStats
+from .text.cancellation import GenerationHandle
+from .text.kv_cache import ConversationCache
+from .text.shared import StreamMixin
+from .text.streaming import IncrementalTextStreamer
+from .text.telemetry import GenerationMetrics, generation_telemetry
+from .text.worker_pool import GenerationPool
+
+# seconds to wait for a worker to be ready, e.g. while one restarts
+READY_TIMEOUT = 300
+
+
+def core_sets(workers: int) -> List[List[int]]:
+    """Split the cores the process may use into `workers` disjoint sets of
+    (almost) equal size. With more workers than cores, cores are shared."""
+    if hasattr(os, "sched_getaffinity"):
+        cores = sorted(os.sched_getaffinity(0))
+    else:
+        cores = list(range(os.cpu_count() or 1))
+    return [
+        cores[i * len(cores) // workers : (i + 1) * len(cores) // workers]
+        or [cores[i % len(cores)]]
+        for i in range(workers)
+    ]
+
+
+def _picklable(error: BaseException) -> BaseException:
+    try:
+        pickle.loads(pickle.dumps(error))
+        return error
+    except Exception:
+        return RuntimeError(f"{type(error).__name__}: {error}")
+
+
+def _info(model) -> dict:
+    return {
+        "fingerprint": model.fingerprint,
+        "concurrency": model.pool.max_workers,
+        "generation_defaults": model.generation_defaults(),
+        "assisted_stats": model.assisted_stats,
+        "footprint": model.memory_footprint(),
+        # memory of the process not shared with others, e.g. with the other
+        # workers mapping the same weights
+        "private_memory": psutil.Process().memory_full_info().uss,
+    }
+
+
+def _serve(model_class: Type[HuggingFaceModel], id: str, cores: List[int], connection):
+    """Entry point of a worker process: load `model_class(id)` on `cores` and
+    answer the requests of its `RemoteModel` until the connection closes."""
+    if hasattr(os, "sched_setaffinity"):
+        os.sched_setaffinity(0, cores)
+    torch.set_num_threads(len(cores))
+    # the metrics are recorded by the app process
+    generation_telemetry.log_path = None
+
+    send_lock = threading.Lock()
+
+    def send(request_id: int, kind: str, payload=None):
+        with send_lock:
+            connection.send((request_id, kind, payload))
+
+    model = model_class(id)
+    try:
+        model.load()
+    except BaseException as e:
+        try:
+            send(0, "error", _picklable(e))
+        except OSError:
+            pass
+        return
+    send(0, "result", _info(model))
+
+    handles: Dict[int, GenerationHandle] = {}
+    # KV caches of the conversations routed here, by session id
+    sessions: Dict[int, ConversationCache] = {}
+
+    def call(method: str, args, kwargs):
+        if method == "info":
+            return _info(model)
+        if method == "load_draft":
+            model.load_draft(*args, **kwargs)
+            return None
+        if method == "drop_session":
+            sessions.pop(args[0], None)
+            return None
+        if method in (
+            "encode",
+            "count_message_tokens",
+            "get_context_length",
+            "warmup",
+            "unload_draft",
+        ):
+            return getattr(model, method)(*args, **kwargs)
+        raise AttributeError(f"{model_class.__name__} has no remote method {method}")
+
+    def handle(request_id: int, method: str, args, kwargs):
+        try:
+            if method == "generate":
+                session = kwargs.pop("session", None)
+                if session is not None:
+                    kwargs["cache"] = sessions.setdefault(session, ConversationCache())
+                kwargs["on_metrics"] = lambda metrics: send(request_id, "metrics", metrics.to_dict())
+                result = model.generate(*args, **kwargs)
+                if kwargs.get("stream"):
+                    for chunk in result:
+                        if chunk:
+                            send(request_id, "chunk", chunk)
+                    result = None
+            else:
+                result = call(method, args, kwargs)
+            send(request_id, "result", result)
+        except BaseException as e:
+            send(request_id, "error", _picklable(e))
+        finally:
+            handles.pop(request_id, None)
+
+    while True:
+        try:
+            request_id, method, args, kwargs = connection.recv()
+        except EOFError:
+            break
+        if method == "close":
+            break
+        if method == "cancel":
+            if request_id in handles:
+                handles[request_id].cancel()
+            continue
+        if method == "generate":
+            # registered before a cancel of the request can arrive
+            handles[request_id] = kwargs["handle"] = GenerationHandle()
+        threading.Thread(target=handle, args=(request_id, method, args, kwargs), daemon=True).start()
+    model.unload()
+
+
+class _Call:
+    def __init__(self, on_chunk: Optional[Callable] = None, on_metrics: Optional[Callable] = None):
+        self.on_chunk = on_chunk
+        self.on_metrics = on_metrics
+        self.future = Future()
+
+
+class _Worker:
+    """A worker process of a `RemoteModel` pinned to `cores`, and the
+    connection to it. The process is restarted if it dies (e.g. killed when
+    out of memory), the requests it was running fail."""
+
+    def __init__(self, model_class: Type[HuggingFaceModel], id: str, cores: List[int]):
+        self.model_class = model_class
+        self.id = id
+        self.cores = cores
+        self.in_flight = 0
+        self.restarts = 0
+        self.info: dict = {}
+        self.ready = threading.Event()
+        self._calls: Dict[int, _Call] = {}
+        self._ids = count(1)
+        self._lock = threading.Lock()
+        self._closed = False
+        self._start()
+        threading.Thread(target=self._read, daemon=True).start()
+
+    def _start(self):
+        context = multiprocessing.get_context("spawn")
+        self.connection, child = context.Pipe()
+        self.process = context.Process(
+            target=_serve,
+            args=(self.model_class, self.id, self.cores, child),
+            name=f"model-worker-{self.id}",
+            daemon=True,
+        )
+        self.process.start()
+        child.close()
+        # the worker answers request 0 once the model is loaded
+        self.loaded = _Call()
+        self.loaded.future.add_done_callback(self._on_loaded)
+        self._calls[0] = self.loaded
+
+    def _on_loaded(self, future: Future):
+        if future.exception() is None:
+            self.info = future.result()
+            self.ready.set()
+
+    def _read(self):
+        while True:
+            try:
+                request_id, kind, payload = self.connection.recv()
+            except (EOFError, OSError):
+                if self._exited():
+                    continue
+                return
+            call = self._calls.get(request_id)
+            if call is None:
+                continue
+            if kind == "chunk":
+                call.on_chunk(payload)
+            elif kind == "metrics":
+                call.on_metrics(payload)
+            else:
+                with self._lock:
+                    self._calls.pop(request_id, None)
+                if kind == "result":
+                    call.future.set_result(payload)
+                else:
+                    call.future.set_exception(payload)
+
+    def _exited(self) -> bool:
+        """Fail the requests of the dead process, returns whether it was
+        restarted."""
+        self.ready.clear()
+        self.process.join(timeout=5)
+        with self._lock:
+            calls, self._calls = self._calls, {}
+            error = RuntimeError(
+                f"The worker process of {self.id} exited with code {self.process.exitcode}."
+            )
+            for call in calls.values():
+                if not call.future.done():
+                    call.future.set_exception(error)
+            # a model that failed to load would fail again, and a terminated
+            # process was stopped on purpose (e.g. as the app exits)
+            if (
+                self._closed
+                or self.loaded.future.exception() is not None
+                or self.process.exitcode == -signal.SIGTERM
+            ):
+                return False
+            warnings.warn(f"{error} Restarting it.")
+            self.restarts += 1
+            self._start()
+            return True
+
+    def call(self, method: str, *args, on_chunk=None, on_metrics=None, **kwargs) -> Tuple[int, Future]:
+        """Send a request, the future resolves to its result."""
+        call = _Call(on_chunk, on_metrics)
+        with self._lock:
+            request_id = next(self._ids)
+            self._calls[request_id] = call
+            try:
+                self.connection.send((request_id, method, args, kwargs))
+            except (OSError, ValueError) as e:
+                self._calls.pop(request_id, None)
+                raise RuntimeError(f"The worker process of {self.id} is not running.") from e
+        return request_id, call.future
+
+    def _send(self, request_id: int, method: str, *args):
+        with self._lock:
+            try:
+                self.connection.send((request_id, method, args, {}))
+            except (OSError, ValueError):
+                pass
+
+    def cancel(self, request_id: int):
+        self._send(request_id, "cancel")
+
+    def drop_session(self, session: int):
+        self._send(0, "drop_session", session)
+
+    def close(self):
+        self._closed = True
+        self._send(0, "close")
+        self.process.join(timeout=10)
+        if self.process.is_alive():
+            self.process.terminate()
+
+
+class RemoteModel(StreamMixin, HuggingFaceModel):
+    """Runs `model_class(id)` in `workers` processes behind the interface of
+    the model, so a crash or an out-of-memory kill of a model does not take
+    the app down and generations do not compete with it for the GIL.
+
+    Each worker is pinned to its own share of the cores. Generations go to
+    the least busy worker, except that a conversation (its
+    `ConversationCache`) sticks to one worker, which holds its KV state.
+    Streamed text, metrics and cancellations go over the connection. The
+    workers map the same weight files (snapshots or safetensors), the page
+    cache shares them where the weights are used as stored.
+    """
+
+    def __init__(self, model_class: Type[HuggingFaceModel], id: str, workers: int = MODEL_WORKERS):
+        super().__init__(id, model_class(id).tag)
+        self.model_class = model_class
+        self.workers = max(1, workers)
+        self.fingerprint = None
+        self.draft_id = None
+        self._workers: List[_Worker] = []
+        self._generation_defaults: dict = {}
+        # conversation -> (session id, worker holding its KV state)
+        self._sessions: "weakref.WeakKeyDictionary[ConversationCache, Tuple[int, _Worker]]" = (
+            weakref.WeakKeyDictionary()
+        )
+        self._session_ids = count(1)
+        self._lock = threading.Lock()
+
+    def load(self):
+        first, *others = core_sets(self.workers)
+        try:
+            # the first worker converts the weights and stores a snapshot if
+            # needed, the others map it instead of converting again
+            self._workers = [_Worker(self.model_class, self.id, first)]
+            self._workers[0].loaded.future.result()
+            self._workers += [_Worker(self.model_class, self.id, cores) for cores in others]
+            infos = [worker.loaded.future.result() for worker in self._workers]
+        except BaseException:
+            self.unload()
+            raise
+        self.fingerprint = infos[0]["fingerprint"]
+        self._generation_defaults = infos[0]["generation_defaults"]
+        self.pool = GenerationPool(sum(info["concurrency"] for info in infos))
+
+    def unload(self):
+        self._stop_pool()
+        for worker in self._workers:
+            worker.close()
+        self._workers = []
+
+    def _pick(self, cache: Optional[ConversationCache] = None) -> Tuple[_Worker, Optional[int]]:
+        """The worker for a request and the session id of `cache`, counts the
+        request as in flight on the worker."""
+        deadline = time.monotonic() + READY_TIMEOUT
+        while True:
+            with self._lock:
+                session, worker = self._sessions.get(cache, (None, None)) if cache is not None else (None, None)
+                if worker is None or not worker.ready.is_set():
+                    ready = [worker for worker in self._workers if worker.ready.is_set()]
+                    worker = min(ready, key=lambda worker: worker.in_flight) if ready else None
+                if worker is not None:
+                    if cache is not None:
+                        if session is None:
+                            session = next(self._session_ids)
+                        if self._sessions.get(cache, (None, None))[1] is not worker:
+                            weakref.finalize(cache, worker.drop_session, session)
+                        self._sessions[cache] = (session, worker)
+                    worker.in_flight += 1
+                    return worker, session
+            if not self._workers:
+                raise RuntimeError(f"{self.id} is not loaded.")
+            if time.monotonic() > deadline:
+                raise RuntimeError(f"No worker process of {self.id} is running.")
+            time.sleep(0.1)
+
+    def _done(self, worker: _Worker):
+        with self._lock:
+            worker.in_flight -= 1
+
+    def _call(self, method: str, *args, **kwargs):
+        worker, _ = self._pick()
+        try:
+            _, future = worker.call(method, *args, **kwargs)
+            return future.result()
+        finally:
+            self._done(worker)
+
+    def _call_all(self, method: str, *args, **kwargs) -> list:
+        futures = [worker.call(method, *args, **kwargs)[1] for worker in self._workers]
+        return [future.result() for future in futures]
+
+    def warmup(self):
+        self._call_all("warmup")
+
+    def encode(self, text_inputs) -> List[int]:
+        return self._call("encode", text_inputs)
+
+    def count_message_tokens(self, message: dict) -> int:
+        return self._call("count_message_tokens", message)
+
+    def get_context_length(self) -> int:
+        return self._call("get_context_length")
+
+    def generation_defaults(self) -> dict:
+        return self._generation_defaults
+
+    def load_draft(self, id: str, tag: str = None):
+        """Load the draft in every worker, see `AssistedMixin.load_draft`."""
+        try:
+            self._call_all("load_draft", id, tag)
+        except BaseException:
+            self.unload_draft()
+            raise
+        self.draft_id = id
+
+    def unload_draft(self):
+        self._call_all("unload_draft")
+        self.draft_id = None
+
+    @property
+    def assisted_stats(self) -> AssistedStats:
+        """`AssistedStats` of all workers together."""
+        stats = [info["assisted_stats"] for info in self._call_all("info")]
+        return AssistedStats(
+            *(sum(getattr(s, field.name) for s in stats) for field in fields(AssistedStats))
+        )
+
+    def worker_stats(self) -> List[dict]:
+        """Per worker: its cores, the footprint of its model, its private
+        memory (bytes not shared with other processes) and its restarts."""
+        return [
+            {
+                "cores": worker.cores,
+                "footprint": info["footprint"],
+                "private_memory": info["private_memory"],
+                "restarts": worker.restarts,
+            }
+            for worker, info in zip(self._workers, self._call_all("info"))
+        ]
+
+    def memory_footprint(self) -> int:
+        """The model once, plus the memory of the other workers that is not
+        shared with the first."""
+        if not self._workers:
+            return 0
+        stats = self.worker_stats()
+        return stats[0]["footprint"] + sum(worker["private_memory"] for worker in stats[1:])
+
+    def generate(
+        self,
+        text_inputs,
+        stream=False,
+        cache: ConversationCache = None,
+        on_metrics=None,
+        handle: GenerationHandle = None,
+        **kwargs,
+    ):
+        """`generate` of the model, run by a worker process. `cache` only
+        identifies the conversation, its KV state stays in the worker."""
+        if not self._workers:
+            raise RuntimeError("The model must be loaded before generation.")
+        handle = handle or GenerationHandle()
+        streamer = IncrementalTextStreamer(None, handle=handle) if stream else None
+        requested = time.perf_counter()
+        waited = 0.0
+
+        def record(data: dict):
+            metrics = GenerationMetrics(**{field.name: data[field.name] for field in fields(GenerationMetrics)})
+            # the worker measured from when it got the request
+            metrics.queue_wait = (metrics.queue_wait or 0.0) + waited
+            if metrics.ttft is not None:
+                metrics.ttft += waited
+            if metrics.duration is not None:
+                metrics.duration += waited
+            generation_telemetry.record(metrics)
+            if on_metrics is not None:
+                on_metrics(metrics)
+
+        def run():
+            nonlocal waited
+            waited = time.perf_counter() - requested
+            worker, session = self._pick(cache)
+            try:
+                request_id, future = worker.call(
+                    "generate",
+                    text_inputs,
+                    stream=stream,
+                    session=session,
+                    on_chunk=streamer.on_finalized_text if stream else None,
+                    on_metrics=record,
+                    **kwargs,
+                )
+                handle.on_cancel(lambda: worker.cancel(request_id))
+                return future.result()
+            finally:
+                self._done(worker)
+                if stream:
+                    streamer.on_finalized_text("", stream_end=True)
+
+        def on_skip():
+            if stream:
+                streamer.on_finalized_text("", stream_end=True)
+
+        future = self._submit(run, handle, on_skip)
+        return streamer if stream else future.result()
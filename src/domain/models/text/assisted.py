@@ -0,0 +1,186 @@
+import os
+import threading
+import time
+from dataclasses import dataclass
+from typing import List
+
+from accelerate.utils import release_memory
+from transformers.generation.streamers import BaseStreamer
+
+from .quantization import model_memory_footprint
+from ..constants import MODELS_DIR
+
+
+@dataclass
+class AssistedStats:
+    """Counters of the generations run with a draft model.
+
+    Every target forward pass verifies the tokens proposed by the draft and
+    emits the accepted ones plus one token of its own, so
+    `new_tokens - target_passes` tokens came from the draft.
+    """
+
+    generations: int = 0
+    new_tokens: int = 0
+    target_passes: int = 0
+    draft_tokens: int = 0
+    elapsed: float = 0.0
+
+    @property
+    def accepted_tokens(self) -> int:
+        return max(0, self.new_tokens - self.target_passes)
+
+    @property
+    def acceptance_rate(self) -> float:
+        """Fraction of the draft tokens the target accepted."""
+        return self.accepted_tokens / self.draft_tokens if self.draft_tokens else 0.0
+
+    @property
+    def tokens_per_pass(self) -> float:
+        return self.new_tokens / self.target_passes if self.target_passes else 0.0
+
+    @property
+    def tokens_per_second(self) -> float:
+        return self.new_tokens / self.elapsed if self.elapsed else 0.0
+
+
+class _PassCounter(BaseStreamer):
+    """Forwards to `streamer` while counting the target forward passes.
+
+    Assisted generation puts the prompt first, then the tokens emitted by
+    each verification pass.
+    """
+
+    def __init__(self, streamer=None):
+        self.streamer = streamer
+        self.passes = 0
+        self.tokens = 0
+        self._prompt = True
+
+    def put(self, value):
+        if self._prompt:
+            self._prompt = False
+        else:
+            self.passes += 1
+            self.tokens += value.numel()
+        if self.streamer is not None:
+            self.streamer.put(value)
+
+    def end(self):
+        if self.streamer is not None:
+            self.streamer.end()
+
+
+def draft_compatibility(tokenizer, model, draft_tokenizer, draft_model) -> List[str]:
+    """Reasons why `draft_model` can't assist `model`, empty if it can."""
+    problems = []
+    if draft_model.config.is_encoder_decoder != model.config.is_encoder_decoder:
+        problems.append("the draft and target architectures differ (encoder-decoder vs decoder-only)")
+    if tokenizer.get_vocab() != draft_tokenizer.get_vocab():
+        problems.append("the draft uses a different tokenizer vocabulary")
+    for name in ("bos_token_id", "eos_token_id"):
+        if getattr(tokenizer, name) != getattr(draft_tokenizer, name):
+            problems.append(f"the tokenizers disagree on {name}")
+    if draft_model.config.get_text_config().vocab_size != model.config.get_text_config().vocab_size:
+        problems.append("the draft and target output vocabulary sizes differ")
+    return problems
+
+
+class AssistedMixin:
+    """Pairs the model with a small draft model for assisted generation.
+
+    The draft proposes a few tokens which the target verifies in a single
+    forward pass, so several tokens can be emitted per target pass while the
+    output stays the same as without the draft. The draft is owned by the
+    model, generations using it run one at a time.
+    """
+
+    draft_id = None
+    draft_tokenizer = None
+    draft_model = None
+
+    def _init_assisted(self):
+        self.assisted_stats = AssistedStats()
+        self._draft_lock = threading.Lock()
+        self._draft_forwards = 0
+        self._draft_hook = None
+
+    def load_draft(self, id: str, tag: str = None):
+        """Load `.models/<tag>/<id>` as draft model, `tag` defaults to the
+        target's. Raises `ValueError` if the draft is not compatible."""
+        if self.model is None:
+            raise RuntimeError("The target model must be loaded before its draft.")
+        if id == self.id and (tag or self.tag) == self.tag:
+            raise ValueError("A model can't be its own draft.")
+
+        path = os.path.join(MODELS_DIR, tag or self.tag, id)
+        draft_tokenizer, draft_model = self._load_pretrained(path)
+        problems = draft_compatibility(self.tokenizer, self.model, draft_tokenizer, draft_model)
+        if problems:
+            release_memory(draft_tokenizer, draft_model)
+            raise ValueError(f"{id} can't be used as draft for {self.id}: " + "; ".join(problems))
+
+        with self._draft_lock:
+            self._release_draft()
+            self.draft_id = id
+            self.draft_tokenizer, self.draft_model = draft_tokenizer, draft_model
+            self._draft_hook = draft_model.register_forward_hook(self._count_draft_forward)
+            self._num_assistant_tokens = draft_model.generation_config.num_assistant_tokens
+            self.assisted_stats = AssistedStats()
+        return self.draft_model
+
+    def _count_draft_forward(self, module, args, output):
+        # each draft forward pass proposes one token
+        self._draft_forwards += 1
+
+    def _release_draft(self):
+        if self._draft_hook is not None:
+            self._draft_hook.remove()
+            self._draft_hook = None
+        if self.draft_model is not None:
+            self.draft_tokenizer, self.draft_model = release_memory(
+                self.draft_tokenizer, self.draft_model
+            )
+        self.draft_id = None
+
+    def unload_draft(self):
+        with self._draft_lock:
+            self._release_draft()
+
+    def memory_footprint(self) -> int:
+        footprint = super().memory_footprint()
+        if self.draft_model is not None:
+            footprint += model_memory_footprint(self.draft_model)
+        return footprint
+
+    def _uses_draft(self, generation_kwargs) -> bool:
+        # assisted generation only supports a single sequence
+        return (
+            self.draft_model is not None
+            and (generation_kwargs.get("num_beams") or 1) == 1
+            and (generation_kwargs.get("num_return_sequences") or 1) == 1
+        )
+
+    def generate_assisted(self, **generation_kwargs):
+        """`model.generate` with the draft as assistant, updating `assisted_stats`."""
+        counter = _PassCounter(generation_kwargs.get("streamer"))
+        with self._draft_lock:
+            if self.draft_model is None:
+                # the draft was unloaded since the generation was routed here
+                return self.model.generate(**generation_kwargs)
+            generation_kwargs["streamer"] = counter
+            generation_kwargs["assistant_model"] = self.draft_model
+            # the candidate generator adapts the draft's number of tokens per
+            # pass in place, start every generation from the same value
+            self.draft_model.generation_config.num_assistant_tokens = self._num_assistant_tokens
+            self._draft_forwards = 0
+            start = time.perf_counter()
+            output = self.model.generate(**generation_kwargs)
+
+            stats = self.assisted_stats
+            stats.generations += 1
+            stats.new_tokens += counter.tokens
+            stats.target_passes += counter.passes
+            stats.draft_tokens += self._draft_forwards
+            stats.elapsed += time.perf_counter() - start
+        return output
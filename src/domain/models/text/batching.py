@@ -0,0 +1,205 @@
+import queue
+import threading
+import time
+from collections import deque
+from concurrent.futures import Future
+from typing import List, Optional
+
+from transformers.generation.streamers import BaseStreamer
+
+from .cancellation import GenerationHandle
+
+
+class BatchStreamer(BaseStreamer):
+    """Fans the tokens of a batched `generate` out to one streamer per row.
+
+    Padding is stripped from the prompt and a row's streamer is ended as
+    soon as that row produces an end-of-sequence token or its handle is
+    cancelled, so callers do not wait for the longest sequence of the batch.
+    """
+
+    def __init__(
+        self,
+        streamers: List[Optional[BaseStreamer]],
+        attention_mask,
+        eos_token_ids,
+        handles: Optional[List[Optional[GenerationHandle]]] = None,
+    ):
+        self.streamers = streamers
+        self.attention_mask = attention_mask
+        self.eos_token_ids = set(eos_token_ids)
+        self.handles = handles or [None] * len(streamers)
+        self.finished = [streamer is None for streamer in streamers]
+        self.prompt_sent = False
+
+    def put(self, value):
+        if not self.prompt_sent:
+            self.prompt_sent = True
+            for i, streamer in enumerate(self.streamers):
+                if streamer is not None:
+                    streamer.put(value[i][self.attention_mask[i].bool()])
+            return
+
+        for i, streamer in enumerate(self.streamers):
+            if self.finished[i]:
+                continue
+            handle = self.handles[i]
+            if handle is not None and handle.cancelled:
+                # the row only produces padding from now on
+                self.finished[i] = True
+                streamer.end()
+                continue
+            token = value[i : i + 1]
+            streamer.put(token)
+            if token.item() in self.eos_token_ids:
+                self.finished[i] = True
+                streamer.end()
+
+    def end(self):
+        for i, streamer in enumerate(self.streamers):
+            if not self.finished[i]:
+                self.finished[i] = True
+                streamer.end()
+
+
+class _Request:
+    def __init__(
+        self,
+        text_inputs: str,
+        streamer: Optional[BaseStreamer],
+        handle: Optional[GenerationHandle],
+        kwargs: dict,
+    ):
+        self.text_inputs = text_inputs
+        self.streamer = streamer
+        self.handle = handle
+        self.kwargs = kwargs
+        self.future = Future()
+        self.key = tuple(sorted((name, repr(value)) for name, value in kwargs.items()))
+
+
+class BatchScheduler:
+    """Groups concurrent generation requests on one model into padded batches.
+
+    The worker thread takes the oldest pending request, waits up to
+    `max_wait` seconds for more requests with the same generation kwargs and
+    runs them as a single `generate_batch` call of at most `max_batch_size`
+    prompts. Requests with other kwargs wait for a later batch. Like
+    `TextGenerationModel.generate`, a request resolves to its first sequence
+    when `num_return_sequences` is above one, streaming such requests is not
+    supported.
+    """
+
+    def __init__(self, model, max_batch_size: int = 8, max_wait: float = 0.01):
+        self.model = model
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait
+        self.batches = 0
+        self.batched_requests = 0
+        self._queue: "queue.Queue[Optional[_Request]]" = queue.Queue()
+        self._pending: "deque[_Request]" = deque()
+        self._closed = False
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    def submit(
+        self,
+        text_inputs: str,
+        streamer: Optional[BaseStreamer] = None,
+        handle: Optional[GenerationHandle] = None,
+        **kwargs,
+    ) -> Future:
+        """Queue a prompt, the returned future resolves to the generated text.
+        If a `streamer` is given it is fed with the tokens of this prompt only.
+        Cancelling `handle` drops the request if it is still queued and stops
+        its row of the batch otherwise (the future is then cancelled or
+        resolves to the text generated so far)."""
+        if self._closed:
+            raise RuntimeError("Batch scheduler is closed.")
+        request = _Request(text_inputs, streamer, handle, kwargs)
+        self._queue.put(request)
+        return request.future
+
+    def close(self):
+        self._closed = True
+        self._queue.put(None)
+
+    def _next_request(self, timeout: Optional[float]) -> Optional[_Request]:
+        if self._pending:
+            return self._pending.popleft()
+        try:
+            return self._queue.get(timeout=timeout)
+        except queue.Empty:
+            return None
+
+    def _collect(self, first: _Request) -> List[_Request]:
+        batch = [first]
+        skipped = []
+        deadline = time.monotonic() + self.max_wait
+        while len(batch) < self.max_batch_size:
+            if self._pending:
+                request = self._pending.popleft()
+            else:
+                timeout = deadline - time.monotonic()
+                if timeout <= 0:
+                    break
+                try:
+                    request = self._queue.get(timeout=timeout)
+                except queue.Empty:
+                    break
+            if request is None:
+                self._closed = True
+                break
+            if request.key == first.key:
+                batch.append(request)
+            else:
+                skipped.append(request)
+        self._pending.extendleft(reversed(skipped))
+        return batch
+
+    def _drop_cancelled(self, request: _Request) -> bool:
+        if request.handle is None or not request.handle.cancelled:
+            return False
+        if request.streamer is not None:
+            request.streamer.end()
+        request.future.cancel()
+        return True
+
+    def _run(self):
+        while True:
+            if self._closed and not self._pending and self._queue.empty():
+                return
+            first = self._next_request(timeout=None)
+            if first is None:
+                continue
+            batch = self._collect(first)
+            batch = [request for request in batch if not self._drop_cancelled(request)]
+            # an idle worker must not keep the requests of the last batch, their
+            # streamers and callbacks reference the sessions that sent them
+            del first
+            if batch:
+                self._run_batch(batch)
+            del batch
+
+    def _run_batch(self, batch: List[_Request]):
+        self.batches += 1
+        self.batched_requests += len(batch)
+        try:
+            texts = self.model.generate_batch(
+                [request.text_inputs for request in batch],
+                streamers=[request.streamer for request in batch],
+                handles=[request.handle for request in batch],
+                **batch[0].kwargs,
+            )
+        except Exception as e:
+            for request in batch:
+                if request.handle is not None:
+                    request.handle.fail(e)
+                if request.streamer is not None:
+                    request.streamer.end()
+                request.future.set_exception(e)
+            return
+        # with several return sequences each request owns consecutive rows
+        rows = len(texts) // len(batch)
+        for i, request in enumerate(batch):
+            request.future.set_result(texts[i * rows])
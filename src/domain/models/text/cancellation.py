@@ -0,0 +1,97 @@
+import threading
+from typing import Callable, List, Optional
+
+import torch
+from transformers import StoppingCriteria, StoppingCriteriaList
+
+
+class GenerationHandle:
+    """Cancellation flag of one generation.
+
+    `cancel` may be called from any thread, the decode loop running the
+    generation stops at its next step (or skips the request if it is still
+    queued). The code running the generation records a failure with `fail`
+    before ending its streamer, so consumers can tell it from a normal end.
+    The pool running it calls `finish` once it is over, whether it completed,
+    failed, was skipped or was rejected.
+    """
+
+    def __init__(self):
+        self._cancelled = threading.Event()
+        # requested length, to count the tokens a cancellation saved
+        self.max_new_tokens: Optional[int] = None
+        self._callbacks: List[Callable[[], None]] = []
+        self._finished = False
+        self._finish_callbacks: List[Callable[[], None]] = []
+        self._lock = threading.Lock()
+        self.error: Optional[BaseException] = None
+
+    def cancel(self):
+        with self._lock:
+            self._cancelled.set()
+            callbacks, self._callbacks = self._callbacks, []
+        for callback in callbacks:
+            callback()
+
+    def on_cancel(self, callback: Callable[[], None]):
+        """Call `callback` on `cancel`, right away if it was already called."""
+        with self._lock:
+            if not self._cancelled.is_set():
+                self._callbacks.append(callback)
+                return
+        callback()
+
+    @property
+    def cancelled(self) -> bool:
+        return self._cancelled.is_set()
+
+    def finish(self):
+        with self._lock:
+            if self._finished:
+                return
+            self._finished = True
+            callbacks, self._finish_callbacks = self._finish_callbacks, []
+        for callback in callbacks:
+            callback()
+
+    def on_finish(self, callback: Callable[[], None]):
+        """Call `callback` on `finish`, right away if it was already called."""
+        with self._lock:
+            if not self._finished:
+                self._finish_callbacks.append(callback)
+                return
+        callback()
+
+    @property
+    def finished(self) -> bool:
+        return self._finished
+
+    def fail(self, error: BaseException):
+        self.error = error
+
+    @property
+    def failed(self) -> bool:
+        return self.error is not None
+
+
+class CancelledCriteria(StoppingCriteria):
+    """Stops the rows of a `generate` call whose handle was cancelled."""
+
+    def __init__(self, handles: List[Optional[GenerationHandle]]):
+        self.handles = handles
+
+    def __call__(self, input_ids: torch.LongTensor, scores, **kwargs) -> torch.BoolTensor:
+        return torch.tensor(
+            [handle is not None and handle.cancelled for handle in self.handles],
+            dtype=torch.bool,
+            device=input_ids.device,
+        )
+
+
+def with_cancellation(generation_kwargs: dict, handles: List[Optional[GenerationHandle]]) -> dict:
+    """Add the check of `handles` (one per row) to the stopping criteria of
+    `generation_kwargs`, in place."""
+    criteria = StoppingCriteriaList(generation_kwargs.get("stopping_criteria") or [])
+    criteria.append(CancelledCriteria(handles))
+    generation_kwargs["stopping_criteria"] = criteria
+    return generation_kwargs
@@ -0,0 +1,152 @@
+import os
+import threading
+from contextlib import contextmanager, nullcontext
+from typing import Dict, List, Optional, Set
+
+import torch
+from transformers import StaticCache
+
+from .continuous_batching import _Sequence, max_new_tokens, unsupported_options
+from ..constants import CACHE_DIR
+
+
+# inductor writes its default into the environment on its first use, only a
+# value set before that is the user's
+_USER_CACHE_DIR = os.environ.get("TORCHINDUCTOR_CACHE_DIR")
+
+
+@contextmanager
+def _inductor_cache_dir(path: str):
+    """Point inductor at `path`, or at the user's `TORCHINDUCTOR_CACHE_DIR`,
+    and leave the environment as it was."""
+    previous = os.environ.get("TORCHINDUCTOR_CACHE_DIR")
+    os.environ["TORCHINDUCTOR_CACHE_DIR"] = _USER_CACHE_DIR or path
+    try:
+        yield
+    finally:
+        if previous is None:
+            os.environ.pop("TORCHINDUCTOR_CACHE_DIR", None)
+        else:
+            os.environ["TORCHINDUCTOR_CACHE_DIR"] = previous
+
+
+class StaticCacheGenerator:
+    """Single-sequence decode loop over preallocated static KV caches.
+
+    The cache length of a generation (prompt plus new tokens) is rounded up
+    to a bucket, and every bucket gets one `StaticCache` reused by all the
+    generations that fit it. The decode forward pass is `torch.compile`d
+    with static shapes, so there is one compiled graph per bucket, built by
+    the first generation in the bucket and kept for the lifetime of the
+    generator. The prompt is prefilled eagerly since its length varies.
+    Generations run one at a time.
+
+    The compiled kernels are kept under `CACHE_DIR` across restarts, unless
+    `TORCHINDUCTOR_CACHE_DIR` says otherwise. Inductor reads that variable
+    from the environment, so it is only set while a bucket compiles.
+    """
+
+    def __init__(self, model, buckets=(256, 512, 1024, 2048, 4096)):
+        self.model = model
+        max_length = getattr(model.config, "max_position_embeddings", None) or max(buckets)
+        self.buckets = [bucket for bucket in buckets if bucket <= max_length]
+        self._caches: Dict[int, StaticCache] = {}
+        self._lock = threading.Lock()
+        self._compiled: Set[int] = set()
+        self._cache_dir = os.path.abspath(os.path.join(CACHE_DIR, "inductor"))
+        self._decode = torch.compile(model.__call__, fullgraph=True, dynamic=False)
+
+    def bucket(self, length: int) -> Optional[int]:
+        """Smallest bucket holding `length` tokens, `None` if none does."""
+        for bucket in self.buckets:
+            if length <= bucket:
+                return bucket
+        return None
+
+    def fits(self, input_length: int, generation_config: dict) -> bool:
+        try:
+            new_tokens = max_new_tokens(input_length, generation_config)
+        except ValueError:
+            return False
+        return self.bucket(input_length + new_tokens) is not None
+
+    def _compiling(self, bucket: int):
+        """Context of a decode step of `bucket`, the first one compiles it."""
+        if bucket in self._compiled:
+            return nullcontext()
+        self._compiled.add(bucket)
+        return _inductor_cache_dir(self._cache_dir)
+
+    def _cache(self, bucket: int) -> StaticCache:
+        cache = self._caches.get(bucket)
+        if cache is None:
+            cache = StaticCache(
+                config=self.model.config,
+                max_cache_len=bucket,
+                device=self.model.device,
+                dtype=self.model.dtype,
+            )
+            self._caches[bucket] = cache
+        else:
+            cache.reset()
+        return cache
+
+    @torch.no_grad()
+    def generate(self, input_ids: List[int], streamer=None, **generation_config) -> List[int]:
+        """Generate for one prompt, returns the prompt and new token ids."""
+        sequence = _Sequence(input_ids, streamer, None, None, generation_config)
+        bucket = self.bucket(len(input_ids) + sequence.max_new_tokens)
+        if bucket is None:
+            raise ValueError(f"{len(input_ids)} + {sequence.max_new_tokens} tokens exceed the largest bucket")
+
+        device = self.model.device
+        with self._lock:
+            if streamer is not None:
+                streamer.put(torch.tensor(input_ids))
+            if not sequence.is_stopped():
+                cache = self._cache(bucket)
+                outputs = self.model(
+                    input_ids=torch.tensor([input_ids], device=device),
+                    past_key_values=cache,
+                    cache_position=torch.arange(len(input_ids), device=device),
+                    use_cache=True,
+                )
+                sequence.append_token(outputs.logits[0, -1])
+                while not sequence.is_finished():
+                    position = len(input_ids) + len(sequence.generated) - 1
+                    with self._compiling(bucket):
+                        outputs = self._decode(
+                            input_ids=torch.tensor([[sequence.next_token]], device=device),
+                            past_key_values=cache,
+                            cache_position=torch.tensor([position], device=device),
+                            use_cache=True,
+                        )
+                    sequence.append_token(outputs.logits[0, -1])
+        # like `generate`, a failed generation leaves the streamer to the
+        # caller, which records the failure before ending it
+        if streamer is not None:
+            streamer.end()
+        return input_ids + sequence.generated
+
+
+class CompiledGenerationMixin:
+    """Routes single-sequence generations of the model through a
+    `StaticCacheGenerator` when `compile_generation` is enabled."""
+
+    static_generator: StaticCacheGenerator = None
+
+    def _uses_static_cache(self, generation_kwargs) -> bool:
+        # the decode loop is the continuous batching one, with its options
+        return (
+            self.static_generator is not None
+            and not unsupported_options(generation_kwargs)
+            and self.static_generator.fits(generation_kwargs["input_ids"].shape[1], generation_kwargs)
+        )
+
+    def generate_static(self, input_ids, streamer=None, **generation_kwargs) -> torch.Tensor:
+        """Drop-in for `model.generate` on a single prompt."""
+        generation_kwargs.pop("attention_mask", None)
+        sequence_ids = self.static_generator.generate(
+            input_ids[0].tolist(), streamer, **generation_kwargs
+        )
+        return torch.tensor([sequence_ids], device=input_ids.device)
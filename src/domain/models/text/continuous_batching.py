@@ -0,0 +1,401 @@
+import queue
+import threading
+from concurrent.futures import CancelledError, Future
+from typing import Callable, List, Optional
+
+import torch
+import torch.nn.functional as F
+from transformers import DynamicCache, GenerationConfig, LogitsProcessorList
+from transformers.generation.logits_process import (
+    RepetitionPenaltyLogitsProcessor,
+    TemperatureLogitsWarper,
+    TopKLogitsWarper,
+    TopPLogitsWarper,
+)
+from transformers.generation.streamers import BaseStreamer
+
+from .cancellation import GenerationHandle
+
+_DEFAULTS = GenerationConfig().to_dict()
+# generation options implemented by `_Sequence`
+_SUPPORTED_OPTIONS = {
+    "max_new_tokens",
+    "max_length",
+    "min_new_tokens",
+    "min_length",
+    "eos_token_id",
+    "stopping_criteria",
+    "do_sample",
+    "temperature",
+    "top_k",
+    "top_p",
+    "repetition_penalty",
+}
+# options that don't change the generated tokens
+_IGNORED_OPTIONS = {
+    "input_ids",
+    "attention_mask",
+    "past_key_values",
+    "streamer",
+    "bos_token_id",
+    "pad_token_id",
+    "decoder_start_token_id",
+    "use_cache",
+    "cache_implementation",
+    "cache_config",
+    "return_legacy_cache",
+    "disable_compile",
+    "low_memory",
+    "transformers_version",
+    "_from_model_config",
+    # only used with an assistant model or prompt lookup, which are not supported
+    "num_assistant_tokens",
+    "num_assistant_tokens_schedule",
+    "assistant_confidence_threshold",
+    "assistant_lookbehind",
+    "target_lookbehind",
+    "max_matching_ngram_size",
+    "is_assistant",
+}
+# logits warpers `generate` only applies when sampling
+_SAMPLING_OPTIONS = {"min_p", "typical_p", "epsilon_cutoff", "eta_cutoff"}
+
+
+def unsupported_options(generation_config: dict) -> List[str]:
+    """Options of `generation_config` set to something else than their
+    default that `_Sequence` does not implement, `model.generate` must run
+    generations that have any."""
+    sampling = bool(generation_config.get("do_sample"))
+    return sorted(
+        name
+        for name, value in generation_config.items()
+        if name not in _SUPPORTED_OPTIONS
+        and name not in _IGNORED_OPTIONS
+        and (sampling or name not in _SAMPLING_OPTIONS)
+        and value != _DEFAULTS.get(name)
+    )
+
+
+def max_new_tokens(input_length: int, generation_config: dict) -> int:
+    """Most tokens `model.generate` adds to a prompt of `input_length`
+    tokens: `max_new_tokens`, or up to `max_length` tokens in total."""
+    if generation_config.get("max_new_tokens") is not None:
+        return generation_config["max_new_tokens"]
+    max_length = generation_config.get("max_length") or _DEFAULTS["max_length"]
+    if input_length >= max_length:
+        raise ValueError(
+            f"Input length of input_ids is {input_length}, but `max_length` is set to {max_length}."
+            " Increase `max_length` or set `max_new_tokens`."
+        )
+    return max_length - input_length
+
+
+def _layers(past_key_values: DynamicCache):
+    """The `(keys, values)` of each layer of `past_key_values`."""
+    return tuple((layer.keys, layer.values) for layer in past_key_values.layers)
+
+
+class _Sequence:
+    def __init__(
+        self,
+        input_ids: List[int],
+        streamer: Optional[BaseStreamer],
+        past_key_values: Optional[DynamicCache],
+        on_complete: Optional[Callable],
+        generation_config: dict,
+        handle: Optional[GenerationHandle] = None,
+    ):
+        self.input_ids = input_ids
+        self.streamer = streamer
+        self.handle = handle
+        self.past_key_values = past_key_values
+        self.on_complete = on_complete
+        self.future = Future()
+        self.generated: List[int] = []
+        self.start = 0
+
+        self.max_new_tokens = max_new_tokens(len(input_ids), generation_config)
+        # end of sequence is suppressed until then
+        self.min_new_tokens = max(
+            generation_config.get("min_new_tokens") or 0,
+            (generation_config.get("min_length") or 0) - len(input_ids),
+        )
+        # e.g. the cancellation check of the request
+        self.stopping_criteria = generation_config.get("stopping_criteria")
+        eos_token_id = generation_config.get("eos_token_id")
+        if eos_token_id is None:
+            eos_token_id = []
+        self.eos_token_ids = set(
+            eos_token_id if isinstance(eos_token_id, list) else [eos_token_id]
+        )
+
+        temperature = generation_config.get("temperature") or 1.0
+        top_k = generation_config.get("top_k") or 0
+        top_p = generation_config.get("top_p") or 1.0
+        repetition_penalty = generation_config.get("repetition_penalty") or 1.0
+        # a zero temperature from the UI means greedy decoding
+        self.do_sample = bool(generation_config.get("do_sample")) and temperature > 0
+
+        self.processors = LogitsProcessorList()
+        if repetition_penalty != 1.0:
+            self.processors.append(RepetitionPenaltyLogitsProcessor(repetition_penalty))
+        if self.do_sample:
+            if temperature != 1.0:
+                self.processors.append(TemperatureLogitsWarper(temperature))
+            if top_k > 0:
+                self.processors.append(TopKLogitsWarper(top_k))
+            if top_p < 1.0:
+                self.processors.append(TopPLogitsWarper(top_p))
+
+    def append_token(self, logits: torch.Tensor) -> int:
+        """Pick the next token from the last position `logits` and stream it."""
+        scores = logits.float()
+        if len(self.generated) < self.min_new_tokens and self.eos_token_ids:
+            eos = torch.tensor(sorted(self.eos_token_ids), device=scores.device)
+            scores = scores.index_fill(0, eos, -float("inf"))
+        if self.processors:
+            ids = torch.tensor([self.input_ids + self.generated], device=logits.device)
+            scores = self.processors(ids, scores[None])[0]
+        if self.do_sample:
+            token = torch.multinomial(F.softmax(scores, dim=-1), num_samples=1).item()
+        else:
+            token = scores.argmax().item()
+        self.generated.append(token)
+        if self.streamer is not None:
+            self.streamer.put(torch.tensor([token]))
+        return token
+
+    @property
+    def next_token(self) -> int:
+        return self.generated[-1]
+
+    def is_stopped(self) -> bool:
+        """Whether a stopping criterion ends the sequence."""
+        if not self.stopping_criteria:
+            return False
+        ids = torch.tensor([self.input_ids + self.generated])
+        return bool(self.stopping_criteria(ids, None).all())
+
+    def is_finished(self) -> bool:
+        return (
+            len(self.generated) >= self.max_new_tokens
+            or self.next_token in self.eos_token_ids
+            or self.is_stopped()
+        )
+
+
+class ContinuousBatchingEngine:
+    """Iteration-level batching decode loop shared by every sequence of a model.
+
+    A single worker thread owns the model: at each step it prefills the
+    newly submitted sequences and joins them to the running batch, runs one
+    batched decode forward pass and lets finished sequences leave. The KV
+    state of every running sequence lives in one left-padded batch (one
+    "slot" row per sequence) that is re-packed whenever sequences join or
+    leave. Each sequence keeps its own sampling settings and streamer, other
+    generation options are not supported (see `unsupported_options`).
+    """
+
+    def __init__(self, model, max_batch_size: int = 8):
+        self.model = model
+        self.max_batch_size = max_batch_size
+        self.steps = 0
+        self.tokens = 0
+        self._queue: "queue.Queue[Optional[_Sequence]]" = queue.Queue()
+        self._active: List[_Sequence] = []
+        self._kv = None
+        self._closed = False
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    def submit(
+        self,
+        input_ids: List[int],
+        streamer: Optional[BaseStreamer] = None,
+        past_key_values: Optional[DynamicCache] = None,
+        on_complete: Optional[Callable] = None,
+        handle: Optional[GenerationHandle] = None,
+        **generation_config,
+    ) -> Future:
+        """Queue a prompt, the returned future resolves to the generated token ids.
+
+        `past_key_values` may hold the KV state of a prefix of `input_ids`.
+        `on_complete(past_key_values, sequence_ids)` is called with the final
+        KV state once the sequence is done, or `(None, None)` if it failed.
+        A failure is recorded on `handle` before `streamer` is ended.
+        """
+        if self._closed:
+            raise RuntimeError("Continuous batching engine is closed.")
+        sequence = _Sequence(
+            input_ids, streamer, past_key_values, on_complete, generation_config, handle
+        )
+        self._queue.put(sequence)
+        return sequence.future
+
+    def close(self):
+        self._closed = True
+        self._queue.put(None)
+
+    def _run(self):
+        while not (self._closed and not self._active and self._queue.empty()):
+            self._admit(block=not self._active)
+            if self._active:
+                try:
+                    self._decode_step()
+                except Exception as e:
+                    for sequence in self._active:
+                        self._finish(sequence, error=e)
+                    self._active, self._kv = [], None
+
+    def _admit(self, block: bool):
+        while len(self._active) < self.max_batch_size:
+            try:
+                sequence = self._queue.get(block=block)
+            except queue.Empty:
+                return
+            if sequence is None:
+                return
+            block = False
+            try:
+                self._prefill(sequence)
+            except Exception as e:
+                self._finish(sequence, error=e)
+
+    @torch.no_grad()
+    def _prefill(self, sequence: _Sequence):
+        # the prompt is streamed once the sequence leaves the queue, as `generate` does
+        if sequence.streamer is not None:
+            sequence.streamer.put(torch.tensor(sequence.input_ids))
+        if sequence.is_stopped():
+            # cancelled while queued, skip the prefill
+            self._finish(sequence, error=CancelledError())
+            return
+        past_key_values = sequence.past_key_values or DynamicCache(config=self.model.config)
+        cached = past_key_values.get_seq_length()
+        input_ids = torch.tensor([sequence.input_ids[cached:]], device=self.model.device)
+        outputs = self.model(
+            input_ids=input_ids, past_key_values=past_key_values, use_cache=True
+        )
+        self._append_token(sequence, outputs.logits[0, -1])
+        if sequence.is_finished():
+            sequence.past_key_values = past_key_values
+            self._finish(sequence)
+        else:
+            self._join(sequence, _layers(past_key_values))
+
+    def _cache(self, kv) -> DynamicCache:
+        """A `DynamicCache` of the model holding the `(keys, values)` of each
+        layer in `kv`."""
+        past_key_values = DynamicCache(config=self.model.config)
+        for layer_idx, (keys, values) in enumerate(kv):
+            past_key_values.update(keys, values, layer_idx)
+        return past_key_values
+
+    def _append_token(self, sequence: _Sequence, logits: torch.Tensor):
+        sequence.append_token(logits)
+        self.tokens += 1
+
+    def _join(self, sequence: _Sequence, kv):
+        length = kv[0][0].shape[2]
+        if self._kv is None:
+            self._kv, sequence.start = kv, 0
+        else:
+            width = self._kv[0][0].shape[2]
+            if length > width:
+                self._kv = self._pad_left(self._kv, length - width)
+                for other in self._active:
+                    other.start += length - width
+                width = length
+            kv = self._pad_left(kv, width - length)
+            sequence.start = width - length
+            self._kv = tuple(
+                (torch.cat([keys, new_keys]), torch.cat([values, new_values]))
+                for (keys, values), (new_keys, new_values) in zip(self._kv, kv)
+            )
+        self._active.append(sequence)
+
+    def _pad_left(self, kv, padding: int):
+        if padding == 0:
+            return kv
+        return tuple(
+            (F.pad(keys, (0, 0, padding, 0)), F.pad(values, (0, 0, padding, 0)))
+            for keys, values in kv
+        )
+
+    @torch.no_grad()
+    def _decode_step(self):
+        device = self.model.device
+        width = self._kv[0][0].shape[2]
+        starts = torch.tensor([sequence.start for sequence in self._active], device=device)
+        input_ids = torch.tensor(
+            [[sequence.next_token] for sequence in self._active], device=device
+        )
+        attention_mask = (
+            torch.arange(width + 1, device=device)[None, :] >= starts[:, None]
+        ).long()
+        outputs = self.model(
+            input_ids=input_ids,
+            attention_mask=attention_mask,
+            position_ids=(width - starts)[:, None],
+            cache_position=torch.tensor([width], device=device),
+            past_key_values=self._cache(self._kv),
+            use_cache=True,
+        )
+        self._kv = _layers(outputs.past_key_values)
+        self.steps += 1
+
+        finished = []
+        for row, sequence in enumerate(self._active):
+            self._append_token(sequence, outputs.logits[row, -1])
+            if sequence.is_finished():
+                finished.append(row)
+        if finished:
+            self._leave(finished)
+
+    def _leave(self, rows: List[int]):
+        for row in rows:
+            sequence = self._active[row]
+            sequence.past_key_values = self._cache(
+                tuple(
+                    (keys[row : row + 1, :, sequence.start :], values[row : row + 1, :, sequence.start :])
+                    for keys, values in self._kv
+                )
+            )
+            self._finish(sequence)
+
+        keep = [row for row in range(len(self._active)) if row not in rows]
+        self._active = [self._active[row] for row in keep]
+        if not self._active:
+            self._kv = None
+            return
+
+        # drop the columns that are padding for every remaining sequence
+        offset = min(sequence.start for sequence in self._active)
+        index = torch.tensor(keep, device=self._kv[0][0].device)
+        self._kv = tuple(
+            (
+                keys.index_select(0, index)[:, :, offset:],
+                values.index_select(0, index)[:, :, offset:],
+            )
+            for keys, values in self._kv
+        )
+        for sequence in self._active:
+            sequence.start -= offset
+
+    def _finish(self, sequence: _Sequence, error: Exception = None):
+        # a sequence cancelled while queued did not fail
+        if error is not None and not isinstance(error, CancelledError) and sequence.handle:
+            sequence.handle.fail(error)
+        if sequence.streamer is not None:
+            sequence.streamer.end()
+        if sequence.on_complete is not None:
+            if error is None:
+                sequence.on_complete(
+                    sequence.past_key_values, sequence.input_ids + sequence.generated
+                )
+            else:
+                sequence.on_complete(None, None)
+        if error is None:
+            sequence.future.set_result(sequence.generated)
+        else:
+            sequence.future.set_exception(error)
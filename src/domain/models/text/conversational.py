@@ -1,19 +1,204 @@
-from transformers import TextIteratorStreamer
+from typing import List
+import torch
+from transformers import DynamicCache
+from .assisted import AssistedMixin
+from .cancellation import GenerationHandle, with_cancellation
+from .compiled import CompiledGenerationMixin, StaticCacheGenerator
+from .continuous_batching import ContinuousBatchingEngine, unsupported_options
+from .kv_cache import ConversationCache
+from .prefix_cache import PrefixCache
 from .shared import LoadUnloadMixin, StreamMixin
+from .streaming import IncrementalTextStreamer
+from ..constants import COMPILED_GENERATION, CONTINUOUS_BATCHING, CPU_LOAD_MODE, LoadMode
 from ..huggingface_model import HuggingFaceModel
 
 
-class ConversationalModel(LoadUnloadMixin, StreamMixin, HuggingFaceModel):
-    def __init__(self, id: str):
+class ConversationalModel(
+    AssistedMixin, CompiledGenerationMixin, LoadUnloadMixin, StreamMixin, HuggingFaceModel
+):
+    def __init__(
+        self,
+        id: str,
+        continuous_batching=CONTINUOUS_BATCHING,
+        load_mode: LoadMode = CPU_LOAD_MODE,
+        compile_generation=COMPILED_GENERATION,
+    ):
         super().__init__(id, "conversational")
         self.tokenizer = None
         self.model = None
+        self.load_mode = load_mode
+        # all generations of the model share one decode loop when enabled
+        self.continuous_batching = continuous_batching
+        self.engine: ContinuousBatchingEngine = None
+        # KV states of common conversation preambles, shared by all sessions
+        self.prefix_cache = PrefixCache()
+        self._message_overheads = {}
+        # generations run one by one through a compiled decode step, without
+        # KV reuse across turns
+        self.compile_generation = compile_generation
+        self._init_assisted()
+
+    def load(self):
+        super().load()
+        if self.continuous_batching:
+            self.engine = ContinuousBatchingEngine(self.model)
+        if self.compile_generation:
+            self.static_generator = StaticCacheGenerator(self.model)
+        batched = self.engine is not None and self.static_generator is None
+        self._start_pool(self.engine.max_batch_size if batched else None)
+        return self.tokenizer, self.model
+
+    def unload(self):
+        self._stop_pool()
+        if self.engine is not None:
+            self.engine.close()
+            self.engine = None
+        self.prefix_cache.clear()
+        self._message_overheads = {}
+        self.static_generator = None
+        self.unload_draft()
+        super().unload()
+
+    def warmup(self):
+        self.generate([{"role": "user", "content": "Hello"}], max_new_tokens=2, do_sample=False)
+
+    def get_context_length(self) -> int:
+        return getattr(self.model.config, "max_position_embeddings", None) or min(
+            self.tokenizer.model_max_length, 4096
+        )
+
+    def count_message_tokens(self, message: dict) -> int:
+        """Number of tokens `message` takes in the chat template, the template
+        overhead per role is measured once."""
+        role = message["role"]
+        if role not in self._message_overheads:
+            templated = self.tokenizer.apply_chat_template(
+                [{"role": role, "content": "x"}], tokenize=True, return_dict=True
+            )["input_ids"]
+            content = self.tokenizer.encode("x", add_special_tokens=False)
+            self._message_overheads[role] = max(0, len(templated) - len(content))
+        content_tokens = self.tokenizer.encode(message["content"], add_special_tokens=False)
+        return len(content_tokens) + self._message_overheads[role]
+
+    def _prefix_token_ids(self, text_inputs, input_ids):
+        """Token ids of the chat template preamble and system message, if the
+        conversation starts with them."""
+        if not text_inputs or text_inputs[0]["role"] != "system":
+            return None
+        prefix = self.tokenizer.apply_chat_template(
+            text_inputs[:1], tokenize=True, return_dict=True
+        )["input_ids"]
+        if len(prefix) >= len(input_ids) or input_ids[: len(prefix)] != prefix:
+            return None
+        return prefix
+
+    def _seed_from_prefix_cache(self, text_inputs, input_ids, cache: ConversationCache):
+        """Start an acquired `cache` without reusable state from the prefix
+        cache. Runs on the pool worker of the generation, like the prefill of
+        the prefix on a miss."""
+        if cache.reused_tokens > 0:
+            return
+        length, past_key_values = self.prefix_cache.lookup(input_ids[:-1], self.model.config)
+        if past_key_values is None:
+            prefix = self._prefix_token_ids(text_inputs, input_ids)
+            if prefix is None:
+                return
+            past_key_values = DynamicCache(config=self.model.config)
+            with torch.no_grad():
+                self.model(
+                    input_ids=torch.tensor([prefix], device=self.model.device),
+                    past_key_values=past_key_values,
+                    use_cache=True,
+                )
+            self.prefix_cache.insert(prefix, past_key_values)
+            length = len(prefix)
+        cache.seed(past_key_values, input_ids[:length])
+
+    def _from_prefix_cache(self, generate_fn, text_inputs, input_ids, cache: ConversationCache):
+        """`generate_fn` continuing from the KV state of `cache`, seeded from the
+        prefix cache first."""
+
+        def generate(**generation_kwargs):
+            self._seed_from_prefix_cache(text_inputs, input_ids, cache)
+            return generate_fn(**{**generation_kwargs, "past_key_values": cache.past_key_values})
+
+        return generate
+
+    def _on_complete(self, cache: ConversationCache):
+        """Callback recording the output of `generate` in `cache`, if any."""
+        if cache is None:
+            return None
+        return lambda output: cache.release(output.sequences[0].tolist() if output else None)
+
+    def _generate_with_engine(
+        self,
+        text_inputs,
+        input_ids,
+        cache: ConversationCache,
+        stream,
+        generation_config,
+        on_metrics=None,
+        handle: GenerationHandle = None,
+    ):
+        streamer = None
+        if stream:
+            streamer = IncrementalTextStreamer(
+                self.tokenizer,
+                skip_prompt=True,
+                handle=handle,
+                skip_special_tokens=True,
+            )
+
+        def on_complete(past_key_values, sequence_ids):
+            if past_key_values is not None:
+                cache.past_key_values = past_key_values
+            cache.release(sequence_ids)
+
+        tracked = self._track(streamer, stream, on_metrics, handle)
+        with_cancellation(generation_config, [handle])
+
+        def generate():
+            # the worker holds its slot of the pool until the sequence is done
+            try:
+                self._seed_from_prefix_cache(text_inputs, input_ids, cache)
+                future = self.engine.submit(
+                    input_ids,
+                    tracked,
+                    past_key_values=cache.past_key_values,
+                    on_complete=on_complete,
+                    handle=handle,
+                    **generation_config,
+                )
+            except Exception as e:
+                cache.release(None)
+                handle.fail(e)
+                tracked.end()
+                raise
+            return future.result()
+
+        def on_skip():
+            tracked.end()
+            cache.release(None)
+
+        try:
+            future = self._submit(generate, handle, on_skip)
+        except Exception:
+            cache.release(None)
+            raise
+
+        if stream:
+            return streamer
+        return self.tokenizer.decode(future.result(), skip_special_tokens=True)
+
+    def encode(self, text_inputs) -> List[int]:
+        return self._prepare_inputs(text_inputs)["input_ids"][0].tolist()
 
     def _prepare_inputs(self, text_inputs: str):
         return self.tokenizer.apply_chat_template(
             text_inputs,
             add_generation_prompt=True,
             return_tensors="pt",
+            return_dict=True,
             tokenize=True,
         )
 
@@ -21,29 +206,103 @@ class ConversationalModel(LoadUnloadMixin, StreamMixin, HuggingFaceModel):
         self,
         text_inputs: str,
         stream=False,
+        cache: ConversationCache = None,
+        on_metrics=None,
+        handle: GenerationHandle = None,
         **kwargs,
     ):
+        """Generate the next assistant message of the `text_inputs` conversation.
+
+        When a `cache` is given, its KV state for the common prefix with the
+        previous turn is reused and it is updated with the new turn. A
+        conversation without reusable state starts from the longest prefix in
+        `prefix_cache`, the system preamble is computed and stored on a miss;
+        without a `cache`, a single-sequence generation uses a throwaway one for
+        this. Beam search and multiple return sequences reuse no KV state.
+        `on_metrics` is called with the `GenerationMetrics` of the generation.
+        Cancelling `handle`, or the returned streamer (`streamer.cancel()`),
+        stops the generation.
+        """
         if self.tokenizer is None or self.model is None:
             raise RuntimeError("Tokenizer and model must be loaded before generation.")
 
         model_inputs = self._prepare_inputs(text_inputs).to(self.model.device)
         config_kwargs = self.model.generation_config.to_dict()
         generation_kwargs = {
-            "input_ids": model_inputs,
+            **model_inputs,
             **config_kwargs,
             **kwargs,
         }
+        handle = handle or GenerationHandle()
+        handle.max_new_tokens = generation_kwargs.get("max_new_tokens")
+
+        use_draft = self._uses_draft(generation_kwargs)
+        use_static = not use_draft and self._uses_static_cache(generation_kwargs)
+        # beam search and multiple return sequences expand the batch, the
+        # single-row KV states of earlier turns and prefixes don't fit it
+        single_sequence = (generation_kwargs.get("num_beams") or 1) == 1 and (
+            generation_kwargs.get("num_return_sequences") or 1
+        ) == 1
+        engine_config = {**config_kwargs, **kwargs}
+        # options the decode loop does not implement fall back to `model.generate`
+        use_engine = (
+            self.engine is not None
+            and not use_draft
+            and not use_static
+            and not unsupported_options(engine_config)
+        )
+        if use_draft:
+            generate_fn = self.generate_assisted
+        elif use_static:
+            generate_fn = self.generate_static
+        else:
+            generate_fn = self.model.generate
 
+        if use_static or not single_sequence:
+            # the static caches cannot adopt the KV states of earlier turns either
+            cache = None
+        elif cache is None:
+            # only used to start from the prefix cache
+            cache = ConversationCache()
+
+        if cache is not None:
+            input_ids = model_inputs["input_ids"][0].tolist()
+            cache.acquire(input_ids)
+            if use_engine:
+                return self._generate_with_engine(
+                    text_inputs, input_ids, cache, stream, engine_config, on_metrics, handle
+                )
+
+            generate_fn = self._from_prefix_cache(generate_fn, text_inputs, input_ids, cache)
+            generation_kwargs["return_dict_in_generate"] = True
+
+        on_complete = self._on_complete(cache)
+        with_cancellation(generation_kwargs, [handle])
         if stream:
-            streamer = TextIteratorStreamer(
+            streamer = IncrementalTextStreamer(
                 self.tokenizer,
                 skip_prompt=True,
+                handle=handle,
                 skip_special_tokens=True,
             )
-            return self.stream_message(streamer, generation_kwargs)
+            return self.stream_message(
+                streamer,
+                generation_kwargs,
+                on_complete,
+                generate_fn=generate_fn,
+                on_metrics=on_metrics,
+            )
         else:
-            input_len = model_inputs.shape[1]
-            generated_ids = self.model.generate(**generation_kwargs)
+            input_len = model_inputs["input_ids"].shape[1]
+            output = None
+            try:
+                output = self.generate_tracked(
+                    generate_fn, generation_kwargs, on_metrics, handle
+                )
+            finally:
+                if on_complete is not None:
+                    on_complete(output)
+            generated_ids = output.sequences if cache is not None else output
             new_tokens = generated_ids[:, input_len:]
             text = self.tokenizer.batch_decode(new_tokens, skip_special_tokens=True)[0]
             return text
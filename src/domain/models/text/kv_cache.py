@@ -0,0 +1,70 @@
+import threading
+from typing import List, Optional
+
+from transformers import DynamicCache
+
+
+class ConversationCache:
+    """KV state of a single conversation, reused from one turn to the next.
+
+    `token_ids` are the tokens whose keys/values are held in
+    `past_key_values`. Before a generation the cache is cropped to the
+    longest common prefix with the new prompt, so only the tokens appended
+    since the last turn are prefilled; any edit of the history simply
+    shortens that prefix. Generations on the same conversation are
+    serialized, the cache is mutated in place by `generate`.
+    """
+
+    def __init__(self):
+        self.past_key_values: Optional[DynamicCache] = None
+        self.token_ids: List[int] = []
+        self.reused_tokens = 0
+        self._in_use = threading.Lock()
+
+    def reset(self):
+        with self._in_use:
+            self.past_key_values = None
+            self.token_ids = []
+
+    def _common_prefix_length(self, input_ids: List[int]) -> int:
+        length = 0
+        for cached, new in zip(self.token_ids, input_ids):
+            if cached != new:
+                break
+            length += 1
+        return length
+
+    def acquire(self, input_ids: List[int]) -> DynamicCache:
+        """Lock the cache for a generation on `input_ids` and return the
+        `past_key_values` to pass to `model.generate`."""
+        self._in_use.acquire()
+        # at least one prompt token must be left for the forward pass
+        reusable = min(self._common_prefix_length(input_ids), len(input_ids) - 1)
+        if self.past_key_values is None or reusable <= 0:
+            self.past_key_values = DynamicCache()
+            self.token_ids = []
+            reusable = 0
+        elif reusable < self.past_key_values.get_seq_length():
+            self.past_key_values.crop(reusable)
+            self.token_ids = self.token_ids[:reusable]
+        self.reused_tokens = reusable
+        return self.past_key_values
+
+    def seed(self, past_key_values: DynamicCache, token_ids: List[int]):
+        """Start an empty, acquired cache from a precomputed KV state of `token_ids`."""
+        self.past_key_values = past_key_values
+        self.token_ids = list(token_ids)
+        self.reused_tokens = len(token_ids)
+
+    def release(self, sequence_ids: Optional[List[int]] = None):
+        """Record the tokens held by the cache after the generation of
+        `sequence_ids` (prompt + new tokens). Without them, e.g. when the
+        generation failed, the cache is dropped."""
+        try:
+            if sequence_ids is None:
+                self.past_key_values = None
+                self.token_ids = []
+            else:
+                self.token_ids = sequence_ids[: self.past_key_values.get_seq_length()]
+        finally:
+            self._in_use.release()
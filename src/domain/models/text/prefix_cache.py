@@ -0,0 +1,116 @@
+import threading
+import time
+from typing import Dict, List, Optional, Tuple
+
+from transformers import DynamicCache, PretrainedConfig
+
+
+class _TrieNode:
+    __slots__ = ("children", "kv", "size", "last_used")
+
+    def __init__(self):
+        self.children: Dict[int, "_TrieNode"] = {}
+        self.kv = None
+        self.size = 0
+        self.last_used = 0.0
+
+
+class PrefixCache:
+    """KV states of token-id prefixes shared by every conversation of a model.
+
+    Prefixes are stored in a trie so that `lookup` finds the longest cached
+    prefix of a prompt in a single walk. The stored tensors are never handed
+    out: every hit returns a fresh copy that the caller may extend. Once the
+    stored KV states exceed `max_bytes`, the least recently used ones are
+    dropped.
+    """
+
+    def __init__(self, max_bytes: int = 128 * 1024**2):
+        self.max_bytes = max_bytes
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self._root = _TrieNode()
+        self._lock = threading.Lock()
+
+    def lookup(
+        self, token_ids: List[int], config: Optional[PretrainedConfig] = None
+    ) -> Tuple[int, Optional[DynamicCache]]:
+        """Returns the length of the longest cached prefix of `token_ids` and a
+        copy of its KV state, a `DynamicCache` for the model `config`, `(0, None)`
+        on a miss."""
+        with self._lock:
+            node, best, best_length = self._root, None, 0
+            for length, token_id in enumerate(token_ids, start=1):
+                node = node.children.get(token_id)
+                if node is None:
+                    break
+                if node.kv is not None:
+                    best, best_length = node, length
+
+            if best is None:
+                self.misses += 1
+                return 0, None
+            self.hits += 1
+            best.last_used = time.time()
+            past_key_values = DynamicCache(config=config)
+            # `update` copies the stored tensors into the new cache
+            for layer_idx, (keys, values) in enumerate(best.kv):
+                past_key_values.update(keys, values, layer_idx)
+        return best_length, past_key_values
+
+    def insert(self, token_ids: List[int], past_key_values: DynamicCache):
+        """Store the KV state of the first `len(token_ids)` positions of
+        `past_key_values`."""
+        length = len(token_ids)
+        kv = tuple(
+            (layer.keys[:, :, :length].clone(), layer.values[:, :, :length].clone())
+            for layer in past_key_values.layers
+        )
+        size = sum(key.nbytes + value.nbytes for key, value in kv)
+        if size > self.max_bytes:
+            return
+
+        with self._lock:
+            node = self._root
+            for token_id in token_ids:
+                node = node.children.setdefault(token_id, _TrieNode())
+            self.size += size - node.size
+            node.kv, node.size, node.last_used = kv, size, time.time()
+            self._evict()
+
+    def _nodes(self):
+        """Every node with its parent, parents first."""
+        nodes = [(self._root, None, None)]
+        for node, _, _ in nodes:
+            nodes.extend(
+                (child, node, token_id) for token_id, child in node.children.items()
+            )
+        return nodes
+
+    def _evict(self):
+        if self.size <= self.max_bytes:
+            return
+        nodes = self._nodes()
+        stored = sorted(
+            (node for node, _, _ in nodes if node.kv is not None),
+            key=lambda node: node.last_used,
+        )
+        for node in stored:
+            if self.size <= self.max_bytes:
+                break
+            self.size -= node.size
+            node.kv, node.size = None, 0
+
+        # drop the branches left without any KV state, children first
+        for node, parent, token_id in reversed(nodes):
+            if parent is not None and node.kv is None and not node.children:
+                del parent.children[token_id]
+
+    def clear(self):
+        with self._lock:
+            self._root = _TrieNode()
+            self.size = 0
+
+    def stats(self) -> dict:
+        return {"hits": self.hits, "misses": self.misses, "size": self.size}
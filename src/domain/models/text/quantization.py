@@ -0,0 +1,114 @@
+import gc
+import warnings
+
+import torch
+from torch import nn
+from transformers import AutoModelForCausalLM, PreTrainedModel
+
+from ..constants import LoadMode
+
+
+def quantizable_linears(model: PreTrainedModel):
+    """Names of the Linear layers to quantize, the output head is kept in full
+    precision since its errors go straight into the logits."""
+    head = model.get_output_embeddings()
+    return [
+        name
+        for name, module in model.named_modules()
+        if isinstance(module, nn.Linear) and module is not head
+    ]
+
+
+def release_checkpoint(model: PreTrainedModel):
+    """Copy the float weights left after quantization (embeddings, norms,
+    head) out of the memory-mapped checkpoint they may be views of. The
+    mapping otherwise stays alive, with every page the quantization read
+    still resident."""
+    copies = {}
+    with torch.no_grad():
+        for tensor in list(model.parameters()) + list(model.buffers()):
+            # tied weights share one copy
+            key = tensor.data_ptr()
+            if key not in copies:
+                copies[key] = tensor.data.clone()
+            tensor.data = copies[key]
+    # the replaced float layers are only reachable through reference cycles
+    gc.collect()
+
+
+def _quantize_int8(model: PreTrainedModel) -> PreTrainedModel:
+    from torch.ao.quantization import per_channel_dynamic_qconfig, quantize_dynamic
+
+    qconfig_spec = {name: per_channel_dynamic_qconfig for name in quantizable_linears(model)}
+    with warnings.catch_warnings():
+        # eager-mode quantization is deprecated upstream in favour of torchao
+        warnings.simplefilter("ignore")
+        quantize_dynamic(model, qconfig_spec, dtype=torch.qint8, inplace=True)
+
+    release_checkpoint(model)
+    return model
+
+
+def _quantize_int4(model: PreTrainedModel, group_size=128) -> PreTrainedModel:
+    try:
+        from torchao.quantization import Int4WeightOnlyConfig, quantize_
+    except ImportError as e:
+        raise ImportError(
+            "The int4 load mode requires torchao: pip install torchao"
+        ) from e
+
+    names = set(quantizable_linears(model))
+    quantize_(
+        model,
+        Int4WeightOnlyConfig(group_size=group_size),
+        filter_fn=lambda module, name: name in names,
+    )
+    return model
+
+
+def load_cpu_model(path: str, load_mode: LoadMode = "fp32") -> PreTrainedModel:
+    """Load a causal LM for CPU inference.
+
+    - `fp32`: weights as stored, upcast to float32.
+    - `bf16`: bfloat16 weights and activations, half the memory of fp32.
+    - `int8`: float32 model whose Linear layers use int8 weights with
+      dynamically quantized activations.
+    - `int4`: bfloat16 model with int4 weight-only Linear layers (torchao).
+    """
+    if load_mode == "fp32":
+        return AutoModelForCausalLM.from_pretrained(path, dtype=torch.float32)
+    if load_mode == "bf16":
+        return AutoModelForCausalLM.from_pretrained(path, dtype=torch.bfloat16)
+    if load_mode == "int8":
+        model = AutoModelForCausalLM.from_pretrained(path, dtype=torch.float32)
+        return _quantize_int8(model)
+    if load_mode == "int4":
+        model = AutoModelForCausalLM.from_pretrained(path, dtype=torch.bfloat16)
+        return _quantize_int4(model)
+    raise ValueError(f"Unknown load mode: {load_mode}")
+
+
+def model_memory_footprint(model: PreTrainedModel) -> int:
+    """Bytes held by the weights and buffers of `model`.
+
+    `get_memory_footprint` only sees parameters and buffers, the packed
+    weights of dynamically quantized layers live in the state dict only.
+    """
+    seen = set()
+    total = 0
+
+    def add(tensor):
+        nonlocal total
+        try:
+            key = (tensor.untyped_storage().data_ptr(), tensor.storage_offset())
+        except (RuntimeError, NotImplementedError):
+            key = id(tensor)
+        if key not in seen:
+            seen.add(key)
+            total += tensor.numel() * tensor.element_size()
+
+    for value in model.state_dict(keep_vars=True).values():
+        for tensor in value if isinstance(value, tuple) else (value,):
+            if isinstance(tensor, torch.Tensor):
+                add(tensor)
+    return total
@@ -1,34 +1,174 @@
-from threading import Thread
-from transformers import AutoModelForCausalLM, AutoTokenizer, TextIteratorStreamer
+import hashlib
+import warnings
+from concurrent.futures import Future
+from transformers import AutoModelForCausalLM, AutoTokenizer
 from torch import cuda
 from accelerate.utils import release_memory
+from .quantization import load_cpu_model, model_memory_footprint
+from .snapshots import files_fingerprint, load_snapshot, needs_snapshot, save_snapshot
+from .streaming import IncrementalTextStreamer
+from .telemetry import GenerationMetrics, MetricsStreamer, generation_telemetry
+from .worker_pool import GenerationPool, QueueFullError
+from ..constants import CPU_LOAD_MODE, GENERATION_WORKERS, WEIGHT_SNAPSHOTS, LoadMode
 
 
 class LoadUnloadMixin:
-    def load(self):
-        self.tokenizer = AutoTokenizer.from_pretrained(self.path, padding_side="left")
+    fingerprint = None
+    # only applies without CUDA, GPUs always load 8-bit weights
+    load_mode: LoadMode = CPU_LOAD_MODE
+    # keep converted CPU weights next to the model so later loads map them
+    use_snapshots = WEIGHT_SNAPSHOTS
+
+    def _compute_fingerprint(self) -> str:
+        """Identify the files the model was loaded from and how it was loaded."""
+        fingerprint = files_fingerprint(self.path)
+        if cuda.is_available():
+            return fingerprint
+        # the load mode changes the computed logits
+        return hashlib.sha256(f"{fingerprint}:{self.load_mode}".encode()).hexdigest()
+
+    def _load_cpu_model(self, path: str):
+        if not self.use_snapshots:
+            return load_cpu_model(path, self.load_mode)
+
+        model = load_snapshot(path, self.load_mode)
+        if model is None:
+            model = load_cpu_model(path, self.load_mode)
+            if needs_snapshot(path, self.load_mode):
+                try:
+                    save_snapshot(model, path, self.load_mode)
+                except OSError as e:
+                    warnings.warn(f"Could not store a snapshot of {path}: {e}")
+        return model
+
+    def _load_pretrained(self, path: str):
+        tokenizer = AutoTokenizer.from_pretrained(path, padding_side="left")
 
         if cuda.is_available():
             from transformers import BitsAndBytesConfig
 
             quantization_config = BitsAndBytesConfig(load_in_8bit=True)
-            self.model = AutoModelForCausalLM.from_pretrained(
-                self.path, device_map="auto", quantization_config=quantization_config
+            model = AutoModelForCausalLM.from_pretrained(
+                path, device_map="auto", quantization_config=quantization_config
             )
         else:
-            self.model = AutoModelForCausalLM.from_pretrained(self.path)
+            model = self._load_cpu_model(path)
+
+        return tokenizer, model
 
+    def load(self):
+        self.fingerprint = self._compute_fingerprint()
+        self.tokenizer, self.model = self._load_pretrained(self.path)
         return self.tokenizer, self.model
 
     def unload(self):
-        release_memory(self.tokenizer, self.model)
+        self.tokenizer, self.model = release_memory(self.tokenizer, self.model)
+
+    def memory_footprint(self) -> int:
+        if self.model is None:
+            return 0
+        return model_memory_footprint(self.model)
 
 
 class StreamMixin:
-    def stream_message(self, streamer, generation_kwargs) -> TextIteratorStreamer:
-        generation_kwargs["streamer"] = streamer
-        thread = Thread(
-            target=self.model.generate, kwargs=generation_kwargs, daemon=True
+    # runs the generations of the loaded model, see `_start_pool`
+    pool: GenerationPool = None
+
+    def _start_pool(self, batch_size: int = None):
+        """Bound the generations running at once to `GENERATION_WORKERS`, or
+        by default to the `batch_size` of the model's batching decode loop
+        (one generation at a time without one)."""
+        self.pool = GenerationPool(GENERATION_WORKERS or batch_size or 1)
+
+    def _stop_pool(self):
+        if self.pool is not None:
+            self.pool.close()
+            self.pool = None
+
+    def generation_defaults(self) -> dict:
+        """The generation config of the loaded model."""
+        return self.model.generation_config.to_dict()
+
+    def _submit(self, fn, handle=None, on_skip=None) -> Future:
+        """Run `fn` on the model's pool, see `GenerationPool.submit`."""
+        try:
+            return self.pool.submit(fn, handle, on_skip)
+        except QueueFullError:
+            generation_telemetry.record_rejection(self.id, self.tag)
+            raise
+
+    def _track(self, streamer=None, stream=True, on_metrics=None, handle=None) -> MetricsStreamer:
+        """Wrap `streamer` to measure the generation it is fed by. The metrics
+        go to `generation_telemetry` and to `on_metrics`, if given. `handle`
+        is the `GenerationHandle` of the generation, to count cancellations."""
+
+        def on_finish(metrics: GenerationMetrics):
+            generation_telemetry.record(metrics)
+            if on_metrics is not None:
+                on_metrics(metrics)
+
+        return MetricsStreamer(
+            GenerationMetrics(self.id, self.tag, stream), streamer, on_finish, handle
         )
-        thread.start()
+
+    def stream_message(
+        self, streamer, generation_kwargs, on_complete=None, generate_fn=None, on_metrics=None
+    ) -> IncrementalTextStreamer:
+        """Run `model.generate` (or `generate_fn`) on the model's pool feeding
+        `streamer`, which can cancel it.
+
+        `on_complete` is called from the worker with the output of `generate`,
+        or with `None` if the generation failed or was skipped.
+        """
+        tracker = self._track(streamer, on_metrics=on_metrics, handle=streamer.handle)
+        generation_kwargs["streamer"] = tracker
+        generate_fn = generate_fn or self.model.generate
+
+        def generate():
+            output = None
+            try:
+                output = generate_fn(**generation_kwargs)
+            except Exception as e:
+                warnings.warn(f"Generation with {self.id} failed: {e}")
+                # unblock the consumer instead of leaving it waiting forever
+                streamer.handle.fail(e)
+                streamer.end()
+                raise
+            finally:
+                if on_complete is not None:
+                    on_complete(output)
+            return output
+
+        def skip():
+            # cancelled while queued
+            tracker.end()
+            if on_complete is not None:
+                on_complete(None)
+
+        try:
+            self._submit(generate, streamer.handle, skip)
+        except QueueFullError:
+            if on_complete is not None:
+                on_complete(None)
+            raise
         return streamer
+
+    def generate_tracked(self, generate_fn, generation_kwargs, on_metrics=None, handle=None):
+        """Call `generate_fn(**generation_kwargs)` on the model's pool, wait
+        for it and record its metrics."""
+        tracker = self._track(stream=False, on_metrics=on_metrics, handle=handle)
+
+        def generate():
+            if (generation_kwargs.get("num_beams") or 1) == 1:
+                return generate_fn(**generation_kwargs, streamer=tracker)
+
+            # beam search takes no streamer, only the totals are measured
+            input_ids = generation_kwargs["input_ids"]
+            tracker.put(input_ids)
+            output = generate_fn(**generation_kwargs)
+            sequences = getattr(output, "sequences", output)
+            tracker.put(sequences[0, input_ids.shape[1] :])
+            tracker.end()
+            return output
+
+        return self._submit(generate, handle, tracker.end).result()
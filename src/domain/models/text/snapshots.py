@@ -0,0 +1,128 @@
+import hashlib
+import json
+import os
+import shutil
+import tempfile
+import warnings
+from typing import Optional
+
+import torch
+import transformers
+from accelerate import init_empty_weights
+from transformers import AutoConfig, AutoModelForCausalLM, PreTrainedModel
+
+from .quantization import quantizable_linears, release_checkpoint
+from ..constants import LoadMode
+
+SNAPSHOTS_DIR = ".snapshots"
+METADATA_FILE = "snapshot.json"
+INT8_WEIGHTS_FILE = "model-int8.pt"
+
+
+def files_fingerprint(path: str) -> str:
+    """Identify the files of a model directory by name, size and mtime."""
+    digest = hashlib.sha256()
+    for name in sorted(os.listdir(path)):
+        file_path = os.path.join(path, name)
+        if os.path.isfile(file_path):
+            stat = os.stat(file_path)
+            digest.update(f"{name}:{stat.st_size}:{stat.st_mtime_ns};".encode())
+    return digest.hexdigest()
+
+
+def snapshot_path(path: str, load_mode: LoadMode) -> str:
+    return os.path.join(path, SNAPSHOTS_DIR, load_mode)
+
+
+def needs_snapshot(path: str, load_mode: LoadMode) -> bool:
+    """Whether loading `path` in `load_mode` converts the weights.
+
+    fp32 safetensors are memory-mapped as they are, other modes cast or
+    quantize every weight and `.bin` checkpoints are unpickled into fresh
+    memory.
+    """
+    if load_mode == "int4":
+        # torchao tensor subclasses have no stable serialization yet
+        return False
+    if load_mode != "fp32":
+        return True
+    return not any(name.endswith(".safetensors") for name in os.listdir(path))
+
+
+def _metadata(path: str, load_mode: LoadMode) -> dict:
+    return {
+        "source": files_fingerprint(path),
+        "load_mode": load_mode,
+        "torch": torch.__version__,
+        "transformers": transformers.__version__,
+    }
+
+
+def _load_int8(path: str, snapshot: str) -> PreTrainedModel:
+    from torch.ao.nn.quantized.dynamic import Linear as DynamicQuantizedLinear
+
+    config = AutoConfig.from_pretrained(path)
+    # parameters stay on the meta device until the snapshot tensors are
+    # assigned, buffers computed at init (e.g. rotary frequencies) are real
+    with init_empty_weights(include_buffers=False):
+        model = AutoModelForCausalLM.from_config(config, dtype=torch.float32)
+    with warnings.catch_warnings():
+        warnings.simplefilter("ignore")
+        for name in quantizable_linears(model):
+            parent_name, _, child_name = name.rpartition(".")
+            parent = model.get_submodule(parent_name)
+            linear = getattr(parent, child_name)
+            # built 1x1 since the constructor packs a zero weight of the full
+            # size, the real weight is packed when the state dict is loaded
+            quantized = DynamicQuantizedLinear(
+                1, 1, bias_=linear.bias is not None, dtype=torch.qint8
+            )
+            quantized.in_features = linear.in_features
+            quantized.out_features = linear.out_features
+            setattr(parent, child_name, quantized)
+        state_dict = torch.load(
+            os.path.join(snapshot, INT8_WEIGHTS_FILE), mmap=True, weights_only=True
+        )
+        model.load_state_dict(state_dict, assign=True)
+    del state_dict
+    model.tie_weights()
+    release_checkpoint(model)
+    return model.eval()
+
+
+def load_snapshot(path: str, load_mode: LoadMode) -> Optional[PreTrainedModel]:
+    """Load the converted snapshot of `path`, `None` if there is none or it is
+    stale (the model files or the library versions changed)."""
+    snapshot = snapshot_path(path, load_mode)
+    try:
+        with open(os.path.join(snapshot, METADATA_FILE)) as f:
+            metadata = json.load(f)
+    except (FileNotFoundError, json.JSONDecodeError):
+        return None
+    if metadata != _metadata(path, load_mode):
+        return None
+
+    if load_mode == "int8":
+        return _load_int8(path, snapshot)
+    dtype = torch.bfloat16 if load_mode == "bf16" else torch.float32
+    return AutoModelForCausalLM.from_pretrained(snapshot, dtype=dtype)
+
+
+def save_snapshot(model: PreTrainedModel, path: str, load_mode: LoadMode):
+    """Store `model`, loaded from `path` in `load_mode`, so the next load maps
+    the converted weights instead of converting again."""
+    snapshot = snapshot_path(path, load_mode)
+    os.makedirs(os.path.dirname(snapshot), exist_ok=True)
+    # written aside and renamed so concurrent loads never see a partial snapshot
+    tmp = tempfile.mkdtemp(prefix=f".{load_mode}-", dir=os.path.dirname(snapshot))
+    try:
+        if load_mode == "int8":
+            torch.save(model.state_dict(), os.path.join(tmp, INT8_WEIGHTS_FILE))
+        else:
+            model.save_pretrained(tmp, safe_serialization=True)
+        with open(os.path.join(tmp, METADATA_FILE), "w") as f:
+            json.dump(_metadata(path, load_mode), f)
+        shutil.rmtree(snapshot, ignore_errors=True)
+        os.replace(tmp, snapshot)
+    finally:
+        shutil.rmtree(tmp, ignore_errors=True)
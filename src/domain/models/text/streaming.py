@@ -0,0 +1,121 @@
+import asyncio
+import queue
+from typing import List, Optional
+
+from transformers import TextIteratorStreamer
+
+from .cancellation import GenerationHandle
+
+
+class IncrementalTextStreamer(TextIteratorStreamer):
+    """Drop-in `TextIteratorStreamer` that decodes incrementally.
+
+    `TextIteratorStreamer` re-decodes every token since the last space or
+    newline on each new token, which is quadratic within long lines, code
+    and text without spaces. This streamer decodes each new token together
+    with the few tokens before it (`lookback`) and emits the difference, so
+    the cost per token does not grow with the output. Decoding with context
+    keeps the spaces that tokenizers merge into the next token, and a token
+    ending in an incomplete multi-byte character (decoded as U+FFFD) is held
+    back until the following tokens complete it.
+
+    `cancel()` stops the generation feeding the streamer through `handle`,
+    `failed` tells whether it ended because the generation failed.
+    Besides `for`, the text can be consumed with `async for`, which waits
+    for the next chunk without blocking the event loop.
+    """
+
+    def __init__(
+        self,
+        tokenizer,
+        skip_prompt=False,
+        timeout=None,
+        lookback=5,
+        handle: Optional[GenerationHandle] = None,
+        **decode_kwargs,
+    ):
+        super().__init__(tokenizer, skip_prompt, timeout, **decode_kwargs)
+        self.lookback = lookback
+        self.handle = handle or GenerationHandle()
+        # already emitted context tokens, then the tokens not emitted yet
+        self._ids: List[int] = []
+        self._read_offset = 0
+        # set by `async for`, woken up on every chunk
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
+        self._ready: Optional[asyncio.Event] = None
+
+    def cancel(self):
+        self.handle.cancel()
+
+    @property
+    def cancelled(self) -> bool:
+        return self.handle.cancelled
+
+    @property
+    def failed(self) -> bool:
+        return self.handle.failed
+
+    def _decode(self, ids: List[int]) -> str:
+        return self.tokenizer.decode(ids, **self.decode_kwargs)
+
+    def put(self, value):
+        if len(value.shape) > 1 and value.shape[0] > 1:
+            raise ValueError("IncrementalTextStreamer only supports batch size 1")
+        elif len(value.shape) > 1:
+            value = value[0]
+
+        if self.skip_prompt and self.next_tokens_are_prompt:
+            self.next_tokens_are_prompt = False
+            # the end of the prompt is the context of the first new tokens
+            self._ids = value.tolist()[-self.lookback :]
+            self._read_offset = len(self._ids)
+            return
+        self.next_tokens_are_prompt = False
+
+        self._ids.extend(value.tolist())
+        context_text = self._decode(self._ids[: self._read_offset])
+        text = self._decode(self._ids)
+        if text.endswith("�"):
+            return
+        # the last tokens are the context of the next ones, even if they were
+        # emitted earlier: the last chunk may decode to nothing (special tokens)
+        self._ids = self._ids[-self.lookback :]
+        self._read_offset = len(self._ids)
+        if len(text) > len(context_text):
+            self.on_finalized_text(text[len(context_text) :])
+
+    def end(self):
+        text = ""
+        if len(self._ids) > self._read_offset:
+            context_text = self._decode(self._ids[: self._read_offset])
+            text = self._decode(self._ids)[len(context_text) :]
+        self._ids = []
+        self._read_offset = 0
+        self.next_tokens_are_prompt = True
+        self.on_finalized_text(text, stream_end=True)
+
+    def on_finalized_text(self, text: str, stream_end: bool = False):
+        super().on_finalized_text(text, stream_end)
+        if self._loop is not None:
+            try:
+                self._loop.call_soon_threadsafe(self._ready.set)
+            except RuntimeError:
+                # the loop was closed, nobody is reading anymore
+                pass
+
+    def __aiter__(self):
+        self._ready = asyncio.Event()
+        self._loop = asyncio.get_running_loop()
+        return self
+
+    async def __anext__(self) -> str:
+        while True:
+            try:
+                value = self.text_queue.get_nowait()
+            except queue.Empty:
+                await self._ready.wait()
+                self._ready.clear()
+                continue
+            if value == self.stop_signal:
+                raise StopAsyncIteration()
+            return value
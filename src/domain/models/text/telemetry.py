@@ -0,0 +1,280 @@
+import json
+import multiprocessing
+import threading
+import time
+import warnings
+from collections import deque
+from dataclasses import asdict, dataclass, field
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Callable, Dict, List, Optional, Tuple
+
+import psutil
+from transformers.generation.streamers import BaseStreamer
+
+from .cancellation import GenerationHandle
+from ..constants import GENERATION_METRICS_LOG, METRICS_PORT
+
+# upper bounds (seconds) of the latency histogram buckets
+LATENCY_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+
+
+def _rss() -> int:
+    return psutil.Process().memory_info().rss
+
+
+@dataclass
+class GenerationMetrics:
+    """Performance of one generation, times in seconds.
+
+    `queue_wait` is the time until the model started on the request,
+    `ttft` the time until its first new token and `duration` until its
+    last, all from the call to `generate`. `memory_delta` is the change of
+    the process RSS over the generation, which includes concurrent ones.
+    A `cancelled` generation stopped early, `saved_tokens` of the requested
+    tokens were not generated.
+    """
+
+    model_id: str
+    task: str
+    stream: bool
+    timestamp: float = field(default_factory=time.time)
+    prompt_tokens: int = 0
+    new_tokens: int = 0
+    queue_wait: Optional[float] = None
+    ttft: Optional[float] = None
+    duration: Optional[float] = None
+    memory_delta: int = 0
+    cancelled: bool = False
+    saved_tokens: int = 0
+
+    @property
+    def tokens_per_second(self) -> float:
+        """New tokens over the time the model worked on the request."""
+        if not self.duration or not self.new_tokens:
+            return 0.0
+        return self.new_tokens / max(self.duration - (self.queue_wait or 0.0), 1e-9)
+
+    def to_dict(self) -> dict:
+        return {**asdict(self), "tokens_per_second": self.tokens_per_second}
+
+
+class MetricsStreamer(BaseStreamer):
+    """Measures a generation from the tokens it streams and forwards them to
+    `streamer`, if any.
+
+    Every generation path puts the prompt first, when the model starts on
+    the request, then the new tokens. `on_finish` gets the metrics on `end`.
+    """
+
+    def __init__(
+        self,
+        metrics: GenerationMetrics,
+        streamer: Optional[BaseStreamer] = None,
+        on_finish: Optional[Callable[[GenerationMetrics], None]] = None,
+        handle: Optional[GenerationHandle] = None,
+    ):
+        self.metrics = metrics
+        self.streamer = streamer
+        self.on_finish = on_finish
+        self.handle = handle
+        self._requested = time.perf_counter()
+        self._rss = _rss()
+        self._prompt_sent = False
+        self._finished = False
+
+    def put(self, value):
+        elapsed = time.perf_counter() - self._requested
+        if not self._prompt_sent:
+            self._prompt_sent = True
+            self.metrics.prompt_tokens = value.numel()
+            self.metrics.queue_wait = elapsed
+        else:
+            if self.metrics.ttft is None:
+                self.metrics.ttft = elapsed
+            self.metrics.new_tokens += value.numel()
+        if self.streamer is not None:
+            self.streamer.put(value)
+
+    def end(self):
+        # recorded before the consumer is unblocked, so it can read the metrics
+        if not self._finished:
+            self._finished = True
+            self.metrics.duration = time.perf_counter() - self._requested
+            self.metrics.memory_delta = _rss() - self._rss
+            if self.handle is not None and self.handle.cancelled:
+                self.metrics.cancelled = True
+                if self.handle.max_new_tokens:
+                    self.metrics.saved_tokens = max(
+                        0, self.handle.max_new_tokens - self.metrics.new_tokens
+                    )
+            if self.on_finish is not None:
+                self.on_finish(self.metrics)
+        if self.streamer is not None:
+            self.streamer.end()
+
+
+class _Histogram:
+    def __init__(self, buckets=LATENCY_BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * len(buckets)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value: float):
+        for i, bound in enumerate(self.buckets):
+            if value <= bound:
+                self.counts[i] += 1
+        self.sum += value
+        self.count += 1
+
+
+class _Totals:
+    def __init__(self):
+        self.requests = 0
+        self.prompt_tokens = 0
+        self.new_tokens = 0
+        self.cancelled = 0
+        self.saved_tokens = 0
+        self.rejected = 0
+        self.histograms = {
+            "queue_wait": _Histogram(),
+            "ttft": _Histogram(),
+            "duration": _Histogram(),
+        }
+
+    def add(self, metrics: GenerationMetrics):
+        self.requests += 1
+        self.prompt_tokens += metrics.prompt_tokens
+        self.new_tokens += metrics.new_tokens
+        self.cancelled += metrics.cancelled
+        self.saved_tokens += metrics.saved_tokens
+        for name, histogram in self.histograms.items():
+            value = getattr(metrics, name)
+            if value is not None:
+                histogram.observe(value)
+
+
+def _labels(**labels) -> str:
+    def escape(value) -> str:
+        return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+    return "{" + ",".join(f'{name}="{escape(value)}"' for name, value in labels.items()) + "}"
+
+
+class GenerationTelemetry:
+    """Collects the metrics of every generation of the process.
+
+    The latest ones are kept for display, totals and latency histograms
+    per model are exported in the Prometheus text format, and every record
+    is appended to `log_path` as a JSON line if set.
+    """
+
+    def __init__(self, log_path: Optional[str] = None, history: int = 256):
+        self.log_path = log_path
+        self._recent: "deque[GenerationMetrics]" = deque(maxlen=history)
+        self._totals: Dict[Tuple[str, str], _Totals] = {}
+        self._lock = threading.Lock()
+        self._server: Optional[ThreadingHTTPServer] = None
+
+    def record(self, metrics: GenerationMetrics):
+        with self._lock:
+            self._recent.append(metrics)
+            self._totals.setdefault((metrics.model_id, metrics.task), _Totals()).add(metrics)
+            if self.log_path:
+                try:
+                    with open(self.log_path, "a") as f:
+                        f.write(json.dumps(metrics.to_dict()) + "\n")
+                except OSError as e:
+                    warnings.warn(f"Could not write generation metrics to {self.log_path}: {e}")
+
+    def record_rejection(self, model_id: str, task: str):
+        """Count a generation that was refused because the model was busy."""
+        with self._lock:
+            self._totals.setdefault((model_id, task), _Totals()).rejected += 1
+
+    def recent(self, model_id: Optional[str] = None) -> List[GenerationMetrics]:
+        """The latest metrics, oldest first, optionally of one model only."""
+        with self._lock:
+            return [m for m in self._recent if model_id is None or m.model_id == model_id]
+
+    def prometheus(self) -> str:
+        """All totals in the Prometheus text exposition format."""
+        with self._lock:
+            totals = sorted(self._totals.items())
+            lines = []
+            for name, attribute, help in (
+                ("generation_requests_total", "requests", "Finished generations."),
+                ("generation_prompt_tokens_total", "prompt_tokens", "Prompt tokens processed."),
+                ("generation_new_tokens_total", "new_tokens", "Tokens generated."),
+                ("generation_cancelled_total", "cancelled", "Generations cancelled before the end."),
+                (
+                    "generation_saved_tokens_total",
+                    "saved_tokens",
+                    "Requested tokens not generated thanks to cancellations.",
+                ),
+                ("generation_rejected_total", "rejected", "Generations refused because the queue was full."),
+            ):
+                lines += [f"# HELP {name} {help}", f"# TYPE {name} counter"]
+                for (model_id, task), total in totals:
+                    lines.append(f"{name}{_labels(model=model_id, task=task)} {getattr(total, attribute)}")
+
+            for histogram_name, help in (
+                ("queue_wait", "Time until the model started on the request."),
+                ("ttft", "Time to the first new token."),
+                ("duration", "Time to the last new token."),
+            ):
+                name = f"generation_{histogram_name}_seconds"
+                lines += [f"# HELP {name} {help}", f"# TYPE {name} histogram"]
+                for (model_id, task), total in totals:
+                    histogram = total.histograms[histogram_name]
+                    for bound, count in zip(histogram.buckets, histogram.counts):
+                        labels = _labels(model=model_id, task=task, le=bound)
+                        lines.append(f"{name}_bucket{labels} {count}")
+                    labels = _labels(model=model_id, task=task, le="+Inf")
+                    lines.append(f"{name}_bucket{labels} {histogram.count}")
+                    labels = _labels(model=model_id, task=task)
+                    lines.append(f"{name}_sum{labels} {histogram.sum:.6f}")
+                    lines.append(f"{name}_count{labels} {histogram.count}")
+
+        lines += [
+            "# HELP process_resident_memory_bytes Resident memory size in bytes.",
+            "# TYPE process_resident_memory_bytes gauge",
+            f"process_resident_memory_bytes {_rss()}",
+        ]
+        return "\n".join(lines) + "\n"
+
+    def serve(self, port: int, host: str = "127.0.0.1"):
+        """Serve `prometheus()` at http://host:port/metrics from a daemon
+        thread. Does nothing if already serving."""
+        if self._server is not None:
+            return
+        telemetry = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                if self.path.split("?")[0] != "/metrics":
+                    self.send_error(404)
+                    return
+                body = telemetry.prometheus().encode()
+                self.send_response(200)
+                self.send_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                pass
+
+        self._server = ThreadingHTTPServer((host, port), Handler)
+        threading.Thread(target=self._server.serve_forever, daemon=True).start()
+
+
+generation_telemetry = GenerationTelemetry(GENERATION_METRICS_LOG or None)
+
+# model worker processes leave serving to the app process
+if METRICS_PORT and multiprocessing.parent_process() is None:
+    try:
+        generation_telemetry.serve(METRICS_PORT)
+    except OSError as e:
+        # e.g. another process of the app already serves the port
+        warnings.warn(f"Could not serve generation metrics on port {METRICS_PORT}: {e}")
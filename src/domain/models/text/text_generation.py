@@ -1,42 +1,196 @@
-from transformers import TextIteratorStreamer
+from typing import List
+from .assisted import AssistedMixin
+from .batching import BatchScheduler, BatchStreamer
+from .cancellation import GenerationHandle, with_cancellation
+from .compiled import CompiledGenerationMixin, StaticCacheGenerator
 from .shared import LoadUnloadMixin, StreamMixin
+from .streaming import IncrementalTextStreamer
+from ..constants import COMPILED_GENERATION, CPU_LOAD_MODE, LoadMode
 from ..huggingface_model import HuggingFaceModel
 
 
-class TextGenerationModel(LoadUnloadMixin, StreamMixin, HuggingFaceModel):
-    def __init__(self, id: str):
+class TextGenerationModel(
+    AssistedMixin, CompiledGenerationMixin, LoadUnloadMixin, StreamMixin, HuggingFaceModel
+):
+    def __init__(
+        self,
+        id: str,
+        batching=True,
+        load_mode: LoadMode = CPU_LOAD_MODE,
+        compile_generation=COMPILED_GENERATION,
+    ):
         super().__init__(id, "text-generation")
         self.tokenizer = None
         self.model = None
+        self.load_mode = load_mode
+        # concurrent prompts are grouped into padded batches by the scheduler
+        self.batching = batching
+        self.scheduler: BatchScheduler = None
+        # prompts run one by one through a compiled decode step instead
+        self.compile_generation = compile_generation
+        self._init_assisted()
+
+    def load(self):
+        super().load()
+        if self.tokenizer.pad_token is None:
+            self.tokenizer.pad_token = self.tokenizer.eos_token
+        if self.batching:
+            self.scheduler = BatchScheduler(self)
+        if self.compile_generation:
+            self.static_generator = StaticCacheGenerator(self.model)
+        batched = self.scheduler is not None and self.static_generator is None
+        self._start_pool(self.scheduler.max_batch_size if batched else None)
+        return self.tokenizer, self.model
+
+    def unload(self):
+        self._stop_pool()
+        if self.scheduler is not None:
+            self.scheduler.close()
+            self.scheduler = None
+        self.static_generator = None
+        self.unload_draft()
+        super().unload()
+
+    def warmup(self):
+        self.generate("Hello", max_new_tokens=2, do_sample=False)
 
     def _prepare_inputs(self, text_inputs: str):
         return self.tokenizer(text_inputs, return_tensors="pt")
 
+    def encode(self, text_inputs: str) -> List[int]:
+        return self._prepare_inputs(text_inputs)["input_ids"][0].tolist()
+
+    def _eos_token_ids(self, generation_kwargs) -> List[int]:
+        eos_token_id = generation_kwargs.get("eos_token_id")
+        if eos_token_id is None:
+            eos_token_id = self.tokenizer.eos_token_id
+        if eos_token_id is None:
+            return []
+        return eos_token_id if isinstance(eos_token_id, list) else [eos_token_id]
+
+    def generate_batch(
+        self, text_inputs: List[str], streamers=None, handles=None, skip_prompt=False, **kwargs
+    ) -> List[str]:
+        """Generate for several prompts in one left-padded batch.
+
+        `streamers` and `handles` optionally hold one streamer and one
+        `GenerationHandle` (or `None`) per prompt, a cancelled row stops.
+        With `skip_prompt`, only the generated continuations are returned.
+        """
+        model_inputs = self.tokenizer(text_inputs, return_tensors="pt", padding=True).to(
+            self.model.device
+        )
+        config_kwargs = self.model.generation_config.to_dict()
+        generation_kwargs = {
+            **model_inputs,
+            **config_kwargs,
+            **kwargs,
+            "pad_token_id": self.tokenizer.pad_token_id,
+        }
+        if handles and any(handle is not None for handle in handles):
+            with_cancellation(generation_kwargs, handles)
+        if streamers and any(streamer is not None for streamer in streamers):
+            generation_kwargs["streamer"] = BatchStreamer(
+                streamers,
+                model_inputs["attention_mask"],
+                self._eos_token_ids(generation_kwargs),
+                handles,
+            )
+
+        generated_ids = self.model.generate(**generation_kwargs)
+        if skip_prompt:
+            # left padding puts every prompt before the same position
+            generated_ids = generated_ids[:, model_inputs["input_ids"].shape[1] :]
+        return self.tokenizer.batch_decode(generated_ids, skip_special_tokens=True)
+
     def generate(
         self,
         text_inputs: str,
         stream=False,
+        on_metrics=None,
+        handle: GenerationHandle = None,
         **kwargs,
     ):
+        """Generate a continuation of `text_inputs`, see `StreamMixin._track`
+        for `on_metrics`.
+
+        Cancelling `handle`, or the returned streamer (`streamer.cancel()`),
+        stops the generation.
+        """
         if self.tokenizer is None or self.model is None:
             raise RuntimeError("Tokenizer and model must be loaded before generation.")
 
-        model_inputs = self._prepare_inputs(text_inputs).to(self.model.device)
         config_kwargs = self.model.generation_config.to_dict()
+        use_draft = self._uses_draft({**config_kwargs, **kwargs})
+        beam_search = ({**config_kwargs, **kwargs}.get("num_beams") or 1) > 1
+        # the batch rows of the scheduler map one to one to its requests
+        single_sequence = ({**config_kwargs, **kwargs}.get("num_return_sequences") or 1) == 1
+        handle = handle or GenerationHandle()
+        handle.max_new_tokens = {**config_kwargs, **kwargs}.get("max_new_tokens")
+
+        if (
+            self.scheduler is not None
+            and single_sequence
+            and not use_draft
+            and self.static_generator is None
+        ):
+            streamer = None
+            if stream:
+                streamer = IncrementalTextStreamer(
+                    self.tokenizer,
+                    skip_prompt=False,
+                    handle=handle,
+                    skip_special_tokens=True,
+                )
+            tracked = streamer
+            if not beam_search:
+                # beam search takes no streamer, such batches go unmeasured
+                tracked = self._track(streamer, stream, on_metrics, handle)
+
+            def on_skip():
+                if tracked is not None:
+                    tracked.end()
+
+            def generate():
+                # the worker holds its slot of the pool until the batch row is done
+                try:
+                    future = self.scheduler.submit(text_inputs, tracked, handle, **kwargs)
+                except Exception as e:
+                    handle.fail(e)
+                    on_skip()
+                    raise
+                return future.result()
+
+            future = self._submit(generate, handle, on_skip)
+            return streamer if stream else future.result()
+
+        model_inputs = self._prepare_inputs(text_inputs).to(self.model.device)
         generation_kwargs = {
             **model_inputs,
             **config_kwargs,
             **kwargs,
         }
+        with_cancellation(generation_kwargs, [handle])
+        if use_draft:
+            generate_fn = self.generate_assisted
+        elif self._uses_static_cache(generation_kwargs):
+            generate_fn = self.generate_static
+        else:
+            generate_fn = self.model.generate
 
         if stream:
-            streamer = TextIteratorStreamer(
+            streamer = IncrementalTextStreamer(
                 self.tokenizer,
                 skip_prompt=False,
+                handle=handle,
                 skip_special_tokens=True,
             )
-            return self.stream_message(streamer, generation_kwargs)
+            return self.stream_message(
+                streamer, generation_kwargs, generate_fn=generate_fn, on_metrics=on_metrics
+            )
         else:
-            generated_ids = self.model.generate(**generation_kwargs)
+            generated_ids = self.generate_tracked(
+                generate_fn, generation_kwargs, on_metrics, handle
+            )
             text = self.tokenizer.batch_decode(generated_ids, skip_special_tokens=True)[0]
             return text
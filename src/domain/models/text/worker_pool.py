@@ -0,0 +1,215 @@
+import math
+import threading
+import time
+from collections import deque
+from concurrent.futures import Future
+from dataclasses import dataclass
+from typing import Callable, List, Optional
+
+from .cancellation import GenerationHandle
+from ..constants import GENERATION_MAX_WAIT, GENERATION_QUEUE_SIZE
+
+
+class QueueFullError(Exception):
+    """A generation was rejected because its model is saturated.
+
+    `retry_after` is the estimated wait in seconds, if known.
+    """
+
+    def __init__(self, message: str, retry_after: Optional[float] = None):
+        super().__init__(message)
+        self.retry_after = retry_after
+
+
+@dataclass
+class QueueStatus:
+    # 1 for the next request to start
+    position: int
+    # seconds, None until a generation of the model has finished
+    estimated_wait: Optional[float]
+
+
+class _Task:
+    def __init__(
+        self,
+        fn: Callable,
+        handle: Optional[GenerationHandle],
+        on_skip: Optional[Callable[[], None]],
+    ):
+        self.fn = fn
+        self.handle = handle
+        self.on_skip = on_skip
+        self.future = Future()
+
+    @property
+    def cancelled(self) -> bool:
+        return self.handle is not None and self.handle.cancelled
+
+
+class GenerationPool:
+    """Runs the generations of one model on `max_workers` threads.
+
+    Further requests wait in a FIFO queue of at most `max_queue` entries.
+    Once it is full, or when the estimated wait exceeds `max_wait` seconds,
+    new requests are rejected with `QueueFullError` instead of piling up.
+    The estimate is based on the average duration of the last generations.
+    Cancelled requests are skipped and do not count towards the limit.
+    """
+
+    def __init__(
+        self,
+        max_workers: int,
+        max_queue: int = GENERATION_QUEUE_SIZE,
+        max_wait: Optional[float] = GENERATION_MAX_WAIT or None,
+    ):
+        self.max_workers = max_workers
+        self.max_queue = max_queue
+        self.max_wait = max_wait
+        self.rejected = 0
+        self._waiting: "deque[_Task]" = deque()
+        self._running = 0
+        # moving average of the generation durations, in seconds
+        self._average_duration: Optional[float] = None
+        self._closed = False
+        self._condition = threading.Condition()
+        self._threads = [
+            threading.Thread(target=self._work, daemon=True) for _ in range(max_workers)
+        ]
+        for thread in self._threads:
+            thread.start()
+
+    @property
+    def running(self) -> int:
+        return self._running
+
+    @property
+    def waiting(self) -> int:
+        return len(self._waiting)
+
+    def _position(self, index: int) -> int:
+        """Queue position of the `index`th waiting task, 0 or less if a
+        worker is free for it (it was just not taken yet)."""
+        return index + 1 + self._running - self.max_workers
+
+    def _estimate(self, position: int) -> Optional[float]:
+        if self._average_duration is None:
+            return None
+        return self._average_duration * math.ceil(position / self.max_workers)
+
+    def _take_cancelled(self) -> List[_Task]:
+        cancelled = [task for task in self._waiting if task.cancelled]
+        if cancelled:
+            self._waiting = deque(task for task in self._waiting if not task.cancelled)
+        return cancelled
+
+    def _skip(self, task: _Task):
+        if task.on_skip is not None:
+            task.on_skip()
+        task.future.cancel()
+        if task.handle is not None:
+            task.handle.finish()
+
+    def submit(
+        self,
+        fn: Callable,
+        handle: Optional[GenerationHandle] = None,
+        on_skip: Optional[Callable[[], None]] = None,
+    ) -> Future:
+        """Queue `fn()`, the returned future resolves to its result.
+
+        If `handle` is cancelled before a worker is free, `fn` is not run:
+        `on_skip()` is called instead and the future is cancelled.
+        Raises `QueueFullError` if the request would wait too long. `handle`
+        is finished once `fn` returns or raises, is skipped or is rejected.
+        """
+        error = None
+        with self._condition:
+            cancelled = self._take_cancelled()
+            position = self._position(len(self._waiting))
+            if self._closed:
+                error = RuntimeError("Generation pool is closed.")
+            elif position > 0:
+                estimated_wait = self._estimate(position)
+                if position > self.max_queue:
+                    reason = f"{self._running} generations are running, {position - 1} queued"
+                    error = QueueFullError(f"The model is busy: {reason}.", estimated_wait)
+                elif self.max_wait and estimated_wait and estimated_wait > self.max_wait:
+                    reason = f"the estimated wait is {estimated_wait:.0f} s"
+                    error = QueueFullError(f"The model is busy: {reason}.", estimated_wait)
+            if error is None:
+                task = _Task(fn, handle, on_skip)
+                self._waiting.append(task)
+                self._condition.notify()
+            elif isinstance(error, QueueFullError):
+                self.rejected += 1
+        for skipped in cancelled:
+            self._skip(skipped)
+        if error is not None:
+            if handle is not None:
+                handle.finish()
+            raise error
+        return task.future
+
+    def status(self, handle: GenerationHandle) -> Optional[QueueStatus]:
+        """Position and estimated wait of the request of `handle`, `None`
+        once it runs (or if it is not queued here)."""
+        with self._condition:
+            waiting = [task for task in self._waiting if not task.cancelled]
+            for index, task in enumerate(waiting):
+                position = self._position(index)
+                if task.handle is handle and position > 0:
+                    return QueueStatus(position, self._estimate(position))
+        return None
+
+    def close(self):
+        """Skip the queued requests and stop the workers once the running
+        ones are done."""
+        with self._condition:
+            self._closed = True
+            queued = list(self._waiting)
+            self._waiting.clear()
+            self._condition.notify_all()
+        for task in queued:
+            self._skip(task)
+
+    def _work(self):
+        while True:
+            with self._condition:
+                while not self._waiting and not self._closed:
+                    self._condition.wait()
+                if not self._waiting:
+                    return
+                task = self._waiting.popleft()
+                skip = task.cancelled
+                if not skip:
+                    self._running += 1
+            if skip:
+                self._skip(task)
+                continue
+
+            task.future.set_running_or_notify_cancel()
+            start = time.monotonic()
+            result, error = None, None
+            try:
+                result = task.fn()
+            except BaseException as e:
+                error = e
+            duration = time.monotonic() - start
+            # free the slot before the caller wakes up and submits the next one
+            with self._condition:
+                self._running -= 1
+                # a failed generation does not take a typical time
+                if error is None:
+                    if self._average_duration is None:
+                        self._average_duration = duration
+                    else:
+                        self._average_duration = 0.8 * self._average_duration + 0.2 * duration
+            if error is None:
+                task.future.set_result(result)
+            else:
+                task.future.set_exception(error)
+            if task.handle is not None:
+                task.handle.finish()
+            # an idle worker must not keep what the task referenced, e.g. a
+            # conversation's KV cache
+            del task, result, error
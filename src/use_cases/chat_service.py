@@ -1,19 +1,125 @@
-from typing import Union, Iterator, List, Literal
+import weakref
+from typing import Union, Iterator, List, Literal, Optional, Tuple
 
+from ..domain.models.constants import PRELOAD_NEXT_MODEL
+from ..domain.models.registry import LoadHandle, LoadStatus, model_registry
 from ..domain.models.text.conversational import ConversationalModel
+from ..domain.models.text.kv_cache import ConversationCache
+from ..domain.models.text.cancellation import GenerationHandle
+from ..domain.models.text.telemetry import GenerationMetrics
+from ..domain.models.text.worker_pool import QueueFullError, QueueStatus
 from ..domain.models.utils import list_local_models
+from .context_window import ContextStrategy, ContextWindow
+from .response_cache import ResponseCache
+from .response_stream import ResponseStream
 
 
 class ChatService:
-    def __init__(self):
+    def __init__(self, use_response_cache=True):
         self._messages: List[dict] = []
         self.assistant: ConversationalModel = None
+        self._release_assistant = None
+        self._loading: LoadHandle = None
+        self._discard_loading = None
+        self._preloaded = set()
+        self._cache = ConversationCache()
+        self.context_strategy: ContextStrategy = "sliding_window"
+        self.context_max_tokens = None
+        self._context_window: ContextWindow = None
+        self.trimmed_tokens = 0
+        self.response_cache = ResponseCache() if use_response_cache else None
+        self.last_response_cached = False
+        # metrics of the last generation, None when served from the cache
+        self.last_metrics: Optional[GenerationMetrics] = None
+        self._generation: Optional[GenerationHandle] = None
+        self._draft_errors = {}
+
+    def _release_current(self):
+        # release first so the previous model can be evicted to make room
+        if self._release_assistant is not None:
+            self._release_assistant()
+            self.assistant = None
+        if self._loading is not None:
+            self._discard_loading()
+            self._loading = None
+
+    def _adopt(self, assistant: ConversationalModel):
+        self._cache.reset()
+        self._context_window = None
+        self.assistant = assistant
+        # give the model back to the registry when the session is garbage collected
+        self._release_assistant = weakref.finalize(
+            self, model_registry.release, self.assistant
+        )
 
     def set_assistant(self, id: str):
-        self.assistant = ConversationalModel(id)
-        self.assistant.load()
+        if self.assistant is not None and self.assistant.id == id:
+            return self.assistant
+
+        self._release_current()
+        self._adopt(model_registry.acquire(ConversationalModel, id))
         return self.assistant
 
+    def request_assistant(
+        self, id: str, retry=False
+    ) -> Tuple[LoadStatus, Optional[str]]:
+        """Non-blocking `set_assistant`: start loading `id` in the background
+        and return its status (and error message if it failed). Poll until
+        it is `"ready"`, the model is then the assistant. A failed load is
+        only attempted again with `retry`."""
+        if self.assistant is not None and self.assistant.id == id:
+            return "ready", None
+
+        if (
+            self._loading is None
+            or self._loading.id != id
+            or (retry and self._loading.status()[0] == "failed")
+        ):
+            self._release_current()
+            self._loading = model_registry.acquire_async(ConversationalModel, id)
+            self._discard_loading = weakref.finalize(self, self._loading.discard)
+
+        status, error = self._loading.status()
+        if status == "ready":
+            self._discard_loading.detach()
+            self._adopt(self._loading.result())
+            self._loading = None
+        return status, error
+
+    def preload_next(self, ids: List[str]):
+        """Load the model after the assistant in `ids` in the background, it
+        stays evictable. Does nothing unless `PRELOAD_NEXT_MODEL` is set."""
+        if not PRELOAD_NEXT_MODEL or self.assistant is None or len(ids) < 2:
+            return
+        if self.assistant.id not in ids:
+            return
+        next_id = ids[(ids.index(self.assistant.id) + 1) % len(ids)]
+        if next_id not in self._preloaded:
+            self._preloaded.add(next_id)
+            model_registry.preload_async(ConversationalModel, next_id)
+
+    def set_context_budget(
+        self, strategy: ContextStrategy = "sliding_window", max_tokens: int = None
+    ):
+        """Set how the history is trimmed to fit `max_tokens` (defaults to the
+        model context length) together with the new tokens."""
+        if strategy != self.context_strategy or max_tokens != self.context_max_tokens:
+            self.context_strategy = strategy
+            self.context_max_tokens = max_tokens
+            self._context_window = None
+
+    def _fit_context(self, max_new_tokens: int) -> List[dict]:
+        max_tokens = self.context_max_tokens or self.assistant.get_context_length()
+        if self._context_window is None:
+            self._context_window = ContextWindow(
+                self.assistant.count_message_tokens,
+                max_tokens,
+                strategy=self.context_strategy,
+            )
+        self._context_window.max_tokens = max(1, max_tokens - max_new_tokens)
+        messages, self.trimmed_tokens = self._context_window.fit(self._messages)
+        return messages
+
     def get_conversational_assistants_list(self):
         return list_local_models("conversational")
 
@@ -22,10 +128,14 @@ class ChatService:
 
     def set_messages(self, messages: List[dict]):
         self._messages = messages
+        self._cache.reset()
+        self._reset_context_window()
 
     def set_system_message(self, content: str):
-        if self._messages[0]["role"] == "system":
-            self._messages[0]["content"] = content
+        system_message = self._messages[0]
+        if system_message["role"] == "system" and system_message["content"] != content:
+            system_message["content"] = content
+            self._cache.reset()
 
     def append_message(
         self, role: Literal["system", "user", "assistant"], content: str
@@ -33,17 +143,68 @@ class ChatService:
         self._messages.append({"role": role, "content": content})
 
     def pop_message(self, index: int):
-        if index > 0 and index < len(self.messages):
+        if index > 0 and index < len(self._messages):
             msg = self._messages.pop(index)
+            self._cache.reset()
+            self._reset_context_window()
             return msg
         return None
 
     def clear_messages(self) -> None:
         self._messages.clear()
+        self._cache.reset()
+        self._reset_context_window()
+
+    def _reset_context_window(self):
+        if self._context_window is not None:
+            self._context_window.reset()
+
+    def get_draft_options(self) -> List[str]:
+        """Local models that could serve as draft for the current assistant."""
+        return [id for id in list_local_models("conversational") if id != self.assistant.id]
+
+    def set_draft(self, draft_id: Optional[str]):
+        """Pair the assistant with a draft model for assisted generation, or
+        remove its draft with `None`. The pairing is shared by every session
+        using the model. Raises `ValueError` if the draft is not compatible."""
+        if draft_id == self.assistant.draft_id:
+            return
+        if draft_id is None:
+            self.assistant.unload_draft()
+        else:
+            # don't load an incompatible draft again on every call
+            key = (self.assistant.id, draft_id)
+            if key in self._draft_errors:
+                raise ValueError(self._draft_errors[key])
+            try:
+                self.assistant.load_draft(draft_id)
+            except ValueError as e:
+                self._draft_errors[key] = str(e)
+                raise
+        model_registry.refresh(self.assistant)
+
+    def _set_last_metrics(self, metrics: GenerationMetrics):
+        self.last_metrics = metrics
+
+    def cancel_generation(self):
+        """Stop the generation of the last `send`, if it is still running."""
+        if self._generation is not None:
+            self._generation.cancel()
+            self._generation = None
+
+    def queue_status(self) -> Optional[QueueStatus]:
+        """Queue position and estimated wait of the last `send`, `None` once
+        it is generating (or done)."""
+        if self._generation is None or self.assistant is None or self.assistant.pool is None:
+            return None
+        return self.assistant.pool.status(self._generation)
 
     def send(self, content: str, stream=False, **kwargs) -> Union[str, Iterator[str]]:
         """Send a message to the conversational assistant and generate a response.
 
+        The history is trimmed to the context budget first, see `set_context_budget`;
+        `trimmed_tokens` holds how many tokens were left out.
+
         Args:
             content (str): The content of the message to send to the assistant.
             stream (bool, optional): If `True`, returns a generator yielding response chunks as they are produced.
@@ -54,17 +215,59 @@ class ChatService:
             or an iterator that yields response chunks as they are generated.
         """
         self.append_message("user", content)
+        model_registry.touch(self.assistant)
+        max_new_tokens = (
+            kwargs.get("max_new_tokens")
+            or self.assistant.generation_defaults().get("max_new_tokens")
+            or 0
+        )
+        messages = self._fit_context(max_new_tokens)
+        self.last_metrics = None
+        # a session runs one generation at a time, a new prompt supersedes the last
+        self.cancel_generation()
+        self._generation = handle = GenerationHandle()
+
+        key = None
+        if self.response_cache is not None:
+            key = self.response_cache.key(
+                self.assistant, self.assistant.encode(messages), **kwargs
+            )
+            cached_response = self.response_cache.get(key)
+            self.last_response_cached = cached_response is not None
+            if self.last_response_cached:
+                return self.response_cache.replay(cached_response) if stream else cached_response
+
+        model_registry.hold(self.assistant, handle)
         assistant_response = ""
         try:
             if stream:
                 streamer = self.assistant.generate(
-                    self._messages, stream=True, **kwargs
+                    messages,
+                    stream=True,
+                    cache=self._cache,
+                    on_metrics=self._set_last_metrics,
+                    handle=handle,
+                    **kwargs,
                 )
-                return streamer
+                return ResponseStream(streamer, self.response_cache, key)
             else:
                 assistant_response = self.assistant.generate(
-                    self._messages, stream=False, **kwargs
+                    messages,
+                    stream=False,
+                    cache=self._cache,
+                    on_metrics=self._set_last_metrics,
+                    handle=handle,
+                    **kwargs,
                 )
+                if self.response_cache is not None:
+                    self.response_cache.set(key, assistant_response)
                 return assistant_response
+        except QueueFullError:
+            # the model is busy, the message was not answered
+            self._messages.pop()
+            raise
         except Exception as e:
+            # gives the model back if the pool never got the request, nothing
+            # happens if it already finished the generation
+            handle.finish()
             raise e
@@ -0,0 +1,105 @@
+from collections import OrderedDict
+from typing import Callable, List, Literal, Tuple
+
+ContextStrategy = Literal["sliding_window", "keep_system_last_n", "drop_middle"]
+
+
+class ContextWindow:
+    """Keeps a chat history within a token budget.
+
+    Message token counts are cached, so only new messages are tokenized.
+    The system message (if first) and the last message are always kept:
+
+    - `sliding_window` drops the oldest messages.
+    - `keep_system_last_n` keeps only the last `last_n` messages.
+    - `drop_middle` keeps the first `keep_first` messages after the system
+      message as well, and drops from the middle.
+
+    Messages are dropped a turn at a time (a user message and the replies to
+    it), so the kept history starts with a user message after the system
+    message and after the `keep_first` messages, which are rounded up to
+    whole turns. The kept history never starts with an answer, and a history
+    alternating between user and assistant keeps alternating.
+
+    When trimming, `sliding_window` and `drop_middle` cut down to
+    `low_watermark` of the budget and keep that cut point on the following
+    turns, so the kept history stays a stable prefix that the KV cache can
+    reuse instead of shifting by one message every turn.
+    """
+
+    def __init__(
+        self,
+        count_tokens: Callable[[dict], int],
+        max_tokens: int,
+        strategy: ContextStrategy = "sliding_window",
+        last_n: int = 8,
+        keep_first: int = 2,
+        low_watermark: float = 0.75,
+        cache_size: int = 4096,
+    ):
+        self.count_tokens = count_tokens
+        self.max_tokens = max_tokens
+        self.strategy = strategy
+        self.last_n = last_n
+        self.keep_first = keep_first
+        self.low_watermark = low_watermark
+        self.cache_size = cache_size
+        self._counts: "OrderedDict[Tuple[str, str], int]" = OrderedDict()
+        self._dropped = 0
+
+    def reset(self):
+        self._dropped = 0
+
+    def count(self, message: dict) -> int:
+        key = (message["role"], message["content"])
+        if key in self._counts:
+            self._counts.move_to_end(key)
+            return self._counts[key]
+
+        count = self.count_tokens(message)
+        self._counts[key] = count
+        if len(self._counts) > self.cache_size:
+            self._counts.popitem(last=False)
+        return count
+
+    def total(self, messages: List[dict]) -> int:
+        return sum(self.count(message) for message in messages)
+
+    def fit(self, messages: List[dict]) -> Tuple[List[dict], int]:
+        """Returns the messages to send and the number of tokens trimmed."""
+        system = messages[:1] if messages and messages[0]["role"] == "system" else []
+        body = messages[len(system) :]
+
+        if self.strategy == "keep_system_last_n":
+            head, tail = [], _from_user(body[-self.last_n :])
+            while _next_turn(tail) < len(tail) and self.total(system + tail) > self.max_tokens:
+                tail = tail[_next_turn(tail) :]
+        else:
+            head = []
+            if self.strategy == "drop_middle":
+                head = body[: _next_turn(body, self.keep_first)]
+            rest = body[len(head) :]
+            if self._dropped >= len(rest):
+                self._dropped = 0
+            tail = _from_user(rest[self._dropped :])
+            if self.total(system + head + tail) > self.max_tokens:
+                target = self.max_tokens * self.low_watermark
+                while _next_turn(tail) < len(tail) and self.total(system + head + tail) > target:
+                    tail = tail[_next_turn(tail) :]
+                self._dropped = len(rest) - len(tail)
+
+        fitted = system + head + tail
+        return fitted, self.total(messages) - self.total(fitted)
+
+
+def _next_turn(messages: List[dict], start: int = 1) -> int:
+    """Index of the first user message from `start` on, `len(messages)` if none."""
+    for i in range(start, len(messages)):
+        if messages[i]["role"] == "user":
+            return i
+    return len(messages)
+
+
+def _from_user(messages: List[dict]) -> List[dict]:
+    """`messages` from their first user message on, or their last message."""
+    return messages[_next_turn(messages, 0) :] or messages[-1:]
@@ -0,0 +1,68 @@
+import re
+from typing import List
+
+# everything AutoTokenizer / AutoModelForCausalLM.from_pretrained may read
+# next to the weights: configs, tokenizer files, chat templates, custom code
+AUXILIARY_FILE_PATTERN = re.compile(r".+\.(json|model|tiktoken|txt|jinja|py)$")
+
+# weight formats in order of preference, each one as
+# (index file, sharded weights, single weights file)
+WEIGHT_FORMATS = [
+    (
+        "model.safetensors.index.json",
+        re.compile(r"model-\d+-of-\d+\.safetensors"),
+        "model.safetensors",
+    ),
+    (
+        "pytorch_model.bin.index.json",
+        re.compile(r"pytorch_model-\d+-of-\d+\.bin"),
+        "pytorch_model.bin",
+    ),
+]
+
+
+def _is_weight_index(filename: str) -> bool:
+    return any(filename == index for index, _, _ in WEIGHT_FORMATS)
+
+
+def _select_weights(filenames: List[str]) -> List[str]:
+    for index, shard_pattern, single in WEIGHT_FORMATS:
+        if index in filenames:
+            shards = [name for name in filenames if shard_pattern.fullmatch(name)]
+            if shards:
+                return [index, *shards]
+        if single in filenames:
+            return [single]
+
+    # unusual layouts (e.g. `consolidated.safetensors` only): keep a single format
+    safetensors = [name for name in filenames if name.endswith(".safetensors")]
+    if safetensors:
+        return safetensors
+    return [name for name in filenames if name.endswith(".bin")]
+
+
+def plan_download(siblings: List[dict]) -> List[dict]:
+    """Select the files `LoadUnloadMixin.load` needs out of a repository.
+
+    Only the repository root is considered (`from_pretrained` never reads
+    `original/`, `onnx/`...), auxiliary files are kept and a single weight
+    format is picked, safetensors first. ONNX, GGUF, TF, Flax exports and
+    documentation are skipped.
+
+    Args:
+        siblings (List[dict]): `{"rfilename": ..., "size": ...}` dicts of the repository.
+
+    Returns:
+        List[dict]: The planned subset, in the order of `siblings`.
+    """
+    root_files = [
+        file["rfilename"] for file in siblings if "/" not in file["rfilename"]
+    ]
+    weights = set(_select_weights(root_files))
+    planned = {
+        name
+        for name in root_files
+        if name in weights
+        or (AUXILIARY_FILE_PATTERN.fullmatch(name) and not _is_weight_index(name))
+    }
+    return [file for file in siblings if file["rfilename"] in planned]
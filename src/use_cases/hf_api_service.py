@@ -1,19 +1,43 @@
 import os
 import time
-from huggingface_hub import HfApi, snapshot_download
+from concurrent.futures import ThreadPoolExecutor
+from huggingface_hub import HfApi
 import requests
 
-from ..domain.models.constants import MODELS_DIR
+from ..domain.models.constants import HUB_CACHE_PATH, MODELS_DIR
+from .download_planner import plan_download
+from .repo_downloader import RepoDownloader
+from .sqlite_cache import SqliteCache
 
 
 class HfApiService:
-    def __init__(self):
-        self.hf_api = HfApi()
+    SEARCH_TTL = 10 * 60
+    MODEL_INFO_TTL = 60 * 60
+    # bump when the shape of cached entries changes
+    CACHE_VERSION = 2
+
+    def __init__(
+        self,
+        endpoint: str = None,
+        max_workers: int = 8,
+        download_workers: int = 4,
+        ranged_threshold: int = 256 * 1024**2,
+        use_cache=True,
+    ):
+        self.hf_api = HfApi(endpoint=endpoint)
         self.token = None
+        self.max_workers = max_workers
+        self.download_workers = download_workers
+        # files of at least this size are fetched as parallel HTTP Range chunks
+        self.ranged_threshold = ranged_threshold
+        self.cache = SqliteCache(HUB_CACHE_PATH) if use_cache else None
 
     def set_token(self, token: str):
         self.token = token if token else None
 
+    def set_max_workers(self, max_workers: int):
+        self.max_workers = max(1, int(max_workers))
+
     def get_tag_options(self):
         return {
             "Conversational": "conversational",
@@ -51,6 +75,44 @@ class HfApiService:
             token=self.token,
         )
 
+    def _cache_key(self, kind, *parts):
+        # results depend on what the token is allowed to see, never store the token itself
+        token_id = SqliteCache.make_key(self.token) if self.token else None
+        return SqliteCache.make_key(
+            kind, self.CACHE_VERSION, self.hf_api.endpoint, token_id, *parts
+        )
+
+    def _get_model_summary(self, id):
+        key = self._cache_key("model_info", id)
+        if self.cache is not None:
+            summary = self.cache.get(key)
+            if summary is not None:
+                return summary
+
+        model_info = self._get_model_infos(id)
+        if model_info.safetensors and model_info.safetensors.total:
+            params = model_info.safetensors.total
+        else:
+            params = None
+
+        summary = {
+            "parameter_size": params,
+            "siblings": [
+                {"rfilename": file.rfilename, "size": file.size}
+                for file in model_info.siblings or []
+            ],
+        }
+        if self.cache is not None:
+            self.cache.set(key, summary, ttl=self.MODEL_INFO_TTL)
+        return summary
+
+    def get_cache_stats(self):
+        return self.cache.stats() if self.cache is not None else None
+
+    def clear_cache(self):
+        if self.cache is not None:
+            self.cache.clear()
+
     def _format_bytes(self, size_bytes):
         if size_bytes < 1024:
             return f"{size_bytes:.0f} B"
@@ -63,12 +125,43 @@ class HfApiService:
 
     def _calculate_download_size(self, siblings):
         if siblings and len(siblings) > 0:
-            download_size = sum(file.size for file in siblings if file.size is not None)
+            download_size = sum(
+                file["size"] for file in siblings if file["size"] is not None
+            )
             download_size = self._format_bytes(download_size)
         else:
             download_size = "N/A"
         return download_size
 
+    def _enrich_model(self, model):
+        try:
+            summary = self._get_model_summary(model["modelId"])
+        except Exception:
+            # a single failing repo (gated, removed, rate limited...) must not
+            # hide the rest of the results
+            model["parameter_size"] = None
+            model["download_size"] = "N/A"
+            model["repo_size"] = "N/A"
+            return False
+
+        model["parameter_size"] = summary["parameter_size"]
+
+        model["download_size"] = self._calculate_download_size(
+            plan_download(summary["siblings"])
+        )
+        model["repo_size"] = self._calculate_download_size(summary["siblings"])
+        return True
+
+    def _enrich_models(self, models):
+        """Enrich `models` in place, returns `True` if no model_info lookup failed."""
+        max_workers = min(self.max_workers, len(models))
+        if max_workers <= 1:
+            return all([self._enrich_model(model) for model in models])
+
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            # map keeps the order of the search results
+            return all(list(executor.map(self._enrich_model, models)))
+
     def search_models(
         self,
         query,
@@ -97,8 +190,8 @@ class HfApiService:
             pipeline_tag = "text-generation"
 
         params = {
-            "search": query,
-            "author": author,
+            "search": (query or "").strip(),
+            "author": (author or "").strip(),
             "pipeline_tag": pipeline_tag,
             "filter": filter,
             "sort": sort,
@@ -107,49 +200,89 @@ class HfApiService:
             "limit": limit,
         }
 
+        key = self._cache_key("search", params)
+        if self.cache is not None:
+            models = self.cache.get(key)
+            if models is not None:
+                return models
+
         headers = {}
         if self.token:
             headers["Authorization"] = f"Bearer {self.token}"
 
         response = requests.get(
-            "https://huggingface.co/api/models",
+            f"{self.hf_api.endpoint}/api/models",
             params=params,
             headers=headers,
         )
         response.raise_for_status()
 
-        response = response.json()
-        for model in response:
-            model_info = self._get_model_infos(model["modelId"])
-            if model_info.safetensors and model_info.safetensors.total:
-                params = model_info.safetensors.total
-            else:
-                params = None
-
-            model["parameter_size"] = params
-
-            model["download_size"] = self._calculate_download_size(model_info.siblings)
-        return response
+        models = response.json()
+        if self._enrich_models(models) and self.cache is not None:
+            self.cache.set(key, models, ttl=self.SEARCH_TTL)
+        return models
 
     def get_repo_files(self, repo_id):
         return self.hf_api.list_repo_files(repo_id, token=self.token)
 
-    def _download_file_from_repo(self, repo_id, filename, download_folder):
-        return self.hf_api.hf_hub_download(
-            repo_id,
-            repo_type="model",
-            filename=filename,
-            local_dir=download_folder,
-            force_download=False,
+    def _get_downloader(self):
+        return RepoDownloader(
+            self.hf_api.endpoint,
             token=self.token,
+            max_workers=self.download_workers,
+            ranged_threshold=self.ranged_threshold,
         )
 
-    def download_file(self, repo_id, filename, pipeline_tag):
-        download_folder = os.path.join(
+    def _get_download_folder(self, repo_id, pipeline_tag):
+        return os.path.join(
             MODELS_DIR, pipeline_tag, repo_id.split("/")[1].replace("/", "_")
         )
+
+    def download_file(self, repo_id, filename, pipeline_tag):
+        download_folder = self._get_download_folder(repo_id, pipeline_tag)
+        files = [
+            file for file in self.get_repo_siblings(repo_id) if file["rfilename"] == filename
+        ] or [{"rfilename": filename, "size": None}]
         start_time = time.time()
-        file_path = self._download_file_from_repo(repo_id, filename, download_folder)
+        (file_path,) = self._get_downloader().download(repo_id, files, download_folder)
         elapsed = time.time() - start_time
         file_size = os.path.getsize(file_path)
         return f"{elapsed:.2f}s", self._format_bytes(file_size)
+
+    def format_download_progress(self, progress):
+        text = (
+            f"{self._format_bytes(progress.downloaded_bytes)} / "
+            f"{self._format_bytes(progress.total_bytes)} "
+            f"({progress.files_done}/{progress.files_total} files) - "
+            f"{self._format_bytes(progress.bytes_per_second)}/s"
+        )
+        if progress.eta is not None:
+            minutes, seconds = divmod(int(progress.eta), 60)
+            text += f", ETA {minutes}m {seconds:02d}s"
+        return text
+
+    def get_repo_siblings(self, repo_id):
+        return self._get_model_summary(repo_id)["siblings"]
+
+    def get_planned_files(self, repo_id):
+        return plan_download(self.get_repo_siblings(repo_id))
+
+    def download_repo(self, repo_id, pipeline_tag, files=None, on_progress=None):
+        """Download the files of a repository needed to load the model (or the
+        `files` subset of its siblings) with `download_workers` files in flight.
+        Interrupted files are resumed.
+
+        Returns:
+            Tuple[str, str]: Elapsed time and downloaded size, formatted.
+        """
+        files = files if files is not None else self.get_planned_files(repo_id)
+        start_time = time.time()
+        paths = self._get_downloader().download(
+            repo_id,
+            files,
+            self._get_download_folder(repo_id, pipeline_tag),
+            on_progress=on_progress,
+        )
+        elapsed = time.time() - start_time
+        total_size = sum(os.path.getsize(path) for path in paths)
+        return f"{elapsed:.2f}s", self._format_bytes(total_size)
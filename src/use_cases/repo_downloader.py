@@ -0,0 +1,395 @@
+import hashlib
+import json
+import os
+import re
+import threading
+import time
+from concurrent.futures import FIRST_EXCEPTION, ThreadPoolExecutor, wait
+from dataclasses import dataclass
+from typing import Callable, List, Optional
+from urllib.parse import quote, urljoin, urlparse
+
+import requests
+
+
+@dataclass
+class DownloadProgress:
+    total_bytes: int
+    downloaded_bytes: int
+    files_total: int
+    files_done: int
+    elapsed: float
+    bytes_per_second: float
+
+    @property
+    def fraction(self) -> float:
+        if not self.total_bytes:
+            return self.files_done / self.files_total if self.files_total else 1.0
+        return min(1.0, self.downloaded_bytes / self.total_bytes)
+
+    @property
+    def eta(self) -> Optional[float]:
+        if not self.total_bytes or not self.bytes_per_second:
+            return None
+        return max(0, self.total_bytes - self.downloaded_bytes) / self.bytes_per_second
+
+
+class DownloadCancelled(Exception):
+    pass
+
+
+class RepoDownloader:
+    """Downloads the files of a Hub repository concurrently.
+
+    Files are streamed into `<name>.incomplete` next to their destination and
+    renamed once complete; an interrupted file is resumed with an HTTP Range
+    request, both on retry and on a later call. Progress is reported in bytes
+    from the calling thread, so `on_progress` may safely touch Streamlit
+    elements.
+
+    Files of at least `ranged_threshold` bytes are split into `range_size`
+    chunks fetched by `range_workers` parallel Range requests into a
+    preallocated file, then checked against the size and ETag announced by
+    the Hub. Completed chunks are recorded in `<name>.incomplete.json` so an
+    interrupted shard only refetches the missing ones.
+    """
+
+    def __init__(
+        self,
+        endpoint: str,
+        token: str = None,
+        max_workers: int = 4,
+        retries: int = 3,
+        chunk_size: int = 1024**2,
+        timeout: float = 30,
+        ranged_threshold: int = 256 * 1024**2,
+        range_size: int = 64 * 1024**2,
+        range_workers: int = 8,
+    ):
+        self.endpoint = endpoint.rstrip("/")
+        self.token = token
+        self.max_workers = max_workers
+        self.retries = retries
+        self.chunk_size = chunk_size
+        self.timeout = timeout
+        self.ranged_threshold = ranged_threshold
+        self.range_size = range_size
+        self.range_workers = range_workers
+        self._lock = threading.Lock()
+        self._cancelled = threading.Event()
+        self._downloaded = 0
+        self._resumed = 0
+        self._files_done = 0
+
+    def file_url(self, repo_id: str, filename: str, revision: str = "main") -> str:
+        return (
+            f"{self.endpoint}/{repo_id}/resolve/{quote(revision, safe='')}"
+            f"/{quote(filename, safe='/')}"
+        )
+
+    def _headers(self):
+        headers = {}
+        if self.token:
+            headers["Authorization"] = f"Bearer {self.token}"
+        return headers
+
+    def _add_bytes(self, count: int):
+        with self._lock:
+            self._downloaded += count
+
+    def cancel(self):
+        self._cancelled.set()
+
+    def _fetch(self, url: str, path: str, size: Optional[int]):
+        tmp_path = path + ".incomplete"
+        offset = os.path.getsize(tmp_path) if os.path.exists(tmp_path) else 0
+        if size is not None and offset > size:
+            os.remove(tmp_path)
+            offset = 0
+
+        if size is None or offset < size:
+            headers = self._headers()
+            if offset:
+                headers["Range"] = f"bytes={offset}-"
+
+            with requests.get(
+                url, headers=headers, stream=True, timeout=self.timeout
+            ) as response:
+                response.raise_for_status()
+                if offset and response.status_code != 206:
+                    # the server ignored the Range header, start over
+                    self._add_bytes(-offset)
+                    offset = 0
+
+                with open(tmp_path, "ab" if offset else "wb") as f:
+                    for chunk in response.iter_content(chunk_size=self.chunk_size):
+                        if self._cancelled.is_set():
+                            raise DownloadCancelled()
+                        f.write(chunk)
+                        self._add_bytes(len(chunk))
+
+        if size is not None and os.path.getsize(tmp_path) != size:
+            raise IOError(
+                f"Size mismatch for {os.path.basename(path)}: "
+                f"expected {size}, got {os.path.getsize(tmp_path)}"
+            )
+        os.replace(tmp_path, path)
+
+    def _resolve(self, url: str):
+        """Returns the final download url with the size and ETag of the file.
+
+        The Hub answers `/resolve/` with a redirect to its CDN for LFS files and
+        announces the real size and sha256 in the `X-Linked-*` headers.
+        """
+        response = requests.head(
+            url, headers=self._headers(), allow_redirects=False, timeout=self.timeout
+        )
+        response.raise_for_status()
+        headers = response.headers
+        etag = headers.get("X-Linked-Etag") or headers.get("ETag")
+        size = headers.get("X-Linked-Size") or headers.get("Content-Length")
+        location = url
+        if response.is_redirect:
+            location = urljoin(url, headers["Location"])
+        accept_ranges = response.is_redirect or headers.get("Accept-Ranges") == "bytes"
+        return location, int(size) if size else None, etag, accept_ranges
+
+    def _range_headers(self, location: str):
+        # never leak the token to a CDN on another host
+        if urlparse(location).netloc == urlparse(self.endpoint).netloc:
+            return self._headers()
+        return {}
+
+    def _verify(self, tmp_path: str, size: int, etag: Optional[str]):
+        if os.path.getsize(tmp_path) != size:
+            raise IOError(
+                f"Size mismatch for {os.path.basename(tmp_path)}: "
+                f"expected {size}, got {os.path.getsize(tmp_path)}"
+            )
+        etag = (etag or "").removeprefix("W/").strip('"')
+        if re.fullmatch(r"[0-9a-f]{64}", etag):
+            digest = hashlib.sha256()
+        elif re.fullmatch(r"[0-9a-f]{40}", etag):
+            # regular git files are identified by their git blob sha1
+            digest = hashlib.sha1(f"blob {size}\0".encode())
+        else:
+            return
+
+        with open(tmp_path, "rb") as f:
+            while block := f.read(8 * 1024**2):
+                digest.update(block)
+        if digest.hexdigest() != etag:
+            raise IOError(f"Checksum mismatch for {os.path.basename(tmp_path)}")
+
+    def _write_at(self, f, lock, data: bytes, offset: int):
+        if hasattr(os, "pwrite"):
+            os.pwrite(f.fileno(), data, offset)
+        else:
+            with lock:
+                f.seek(offset)
+                f.write(data)
+
+    def _fetch_range(self, location, f, file_lock, start, end):
+        headers = {**self._range_headers(location), "Range": f"bytes={start}-{end}"}
+        written = 0
+        try:
+            with requests.get(
+                location, headers=headers, stream=True, timeout=self.timeout
+            ) as response:
+                response.raise_for_status()
+                if response.status_code != 206:
+                    raise IOError("Server does not support Range requests")
+                for chunk in response.iter_content(chunk_size=self.chunk_size):
+                    if self._cancelled.is_set():
+                        raise DownloadCancelled()
+                    chunk = chunk[: end + 1 - start - written]
+                    self._write_at(f, file_lock, chunk, start + written)
+                    written += len(chunk)
+                    self._add_bytes(len(chunk))
+            if written != end + 1 - start:
+                raise IOError(f"Incomplete range {start}-{end}")
+        except BaseException:
+            # the whole range is fetched again on retry
+            self._add_bytes(-written)
+            raise
+
+    def _fetch_ranged(self, url: str, path: str, size: int):
+        location, remote_size, etag, accept_ranges = self._resolve(url)
+        size = remote_size or size
+        if not accept_ranges:
+            return self._fetch(url, path, size)
+
+        tmp_path = path + ".incomplete"
+        state_path = tmp_path + ".json"
+        state = self._read_range_state(state_path)
+        if (
+            state.get("size") != size
+            or state.get("etag") != etag
+            or state.get("range_size") != self.range_size
+            or not os.path.exists(tmp_path)
+            or os.path.getsize(tmp_path) != size
+        ):
+            state = {"size": size, "etag": etag, "range_size": self.range_size, "done": []}
+            with open(tmp_path, "wb") as f:
+                f.truncate(size)
+
+        done = set(state["done"])
+        todo = [
+            (index, start, min(start + self.range_size, size) - 1)
+            for index, start in enumerate(range(0, size, self.range_size))
+            if index not in done
+        ]
+        file_lock = threading.Lock()
+        state_lock = threading.Lock()
+
+        def fetch(index, start, end):
+            for attempt in range(self.retries + 1):
+                try:
+                    self._fetch_range(location, f, file_lock, start, end)
+                    break
+                except (requests.ConnectionError, requests.Timeout, IOError):
+                    if self._cancelled.is_set() or attempt == self.retries:
+                        raise
+                    time.sleep(min(2**attempt, 10))
+            with state_lock:
+                state["done"].append(index)
+                with open(state_path, "w") as state_file:
+                    json.dump(state, state_file)
+
+        with open(tmp_path, "r+b") as f:
+            with ThreadPoolExecutor(max_workers=self.range_workers) as executor:
+                futures = [executor.submit(fetch, *chunk) for chunk in todo]
+                for future in futures:
+                    future.result()
+
+        try:
+            self._verify(tmp_path, size, etag)
+        except IOError:
+            os.remove(tmp_path)
+            os.remove(state_path)
+            raise
+        os.replace(tmp_path, path)
+        os.remove(state_path)
+
+    def _read_range_state(self, state_path: str) -> dict:
+        try:
+            with open(state_path) as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return {}
+
+    def _download_file(self, repo_id, filename, size, download_folder, revision):
+        path = os.path.join(download_folder, filename)
+        if os.path.exists(path) and (size is None or os.path.getsize(path) == size):
+            on_disk = os.path.getsize(path)
+            with self._lock:
+                self._resumed += on_disk
+                self._downloaded += on_disk
+                self._files_done += 1
+            return path
+
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        url = self.file_url(repo_id, filename, revision)
+        ranged = size is not None and size >= self.ranged_threshold
+        fetch = self._fetch_ranged if ranged else self._fetch
+        for attempt in range(self.retries + 1):
+            try:
+                fetch(url, path, size)
+                break
+            except (requests.ConnectionError, requests.Timeout, IOError) as e:
+                if self._cancelled.is_set() or attempt == self.retries:
+                    raise
+                if isinstance(e, requests.HTTPError) and e.response.status_code < 500:
+                    raise
+                time.sleep(min(2**attempt, 10))
+
+        with self._lock:
+            self._files_done += 1
+        return path
+
+    def _already_on_disk(self, download_folder, filename):
+        """Bytes of an interrupted download of `filename`, complete files are
+        counted when `_download_file` skips them."""
+        path = os.path.join(download_folder, filename)
+        state = self._read_range_state(path + ".incomplete.json")
+        if state:
+            return sum(
+                min(state["range_size"], state["size"] - index * state["range_size"])
+                for index in state["done"]
+            )
+        if os.path.exists(path + ".incomplete"):
+            return os.path.getsize(path + ".incomplete")
+        return 0
+
+    def download(
+        self,
+        repo_id: str,
+        files: List[dict],
+        download_folder: str,
+        revision: str = "main",
+        on_progress: Callable[[DownloadProgress], None] = None,
+        poll_interval: float = 0.25,
+    ) -> List[str]:
+        """Download `files` (`{"rfilename": ..., "size": ...}` dicts, as in the
+        model_info siblings) into `download_folder`.
+
+        Returns:
+            List[str]: The local paths, in the order of `files`.
+        """
+        self._cancelled.clear()
+        self._resumed = sum(
+            self._already_on_disk(download_folder, file["rfilename"]) for file in files
+        )
+        self._downloaded = self._resumed
+        self._files_done = 0
+        total_bytes = sum(file["size"] or 0 for file in files)
+        start_time = time.time()
+
+        def report():
+            if on_progress is None:
+                return
+            elapsed = time.time() - start_time
+            with self._lock:
+                downloaded, files_done = self._downloaded, self._files_done
+            on_progress(
+                DownloadProgress(
+                    total_bytes=total_bytes,
+                    downloaded_bytes=downloaded,
+                    files_total=len(files),
+                    files_done=files_done,
+                    elapsed=elapsed,
+                    bytes_per_second=(
+                        (downloaded - self._resumed) / elapsed if elapsed > 0 else 0
+                    ),
+                )
+            )
+
+        with ThreadPoolExecutor(max_workers=max(1, self.max_workers)) as executor:
+            futures = [
+                executor.submit(
+                    self._download_file,
+                    repo_id,
+                    file["rfilename"],
+                    file["size"],
+                    download_folder,
+                    revision,
+                )
+                for file in files
+            ]
+            pending = futures
+            try:
+                while pending:
+                    done, pending = wait(
+                        pending, timeout=poll_interval, return_when=FIRST_EXCEPTION
+                    )
+                    report()
+                    for future in done:
+                        if future.exception() is not None:
+                            raise future.exception()
+            except BaseException:
+                self.cancel()
+                for future in pending:
+                    future.cancel()
+                raise
+        report()
+        return [future.result() for future in futures]
@@ -0,0 +1,61 @@
+import re
+from typing import Iterator, List, Optional
+
+from ..domain.models.constants import RESPONSE_CACHE_PATH
+from .sqlite_cache import SqliteCache
+
+# generation config entries that do not change the generated tokens
+IGNORED_GENERATION_KEYS = {"transformers_version", "_from_model_config", "streamer"}
+SAMPLING_KEYS = {"temperature", "top_k", "top_p", "min_p", "typical_p"}
+
+
+class ResponseCache:
+    """Persistent cache of deterministic (greedy or beam search) generations.
+
+    Entries are keyed on the model id and weight fingerprint, the exact
+    prompt token ids and the normalized generation config, so any change to
+    one of them is a miss. Sampled generations are never cached.
+    """
+
+    def __init__(self, path: str = RESPONSE_CACHE_PATH, max_bytes: int = 256 * 1024**2):
+        self.store = SqliteCache(path, max_bytes=max_bytes)
+
+    def _normalize(self, generation_config: dict) -> dict:
+        config = {
+            name: value
+            for name, value in generation_config.items()
+            if value is not None and name not in IGNORED_GENERATION_KEYS
+        }
+        if not config.get("do_sample"):
+            # sampling parameters are ignored by greedy decoding
+            config = {name: value for name, value in config.items() if name not in SAMPLING_KEYS}
+        return config
+
+    def key(self, model, input_ids: List[int], **kwargs) -> Optional[str]:
+        """Returns the cache key of a generation, `None` if it is not deterministic."""
+        generation_config = {**model.generation_defaults(), **kwargs}
+        if generation_config.get("do_sample"):
+            return None
+        return SqliteCache.make_key(
+            "response",
+            model.id,
+            model.fingerprint,
+            input_ids,
+            self._normalize(generation_config),
+        )
+
+    def get(self, key: Optional[str]) -> Optional[str]:
+        return self.store.get(key) if key is not None else None
+
+    def set(self, key: Optional[str], text: str):
+        if key is not None:
+            self.store.set(key, text)
+
+    def replay(self, text: str) -> Iterator[str]:
+        """Yield a cached response word by word, like a streamer would."""
+        for chunk in re.findall(r"\S*\s*", text):
+            if chunk:
+                yield chunk
+
+    def stats(self) -> dict:
+        return self.store.stats()
@@ -0,0 +1,60 @@
+import asyncio
+from typing import AsyncIterator, Iterator, Optional
+
+from ..domain.models.text.streaming import IncrementalTextStreamer
+from .response_cache import ResponseCache
+
+
+class ResponseStream:
+    """The chunks of a streamed response, for `for` loops (the pages) as well
+    as `async for` (the HTTP server, whose event loop must not block).
+
+    The full text is stored in `response_cache` under `key` once the stream
+    is exhausted, unless the generation was cancelled or failed. If the consumer stops
+    early (page rerun, new prompt, closed session or connection), the
+    generation is cancelled.
+    """
+
+    def __init__(
+        self,
+        streamer: IncrementalTextStreamer,
+        response_cache: Optional[ResponseCache] = None,
+        key: Optional[str] = None,
+    ):
+        self.streamer = streamer
+        self.response_cache = response_cache
+        self.key = key
+
+    def cancel(self):
+        self.streamer.cancel()
+
+    @property
+    def error(self) -> Optional[BaseException]:
+        """Why the generation failed, `None` unless it did."""
+        return self.streamer.handle.error
+
+    def _complete(self, text: str):
+        if self.response_cache is None or self.streamer.cancelled or self.streamer.failed:
+            # the text is partial, or empty
+            return
+        self.response_cache.set(self.key, text)
+
+    def __iter__(self) -> Iterator[str]:
+        text = ""
+        try:
+            for chunk in self.streamer:
+                text += chunk
+                yield chunk
+            self._complete(text)
+        finally:
+            self.streamer.cancel()
+
+    async def __aiter__(self) -> AsyncIterator[str]:
+        text = ""
+        try:
+            async for chunk in self.streamer:
+                text += chunk
+                yield chunk
+            await asyncio.get_running_loop().run_in_executor(None, self._complete, text)
+        finally:
+            self.streamer.cancel()
@@ -1,35 +1,183 @@
-from typing import Iterator, Union
+import weakref
+from typing import Iterator, List, Optional, Tuple, Union
+from ..domain.models.constants import PRELOAD_NEXT_MODEL
+from ..domain.models.registry import LoadHandle, LoadStatus, model_registry
 from ..domain.models.utils import list_local_models
+from ..domain.models.text.cancellation import GenerationHandle
+from ..domain.models.text.telemetry import GenerationMetrics
+from ..domain.models.text.worker_pool import QueueFullError, QueueStatus
 from ..domain.models.text.text_generation import TextGenerationModel
+from .response_cache import ResponseCache
+from .response_stream import ResponseStream
 
 
 class TextGenerationService:
-    def __init__(self):
+    def __init__(self, use_response_cache=True):
         self.assistant: TextGenerationModel = None
+        self._release_assistant = None
+        self._loading: LoadHandle = None
+        self._discard_loading = None
+        self._preloaded = set()
+        self.response_cache = ResponseCache() if use_response_cache else None
+        self.last_response_cached = False
+        # metrics of the last generation, None when served from the cache
+        self.last_metrics: Optional[GenerationMetrics] = None
+        self._generation: Optional[GenerationHandle] = None
+        self._draft_errors = {}
     
+    def _release_current(self):
+        # release first so the previous model can be evicted to make room
+        if self._release_assistant is not None:
+            self._release_assistant()
+            self.assistant = None
+        if self._loading is not None:
+            self._discard_loading()
+            self._loading = None
+
+    def _adopt(self, assistant: TextGenerationModel):
+        self.assistant = assistant
+        # give the model back to the registry when the session is garbage collected
+        self._release_assistant = weakref.finalize(
+            self, model_registry.release, self.assistant
+        )
+
     def set_assistant(self, id: str):
-        self.assistant = TextGenerationModel(id)
-        self.assistant.load()
+        if self.assistant is not None and self.assistant.id == id:
+            return self.assistant
+
+        self._release_current()
+        self._adopt(model_registry.acquire(TextGenerationModel, id))
         return self.assistant
-    
+
+    def request_assistant(
+        self, id: str, retry=False
+    ) -> Tuple[LoadStatus, Optional[str]]:
+        """Non-blocking `set_assistant`: start loading `id` in the background
+        and return its status (and error message if it failed). Poll until
+        it is `"ready"`, the model is then the assistant. A failed load is
+        only attempted again with `retry`."""
+        if self.assistant is not None and self.assistant.id == id:
+            return "ready", None
+
+        if (
+            self._loading is None
+            or self._loading.id != id
+            or (retry and self._loading.status()[0] == "failed")
+        ):
+            self._release_current()
+            self._loading = model_registry.acquire_async(TextGenerationModel, id)
+            self._discard_loading = weakref.finalize(self, self._loading.discard)
+
+        status, error = self._loading.status()
+        if status == "ready":
+            self._discard_loading.detach()
+            self._adopt(self._loading.result())
+            self._loading = None
+        return status, error
+
+    def preload_next(self, ids: List[str]):
+        """Load the model after the assistant in `ids` in the background, it
+        stays evictable. Does nothing unless `PRELOAD_NEXT_MODEL` is set."""
+        if not PRELOAD_NEXT_MODEL or self.assistant is None or len(ids) < 2:
+            return
+        if self.assistant.id not in ids:
+            return
+        next_id = ids[(ids.index(self.assistant.id) + 1) % len(ids)]
+        if next_id not in self._preloaded:
+            self._preloaded.add(next_id)
+            model_registry.preload_async(TextGenerationModel, next_id)
+
     def get_conversational_assistants_list(self):
         return list_local_models("text-generation")
     
+    def get_draft_options(self) -> List[str]:
+        """Local models that could serve as draft for the current assistant."""
+        return [id for id in list_local_models("text-generation") if id != self.assistant.id]
+
+    def set_draft(self, draft_id: Optional[str]):
+        """Pair the assistant with a draft model for assisted generation, or
+        remove its draft with `None`. The pairing is shared by every session
+        using the model. Raises `ValueError` if the draft is not compatible."""
+        if draft_id == self.assistant.draft_id:
+            return
+        if draft_id is None:
+            self.assistant.unload_draft()
+        else:
+            # don't load an incompatible draft again on every call
+            key = (self.assistant.id, draft_id)
+            if key in self._draft_errors:
+                raise ValueError(self._draft_errors[key])
+            try:
+                self.assistant.load_draft(draft_id)
+            except ValueError as e:
+                self._draft_errors[key] = str(e)
+                raise
+        model_registry.refresh(self.assistant)
+
+    def _set_last_metrics(self, metrics: GenerationMetrics):
+        self.last_metrics = metrics
+
+    def cancel_generation(self):
+        """Stop the generation of the last `send`, if it is still running."""
+        if self._generation is not None:
+            self._generation.cancel()
+            self._generation = None
+
+    def queue_status(self) -> Optional[QueueStatus]:
+        """Queue position and estimated wait of the last `send`, `None` once
+        it is generating (or done)."""
+        if self._generation is None or self.assistant is None or self.assistant.pool is None:
+            return None
+        return self.assistant.pool.status(self._generation)
+
     def send(self, content: str, stream=False, **kwargs) -> Union[str, Iterator[str]]:
         if not self.assistant:
             raise Exception("Assistant wasn't loaded correctly. This could be a caching problem")
         
+        model_registry.touch(self.assistant)
+        self.last_metrics = None
+        # a session runs one generation at a time, a new prompt supersedes the last
+        self.cancel_generation()
+        self._generation = handle = GenerationHandle()
+        key = None
+        if self.response_cache is not None:
+            key = self.response_cache.key(
+                self.assistant, self.assistant.encode(content), **kwargs
+            )
+            cached_response = self.response_cache.get(key)
+            self.last_response_cached = cached_response is not None
+            if self.last_response_cached:
+                return self.response_cache.replay(cached_response) if stream else cached_response
+
+        model_registry.hold(self.assistant, handle)
         assistant_response = ""
         try:
             if stream:
                 streamer = self.assistant.generate(
-                    content, stream=True, **kwargs
+                    content,
+                    stream=True,
+                    on_metrics=self._set_last_metrics,
+                    handle=handle,
+                    **kwargs,
                 )
-                return streamer
+                return ResponseStream(streamer, self.response_cache, key)
             else:
                 assistant_response = self.assistant.generate(
-                    content, stream=False, **kwargs
+                    content,
+                    stream=False,
+                    on_metrics=self._set_last_metrics,
+                    handle=handle,
+                    **kwargs,
                 )
+                if self.response_cache is not None:
+                    self.response_cache.set(key, assistant_response)
                 return assistant_response
+        except QueueFullError:
+            # the model is busy, nothing is generating for this prompt
+            self._generation = None
+            raise
         except Exception as e:
+            # gives the model back if the pool never got the request, nothing
+            # happens if it already finished the generation
+            handle.finish()
             raise e
@@ -0,0 +1,33 @@
+import pytest
+from transformers.utils import logging
+
+from benchmarks.tiny_models import tiny_models_dir
+
+# generate logs about the max_length/min_length defaults of every merged config
+logging.set_verbosity_error()
+
+
+@pytest.fixture(scope="session", autouse=True)
+def models_dir():
+    """Tiny random models under `MODELS_DIR`, in a temporary working directory."""
+    with tiny_models_dir({("conversational", "chat"): {}, ("text-generation", "text"): {}}) as path:
+        yield path
+
+
+def reference(model, inputs, **kwargs):
+    """Output of a plain `model.generate` call on `inputs`, without any KV
+    reuse. Like the models' own `generate`, it starts with the prompt for a
+    text prompt and is only the answer for chat messages."""
+    model_inputs = model._prepare_inputs(inputs)
+    output = model.model.generate(**model_inputs, **kwargs)[0]
+    if not isinstance(inputs, str):
+        output = output[model_inputs["input_ids"].shape[1] :]
+    return model.tokenizer.decode(output, skip_special_tokens=True)
+
+
+@pytest.fixture(scope="module")
+def early_eos(model, prompt):
+    """An end of sequence token the greedy generation of `prompt` emits third,
+    `model` and `prompt` are fixtures of the test module."""
+    inputs = model._prepare_inputs(prompt)
+    return model.model.generate(**inputs, max_new_tokens=3, do_sample=False)[0, -1].item()
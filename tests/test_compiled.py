@@ -0,0 +1,61 @@
+import os
+import subprocess
+import sys
+
+import pytest
+
+from src.domain.models.constants import CACHE_DIR
+from src.domain.models.text import compiled
+from src.domain.models.text.text_generation import TextGenerationModel
+
+PROMPT = "Hello world, how are you today?"
+
+
+@pytest.fixture(scope="module")
+def model():
+    model = TextGenerationModel("text", batching=False, compile_generation=True)
+    model.load()
+    yield model
+    model.unload()
+
+
+def uses_static_cache(model, prompt, **kwargs):
+    inputs = model._prepare_inputs(prompt)
+    return model._uses_static_cache({**inputs, **model.model.generation_config.to_dict(), **kwargs})
+
+
+def test_longer_than_the_largest_bucket(model):
+    assert not uses_static_cache(model, PROMPT, max_new_tokens=model.static_generator.buckets[-1])
+
+
+def test_import_leaves_the_environment_alone():
+    env = {name: value for name, value in os.environ.items() if name != "TORCHINDUCTOR_CACHE_DIR"}
+    code = "import os, src.domain.models.text.compiled; print('TORCHINDUCTOR_CACHE_DIR' in os.environ)"
+    root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    output = subprocess.run([sys.executable, "-c", code], cwd=root, env=env, capture_output=True, text=True)
+    assert output.stdout.strip() == "False"
+
+
+def test_compiling_leaves_the_environment_alone(monkeypatch):
+    monkeypatch.setattr(compiled, "_USER_CACHE_DIR", None)
+    model = TextGenerationModel("text", batching=False, compile_generation=True)
+    model.load()
+    try:
+        generator = model.static_generator
+        seen = []
+        decode = generator._decode
+
+        def spy(**kwargs):
+            seen.append(os.environ.get("TORCHINDUCTOR_CACHE_DIR"))
+            return decode(**kwargs)
+
+        generator._decode = spy
+        environment = os.environ.get("TORCHINDUCTOR_CACHE_DIR")
+        bucket = generator.buckets[1]
+        generator.generate(model.encode(PROMPT), max_new_tokens=bucket - 32, min_new_tokens=bucket - 32)
+        # the first step of a new bucket compiles it
+        assert seen[0] == os.path.abspath(os.path.join(CACHE_DIR, "inductor"))
+        assert set(seen[1:]) == {environment}
+        assert os.environ.get("TORCHINDUCTOR_CACHE_DIR") == environment
+    finally:
+        model.unload()
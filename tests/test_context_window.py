@@ -0,0 +1,72 @@
+import pytest
+
+from src.use_cases.context_window import ContextWindow
+
+SYSTEM = {"role": "system", "content": "You are helpful."}
+
+
+def history(turns: int) -> list:
+    """`turns` questions and answers of ten tokens each, then a question."""
+    messages = [SYSTEM]
+    for i in range(turns):
+        messages.append({"role": "user", "content": f"question {i} " * 5})
+        messages.append({"role": "assistant", "content": f"answer {i} " * 5})
+    messages.append({"role": "user", "content": "last question " * 5})
+    return messages
+
+
+def window(max_tokens: int, **kwargs) -> ContextWindow:
+    return ContextWindow(lambda message: len(message["content"].split()), max_tokens, **kwargs)
+
+
+def assert_alternates(messages: list):
+    assert messages[0] == SYSTEM
+    roles = [message["role"] for message in messages[1:]]
+    assert roles == ["user", "assistant"] * (len(roles) // 2) + ["user"]
+
+
+def test_history_within_budget_is_kept():
+    messages = history(3)
+    assert window(1000).fit(messages) == (messages, 0)
+
+
+@pytest.mark.parametrize("strategy", ["sliding_window", "keep_system_last_n", "drop_middle"])
+def test_trimming_keeps_whole_turns(strategy):
+    messages = history(6)
+    context = window(65, strategy=strategy, last_n=5, keep_first=1, low_watermark=1)
+    fitted, trimmed = context.fit(messages)
+    assert_alternates(fitted)
+    assert fitted[-1] == messages[-1]
+    assert context.total(fitted) <= 65
+    assert trimmed == context.total(messages) - context.total(fitted)
+
+
+def test_sliding_window_drops_the_oldest_turns():
+    messages = history(6)
+    fitted, _ = window(65, low_watermark=1).fit(messages)
+    assert fitted == [SYSTEM] + messages[-5:]
+
+
+def test_sliding_window_keeps_its_cut_point():
+    messages = history(6)
+    context = window(65, low_watermark=0.6)
+    fitted, _ = context.fit(messages)
+    assert fitted == [SYSTEM] + messages[-3:]
+    messages += [{"role": "assistant", "content": "answer"}, {"role": "user", "content": "next"}]
+    assert context.fit(messages)[0] == fitted + messages[-2:]
+
+
+def test_last_n_starts_with_a_user_message():
+    messages = history(6)
+    # the last four messages start with an answer
+    fitted, _ = window(1000, strategy="keep_system_last_n", last_n=4).fit(messages)
+    assert fitted == [SYSTEM] + messages[-3:]
+
+
+def test_drop_middle_keeps_the_first_turns():
+    messages = history(6)
+    context = window(75, strategy="drop_middle", keep_first=1, low_watermark=1)
+    fitted, _ = context.fit(messages)
+    # the first question is kept with its answer
+    assert fitted == [SYSTEM] + messages[1:3] + messages[-5:]
+    assert_alternates(fitted)
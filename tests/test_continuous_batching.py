@@ -0,0 +1,67 @@
+import threading
+
+import pytest
+from transformers import GenerationConfig
+
+from src.domain.models.text.continuous_batching import unsupported_options
+from src.domain.models.text.conversational import ConversationalModel
+
+from .conftest import reference
+from .test_conversational import SYSTEM
+
+MESSAGES = [{"role": "user", "content": "Hello world"}]
+
+
+@pytest.fixture(scope="module")
+def model():
+    model = ConversationalModel("chat", continuous_batching=True, compile_generation=False)
+    model.load()
+    yield model
+    model.unload()
+
+
+def test_prompt_longer_than_max_length(model):
+    with pytest.raises(ValueError, match="max_length"):
+        model.generate(MESSAGES, max_length=4, do_sample=False)
+
+
+def test_stream(model):
+    kwargs = dict(max_new_tokens=8, do_sample=False)
+    assert "".join(model.generate(MESSAGES, stream=True, **kwargs)) == reference(model, MESSAGES, **kwargs)
+
+
+def test_concurrent_sequences_join_and_leave(model):
+    contents = ["Hello world", "The quick brown fox jumps over the lazy dog.", "def main():", "Hi"]
+    conversations = [[SYSTEM, {"role": "user", "content": content}] for content in contents]
+    lengths = [4, 12, 8, 16]
+    results = [None] * len(contents)
+
+    def chat(i):
+        results[i] = "".join(
+            model.generate(conversations[i], stream=True, max_new_tokens=lengths[i], do_sample=False)
+        )
+
+    threads = [threading.Thread(target=chat, args=(i,)) for i in range(len(contents))]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert results == [
+        reference(model, messages, max_new_tokens=length, do_sample=False)
+        for messages, length in zip(conversations, lengths)
+    ]
+
+
+def test_unsupported_options():
+    defaults = GenerationConfig().to_dict()
+    assert unsupported_options(defaults) == []
+    assert unsupported_options({**defaults, "temperature": 0.7, "top_k": 10, "max_new_tokens": 4}) == []
+    assert unsupported_options({**defaults, "num_beams": 2, "no_repeat_ngram_size": 3}) == [
+        "no_repeat_ngram_size",
+        "num_beams",
+    ]
+    # warpers only apply when sampling
+    assert unsupported_options({**defaults, "typical_p": 0.9}) == []
+    assert unsupported_options({**defaults, "typical_p": 0.9, "do_sample": True}) == ["typical_p"]
+    # options that are not part of a generation config
+    assert unsupported_options({"logits_processor": [object()], "streamer": object()}) == ["logits_processor"]
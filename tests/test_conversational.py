@@ -0,0 +1,68 @@
+import pytest
+
+from src.domain.models.text.conversational import ConversationalModel
+from src.domain.models.text.kv_cache import ConversationCache
+
+from .conftest import reference
+
+SYSTEM = {"role": "system", "content": "You are a helpful assistant."}
+
+
+@pytest.fixture(scope="module")
+def model():
+    model = ConversationalModel("chat", continuous_batching=False, compile_generation=False)
+    model.load()
+    yield model
+    model.unload()
+
+
+def conversation(*contents):
+    messages = [SYSTEM]
+    for i, content in enumerate(contents):
+        messages.append({"role": "user" if i % 2 == 0 else "assistant", "content": content})
+    return messages
+
+
+def test_cache_reuses_the_previous_turn(model):
+    cache = ConversationCache()
+    first = conversation("Hello world")
+    answer = model.generate(first, cache=cache, max_new_tokens=8, do_sample=False)
+    assert answer == reference(model, first, max_new_tokens=8, do_sample=False)
+
+    second = conversation("Hello world", answer, "The quick brown fox")
+    answer = model.generate(second, cache=cache, max_new_tokens=8, do_sample=False)
+    assert cache.reused_tokens > len(model.encode(first)) // 2
+    assert answer == reference(model, second, max_new_tokens=8, do_sample=False)
+
+
+def test_cache_with_edited_history(model):
+    cache = ConversationCache()
+    model.generate(conversation("Hello world"), cache=cache, max_new_tokens=4, do_sample=False)
+    edited = conversation("The quick brown fox")
+    answer = model.generate(edited, cache=cache, max_new_tokens=8, do_sample=False)
+    assert answer == reference(model, edited, max_new_tokens=8, do_sample=False)
+
+
+def test_beam_search_with_cache(model):
+    cache = ConversationCache()
+    messages = conversation("Hello world")
+    model.generate(messages, cache=cache, max_new_tokens=4, do_sample=False)
+    kwargs = dict(max_new_tokens=8, num_beams=3, do_sample=False)
+    assert model.generate(messages, cache=cache, **kwargs) == reference(model, messages, **kwargs)
+    # the cache was bypassed, not dropped
+    assert cache.token_ids
+
+
+def test_multiple_return_sequences(model):
+    messages = conversation("Hello world")
+    kwargs = dict(max_new_tokens=8, num_return_sequences=2, num_beams=2, do_sample=False)
+    assert model.generate(messages, cache=ConversationCache(), **kwargs) == reference(model, messages, **kwargs)
+
+
+def test_beam_search_from_generation_config(model):
+    messages = conversation("Hello world")
+    model.model.generation_config.num_beams = 3
+    try:
+        assert model.generate(messages, max_new_tokens=8) == reference(model, messages, max_new_tokens=8)
+    finally:
+        model.model.generation_config.num_beams = 1
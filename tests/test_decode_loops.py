@@ -0,0 +1,91 @@
+"""Parity with `model.generate` of the decode loops that replace it: the
+continuous batching engine of chat models and the compiled static-cache
+loop of text generation models."""
+
+import pytest
+
+from src.domain.models.text.conversational import ConversationalModel
+from src.domain.models.text.text_generation import TextGenerationModel
+
+from .conftest import reference
+
+MESSAGES = [{"role": "user", "content": "Hello world"}]
+PROMPT = "Hello world, how are you today?"
+
+
+@pytest.fixture(scope="module", params=["continuous_batching", "compiled"])
+def model(request):
+    if request.param == "continuous_batching":
+        model = ConversationalModel("chat", continuous_batching=True, compile_generation=False)
+    else:
+        model = TextGenerationModel("text", batching=False, compile_generation=True)
+    model.load()
+    yield model
+    model.unload()
+
+
+@pytest.fixture(scope="module")
+def prompt(model):
+    return MESSAGES if isinstance(model, ConversationalModel) else PROMPT
+
+
+def run(model, prompt, **kwargs):
+    """Output of `model.generate` and whether the decode loop produced it."""
+    if isinstance(model, ConversationalModel):
+        tokens = model.engine.tokens
+        output = model.generate(prompt, **kwargs)
+        return output, model.engine.tokens > tokens
+    inputs = model._prepare_inputs(prompt)
+    on_loop = model._uses_static_cache({**inputs, **model.model.generation_config.to_dict(), **kwargs})
+    return model.generate(prompt, **kwargs), on_loop
+
+
+@pytest.mark.parametrize(
+    "kwargs",
+    [
+        dict(max_new_tokens=8),
+        dict(max_new_tokens=8, repetition_penalty=1.3),
+        dict(max_new_tokens=8, min_p=0.5),
+        dict(max_length=40),
+    ],
+)
+def test_supported_options_run_on_the_loop(model, prompt, kwargs):
+    output, on_loop = run(model, prompt, do_sample=False, **kwargs)
+    assert on_loop
+    assert output == reference(model, prompt, do_sample=False, **kwargs)
+
+
+@pytest.mark.parametrize(
+    "kwargs",
+    [
+        dict(),
+        dict(min_new_tokens=6),
+        # past the prompt, which `min_length` counts
+        dict(min_length=6),
+        dict(min_new_tokens=5, repetition_penalty=1.3),
+    ],
+)
+def test_end_of_sequence(model, prompt, early_eos, kwargs):
+    kwargs = dict(kwargs, max_new_tokens=8, do_sample=False, eos_token_id=early_eos)
+    if "min_length" in kwargs:
+        kwargs["min_length"] += len(model.encode(prompt))
+    output, on_loop = run(model, prompt, **kwargs)
+    assert on_loop
+    assert output == reference(model, prompt, pad_token_id=early_eos, **kwargs)
+
+
+@pytest.mark.parametrize(
+    "kwargs",
+    [
+        dict(num_beams=3),
+        dict(no_repeat_ngram_size=1),
+        dict(bad_words_ids=[[5], [6]]),
+        dict(suppress_tokens=[5, 6]),
+        dict(sequence_bias={(5,): 10.0}),
+    ],
+)
+def test_unsupported_options_fall_back_to_generate(model, prompt, kwargs):
+    kwargs = dict(kwargs, max_new_tokens=8, do_sample=False)
+    output, on_loop = run(model, prompt, **kwargs)
+    assert not on_loop
+    assert output == reference(model, prompt, **kwargs)
@@ -0,0 +1,83 @@
+import pytest
+
+from src.domain.models.text.conversational import ConversationalModel
+from src.domain.models.text.kv_cache import ConversationCache
+
+from .conftest import reference
+from .test_conversational import SYSTEM
+from .test_worker_pool import Blocker
+
+KWARGS = dict(max_new_tokens=8, do_sample=False)
+
+
+@pytest.fixture(scope="module")
+def model():
+    model = ConversationalModel("chat", continuous_batching=False, compile_generation=False)
+    model.load()
+    yield model
+    model.unload()
+
+
+@pytest.fixture(autouse=True)
+def empty_prefix_cache(model):
+    model.prefix_cache.clear()
+
+
+def lookups(model):
+    return model.prefix_cache.hits, model.prefix_cache.misses
+
+
+def test_sessions_share_the_system_prefix(model):
+    first = [SYSTEM, {"role": "user", "content": "Hello world"}]
+    second = [SYSTEM, {"role": "user", "content": "The quick brown fox"}]
+    assert model.generate(first, cache=ConversationCache(), **KWARGS) == reference(model, first, **KWARGS)
+    assert model.prefix_cache.size > 0
+
+    hits, _ = lookups(model)
+    cache = ConversationCache()
+    assert model.generate(second, cache=cache, **KWARGS) == reference(model, second, **KWARGS)
+    assert lookups(model)[0] == hits + 1
+    assert cache.reused_tokens > 0
+
+
+def test_generation_without_a_cache_starts_from_the_prefix(model):
+    messages = [SYSTEM, {"role": "user", "content": "Hello world"}]
+    model.generate(messages, **KWARGS)
+    hits, _ = lookups(model)
+    assert model.generate(messages, **KWARGS) == reference(model, messages, **KWARGS)
+    assert lookups(model)[0] == hits + 1
+
+
+def test_no_prefix_without_a_system_message(model):
+    messages = [{"role": "user", "content": "Hello world"}]
+    assert model.generate(messages, **KWARGS) == reference(model, messages, **KWARGS)
+    assert model.prefix_cache.size == 0
+
+
+def test_beam_search_skips_the_prefix_cache(model):
+    messages = [SYSTEM, {"role": "user", "content": "Hello world"}]
+    model.generate(messages, **KWARGS)
+    before = lookups(model)
+    kwargs = dict(KWARGS, num_beams=3)
+    assert model.generate(messages, **kwargs) == reference(model, messages, **kwargs)
+    assert lookups(model) == before
+
+
+@pytest.mark.parametrize("continuous_batching", [False, True])
+def test_prefix_is_computed_by_the_pool(continuous_batching):
+    model = ConversationalModel("chat", continuous_batching=continuous_batching, compile_generation=False)
+    model.load()
+    blocker = Blocker()
+    try:
+        model.pool.submit(blocker)
+        assert blocker.started.wait(5)
+        messages = [SYSTEM, {"role": "user", "content": "Hello world"}]
+        streamer = model.generate(messages, stream=True, **KWARGS)
+        # queued behind the blocker, the caller did not prefill the prefix
+        assert model.prefix_cache.size == 0
+        blocker.release.set()
+        assert "".join(streamer) == reference(model, messages, **KWARGS)
+        assert model.prefix_cache.size > 0
+    finally:
+        blocker.release.set()
+        model.unload()
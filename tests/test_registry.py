@@ -0,0 +1,37 @@
+import time
+
+from benchmarks.tiny_models import CORPUS
+from src.domain.models.registry import model_registry
+from src.domain.models.text.text_generation import TextGenerationModel
+from src.use_cases.text_generation_service import TextGenerationService
+
+from .test_worker_pool import Blocker
+
+KWARGS = dict(max_new_tokens=8, do_sample=False)
+
+
+def test_generation_keeps_its_model_loaded(monkeypatch):
+    expected = TextGenerationService(use_response_cache=False)
+    expected.set_assistant("text")
+    expected = expected.send(CORPUS[0], **KWARGS)
+    # every model nobody holds is evicted
+    monkeypatch.setattr(model_registry, "memory_budget", 0)
+
+    service = TextGenerationService(use_response_cache=False)
+    model = service.set_assistant("text")
+    blocker = Blocker()
+    model.pool.submit(blocker)
+    assert blocker.started.wait(5)
+    stream = service.send(CORPUS[0], stream=True, **KWARGS)
+    # the session switches models while its generation is queued
+    assert service.request_assistant("missing")[0] in ("loading", "failed")
+    assert model_registry.status(TextGenerationModel, "text")[0] == "ready"
+
+    blocker.release.set()
+    assert "".join(stream) == expected
+    # the worker finishes the generation after the end of the stream
+    handle = stream.streamer.handle
+    deadline = time.monotonic() + 5
+    while not handle.finished and time.monotonic() < deadline:
+        time.sleep(0.01)
+    assert model_registry.status(TextGenerationModel, "text")[0] is None
@@ -0,0 +1,23 @@
+from src.use_cases.repo_downloader import RepoDownloader
+
+# nothing is fetched from it, every file is already on disk
+ENDPOINT = "http://localhost:9"
+
+
+def test_complete_files_count_as_done(tmp_path):
+    files = []
+    for name, size in [("config.json", 10), ("weights/model.safetensors", 100)]:
+        path = tmp_path / name
+        path.parent.mkdir(parents=True, exist_ok=True)
+        path.write_bytes(b"x" * size)
+        files.append({"rfilename": name, "size": size})
+
+    reports = []
+    paths = RepoDownloader(ENDPOINT).download("repo", files, str(tmp_path), on_progress=reports.append)
+
+    assert paths == [str(tmp_path / file["rfilename"]) for file in files]
+    progress = reports[-1]
+    assert (progress.files_done, progress.files_total) == (2, 2)
+    assert progress.downloaded_bytes == progress.total_bytes == 110
+    assert progress.fraction == 1.0
+    assert progress.bytes_per_second == 0
@@ -0,0 +1,41 @@
+import pytest
+
+from benchmarks.tiny_models import CORPUS
+from src.domain.models.text.text_generation import TextGenerationModel
+from src.use_cases.response_cache import ResponseCache
+from src.use_cases.response_stream import ResponseStream
+
+KWARGS = dict(max_new_tokens=4, do_sample=False)
+
+
+@pytest.fixture(params=[False, True], ids=["unbatched", "batched"], scope="module")
+def model(request):
+    model = TextGenerationModel("text", batching=request.param, compile_generation=False)
+    model.load()
+    yield model
+    model.unload()
+
+
+@pytest.fixture
+def response_cache(tmp_path):
+    return ResponseCache(str(tmp_path / "responses.sqlite"))
+
+
+def stream(model, response_cache, **kwargs):
+    key = response_cache.key(model, model.encode(CORPUS[0]), **kwargs)
+    streamer = model.generate(CORPUS[0], stream=True, **kwargs)
+    return key, "".join(ResponseStream(streamer, response_cache, key))
+
+
+def test_completed_stream_is_cached(model, response_cache):
+    key, text = stream(model, response_cache, **KWARGS)
+    assert text == model.generate(CORPUS[0], **KWARGS)
+    assert response_cache.get(key) == text
+
+
+@pytest.mark.filterwarnings("ignore:Generation with")
+def test_failed_stream_is_not_cached(model, response_cache):
+    # streamers don't support beam search
+    key, text = stream(model, response_cache, num_beams=2, **KWARGS)
+    assert text == ""
+    assert response_cache.get(key) is None
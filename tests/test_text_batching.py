@@ -0,0 +1,91 @@
+import gc
+import threading
+import time
+import weakref
+
+import pytest
+
+from benchmarks.tiny_models import CORPUS
+from src.domain.models.text.cancellation import GenerationHandle
+from src.domain.models.text.text_generation import TextGenerationModel
+
+KWARGS = dict(max_new_tokens=8, do_sample=False)
+
+
+@pytest.fixture(scope="module")
+def unbatched():
+    model = TextGenerationModel("text", batching=False, compile_generation=False)
+    model.load()
+    yield model
+    model.unload()
+
+
+@pytest.fixture(scope="module")
+def batched():
+    model = TextGenerationModel("text", batching=True, compile_generation=False)
+    model.load()
+    yield model
+    model.unload()
+
+
+def test_batch_matches_single_prompts(batched, unbatched):
+    scheduler = batched.scheduler
+    batches = scheduler.batches
+    futures = [scheduler.submit(prompt, **KWARGS) for prompt in CORPUS]
+    assert [future.result() for future in futures] == [unbatched.generate(prompt, **KWARGS) for prompt in CORPUS]
+    assert scheduler.batches - batches < len(CORPUS)
+
+
+def test_concurrent_streams_get_their_own_rows(batched, unbatched):
+    results = [None] * len(CORPUS)
+
+    def stream(i):
+        results[i] = "".join(batched.generate(CORPUS[i], stream=True, **KWARGS))
+
+    threads = [threading.Thread(target=stream, args=(i,)) for i in range(len(CORPUS))]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert results == [unbatched.generate(prompt, **KWARGS) for prompt in CORPUS]
+
+
+def test_different_kwargs_are_not_batched_together(batched, unbatched):
+    scheduler = batched.scheduler
+    batches = scheduler.batches
+    short = scheduler.submit(CORPUS[0], max_new_tokens=2, do_sample=False)
+    long = scheduler.submit(CORPUS[1], **KWARGS)
+    assert short.result() == unbatched.generate(CORPUS[0], max_new_tokens=2, do_sample=False)
+    assert long.result() == unbatched.generate(CORPUS[1], **KWARGS)
+    assert scheduler.batches - batches == 2
+
+
+def test_cancelled_request_is_dropped(batched):
+    handle = GenerationHandle()
+    handle.cancel()
+    future = batched.scheduler.submit(CORPUS[0], handle=handle, **KWARGS)
+    other = batched.scheduler.submit(CORPUS[1], **KWARGS)
+    assert other.result()
+    assert future.cancelled()
+
+
+def test_multiple_return_sequences(batched, unbatched):
+    kwargs = dict(KWARGS, num_beams=2, num_return_sequences=2)
+    scheduler = batched.scheduler
+    batches = scheduler.batches
+    expected = [unbatched.generate(prompt, **kwargs) for prompt in CORPUS[:2]]
+    assert [batched.generate(prompt, **kwargs) for prompt in CORPUS[:2]] == expected
+    assert scheduler.batches == batches
+    futures = [scheduler.submit(prompt, **kwargs) for prompt in CORPUS[:2]]
+    assert [future.result() for future in futures] == expected
+
+
+def test_idle_scheduler_keeps_no_request(batched):
+    streamer = batched.generate(CORPUS[0], stream=True, **KWARGS)
+    assert "".join(streamer)
+    streamer = weakref.ref(streamer)
+    deadline = time.monotonic() + 5
+    while streamer() is not None and time.monotonic() < deadline:
+        gc.collect()
+        time.sleep(0.01)
+    assert streamer() is None
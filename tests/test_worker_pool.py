@@ -0,0 +1,149 @@
+import functools
+import gc
+import threading
+import time
+import weakref
+
+import pytest
+
+from src.domain.models.text.cancellation import GenerationHandle
+from src.domain.models.text.worker_pool import GenerationPool, QueueFullError
+from src.use_cases.text_generation_service import TextGenerationService
+
+
+class Blocker:
+    """A task that runs until released."""
+
+    def __init__(self):
+        self.started = threading.Event()
+        self.release = threading.Event()
+
+    def __call__(self):
+        self.started.set()
+        self.release.wait(5)
+        return "done"
+
+
+@pytest.fixture
+def pool():
+    pool = GenerationPool(1, max_queue=1, max_wait=None)
+    yield pool
+    pool.close()
+
+
+def test_runs_at_most_max_workers_at_once():
+    pool = GenerationPool(2, max_queue=8, max_wait=None)
+    running, peak = [0], [0]
+    lock = threading.Lock()
+
+    def task():
+        with lock:
+            running[0] += 1
+            peak[0] = max(peak[0], running[0])
+        time.sleep(0.02)
+        with lock:
+            running[0] -= 1
+
+    futures = [pool.submit(task) for _ in range(6)]
+    for future in futures:
+        future.result()
+    pool.close()
+    assert peak[0] == 2
+
+
+def test_full_queue_rejects(pool):
+    blocker = Blocker()
+    running = pool.submit(blocker)
+    assert blocker.started.wait(5)
+    queued = pool.submit(lambda: "queued")
+    with pytest.raises(QueueFullError):
+        pool.submit(lambda: "rejected")
+    assert pool.rejected == 1
+    blocker.release.set()
+    assert running.result() == "done"
+    assert queued.result() == "queued"
+
+
+def test_estimated_wait_rejects():
+    pool = GenerationPool(1, max_queue=8, max_wait=0.05)
+    pool.submit(lambda: time.sleep(0.1)).result()
+    blocker = Blocker()
+    pool.submit(blocker)
+    assert blocker.started.wait(5)
+    with pytest.raises(QueueFullError) as error:
+        pool.submit(lambda: None)
+    assert error.value.retry_after >= 0.05
+    blocker.release.set()
+    pool.close()
+
+
+def test_queue_status(pool):
+    blocker = Blocker()
+    pool.submit(blocker)
+    assert blocker.started.wait(5)
+    handle = GenerationHandle()
+    pool.submit(lambda: None, handle)
+    assert pool.status(handle).position == 1
+    blocker.release.set()
+
+
+def test_cancelled_task_is_skipped(pool):
+    blocker = Blocker()
+    pool.submit(blocker)
+    assert blocker.started.wait(5)
+    handle = GenerationHandle()
+    ran, skipped = [], []
+    future = pool.submit(lambda: ran.append(1), handle, lambda: skipped.append(1))
+    handle.cancel()
+    # the cancelled task no longer takes the queue slot
+    other = pool.submit(lambda: "other")
+    blocker.release.set()
+    assert other.result() == "other"
+    assert future.cancelled() and skipped == [1] and ran == []
+
+
+def test_close_skips_queued_tasks(pool):
+    blocker = Blocker()
+    pool.submit(blocker)
+    assert blocker.started.wait(5)
+    skipped = []
+    future = pool.submit(lambda: None, None, lambda: skipped.append(1))
+    pool.close()
+    blocker.release.set()
+    assert future.cancelled() and skipped == [1]
+    with pytest.raises(RuntimeError):
+        pool.submit(lambda: None)
+
+
+def test_idle_worker_drops_the_finished_task(pool):
+    class State:
+        pass
+
+    state = State()
+    ref = weakref.ref(state)
+    pool.submit(functools.partial(lambda value: value, state)).result()
+    del state
+    # the worker lets go once it has resolved the future
+    deadline = time.monotonic() + 5
+    while ref() is not None and time.monotonic() < deadline:
+        gc.collect()
+        time.sleep(0.01)
+    assert ref() is None
+
+
+def test_service_forgets_a_rejected_generation():
+    service = TextGenerationService(use_response_cache=False)
+    model = service.set_assistant("text")
+    pool, model.pool = model.pool, GenerationPool(1, max_queue=0, max_wait=None)
+    blocker = Blocker()
+    try:
+        model.pool.submit(blocker)
+        assert blocker.started.wait(5)
+        with pytest.raises(QueueFullError):
+            service.send("Hello", max_new_tokens=2, do_sample=False)
+        assert service._generation is None
+        assert service.queue_status() is None
+    finally:
+        blocker.release.set()
+        model.pool.close()
+        model.pool = pool